@@ -0,0 +1,315 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Purpose
+
+An asyncio client for the Astra DevOps API operations used by lambda_function.py: creating, deleting and
+listing tokens, looking up the roles of a token, and checking that a token can authenticate.
+
+Requests share a pool of keep-alive HTTPS connections, and up to max_connections of them can be in flight at
+the same time, so that thousands of tokens can be managed from one event loop. Operations return the named
+tuples defined below instead of the (status, reason, headers, data) tuple of make_API_request, and raise
+AstraAPIError when Astra does not answer with a success status.
+
+As with make_API_request, transient failures are retried according to lambda_function.retry_delay, within the
+process wide lambda_function.astra_retry_budget, no call is started past the deadline set by
+lambda_function.deadline, and every attempt is recorded in lambda_function.rotation_metrics.
+
+Example:
+
+    async with AsyncAstraClient(root_key) as astra:
+        token = await astra.create_token(roles)
+        await asyncio.gather(*(astra.delete_token(client_id) for client_id in stale_ids))
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+import lambda_function
+
+logger = logging.getLogger(__name__)
+
+
+class AstraResponse(NamedTuple):
+    """A response of the Astra DevOps API"""
+    status: int
+    reason: str
+    headers: List[Tuple[str, str]]
+    data: Any
+
+
+class AstraClient(NamedTuple):
+    """A client ID of the organization and its roles"""
+    client_id: str
+    roles: List[str]
+
+
+class AstraToken(NamedTuple):
+    """A newly created token"""
+    client_id: str
+    secret: str
+    token: str
+    roles: List[str]
+
+
+class AstraAPIError(Exception):
+    """Raised when the Astra DevOps API does not answer with a success status"""
+
+    def __init__(self, method, path, response):
+        super().__init__(f"{method} {path} failed with status {response.status} {response.reason}: {response.data}")
+        self.status = response.status
+        self.response = response
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # Whether the current request was fully written
+        self.sent = False
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncAstraClient:
+    """asyncio client for the Astra DevOps API
+
+    Args:
+        token: the Astra token used for authentication, usually the root key
+        host: the Astra API host
+        max_connections: the maximum number of requests in flight, and of pooled connections
+        timeout: the number of seconds to wait for a connection or a response
+        ssl_context: the SSL context, by default the one shared with lambda_function.py
+        max_attempts: the maximum number of attempts of a request, astraAPImaxAttempts by default
+        retry_budget: the RetryBudget retries are withdrawn from, by default the one shared with lambda_function.py
+    """
+
+    def __init__(self, token, host=lambda_function.astraAPIhost, max_connections=32, timeout=30,
+                 ssl_context=None, max_attempts=lambda_function.astraAPImaxAttempts, retry_budget=None):
+        self.token = token
+        self.host, _, port = host.partition(':')
+        self.port = int(port) if port else 443
+        self.timeout = timeout
+        self.ssl_context = ssl_context or lambda_function.get_ssl_context()
+        self.max_attempts = max_attempts
+        self.retry_budget = retry_budget or lambda_function.astra_retry_budget
+        self.hits = 0
+        self.misses = 0
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Closes every idle connection"""
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+        for conn in idle:
+            try:
+                await conn.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _connect(self, timeout):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl_context, server_hostname=self.host), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise lambda_function.AstraConnectionError(f"Unable to connect to {self.host}: {e!r}") from e
+        return _Connection(reader, writer)
+
+    def _acquire(self):
+        while self._idle:
+            conn = self._idle.pop()
+            if not conn.reader.at_eof() and not conn.writer.is_closing():
+                self.hits += 1
+                return conn
+            conn.close()
+        self.misses += 1
+        return None
+
+    async def _exchange(self, conn, method, path, body):
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", "Content-Type: application/json",
+                f"Authorization: Bearer {self.token}", f"Content-Length: {len(body)}", "", ""]
+        conn.sent = False
+        conn.writer.write("\r\n".join(head).encode("latin-1") + body)
+        await conn.writer.drain()
+        conn.sent = True
+
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the Astra API")
+        parts = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        status = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ""
+        headers = []
+        while True:
+            line = await conn.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers.append((name.strip(), value.strip()))
+        fields = {name.lower(): value for name, value in headers}
+
+        if fields.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await conn.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # Skip the trailers
+                    while (await conn.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await conn.reader.readexactly(size))
+                await conn.reader.readexactly(2)
+            content = b"".join(chunks)
+        elif "content-length" in fields:
+            content = await conn.reader.readexactly(int(fields["content-length"]))
+        elif status in (204, 304) or method == "HEAD":
+            content = b""
+        else:
+            content = await conn.reader.read()
+            fields["connection"] = "close"
+
+        keep_alive = fields.get("connection", "").lower() != "close"
+        return status, reason, headers, content, keep_alive
+
+    async def _send(self, method, path, payload):
+        timeout = lambda_function.call_timeout(self.timeout, f"{method} {path}")
+        async with self._slots:
+            conn = self._acquire()
+            reused = conn is not None
+            try:
+                if conn is None:
+                    conn = await self._connect(timeout)
+                try:
+                    status, reason, headers, content, keep_alive = await asyncio.wait_for(
+                        self._exchange(conn, method, path, payload), timeout)
+                except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                    # The server closed an idle pooled connection, try once more on a new one. Once the request
+                    # was sent, the server may have processed it before closing, so only idempotent requests are
+                    # sent again.
+                    if not reused or (conn.sent and method not in lambda_function.astraAPIidempotentMethods):
+                        raise
+                    conn.close()
+                    conn = None
+                    conn = await self._connect(timeout)
+                    status, reason, headers, content, keep_alive = await asyncio.wait_for(
+                        self._exchange(conn, method, path, payload), timeout)
+            except BaseException:
+                if conn is not None:
+                    conn.close()
+                raise
+            if keep_alive:
+                self._idle.append(conn)
+            else:
+                conn.close()
+            return status, reason, headers, content
+
+    async def request(self, method, path, body=None):
+        """Sends a request to the Astra API
+
+        Requests which fail with a transient error (a connection error, a timeout, 429 or 5xx) are retried
+        like those of make_API_request: when retry_delay allows it for the method, up to max_attempts times, and
+        as long as the retry budget is not exhausted and the retry can be made before the deadline. Otherwise
+        the last response is returned, or the last error raised.
+
+        Args:
+            method: the HTTP method
+            path: the request path, e.g. /v2/clientIdSecrets
+            body: an optional dictionary, sent as the JSON request body
+
+        Returns:
+            AstraResponse: the response, with the JSON body already parsed, or as text when it is not JSON
+
+        Raises:
+            DeadlineExceeded: If the first attempt can not be made before the deadline
+        """
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        metrics = lambda_function.rotation_metrics
+        self.retry_budget.deposit()
+        attempt = 1
+        while True:
+            error = None
+            started = time.monotonic()
+            try:
+                status, reason, headers, content = await self._send(method, path, payload)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                error = e
+                status, reason, headers, content = None, None, [], b''
+            metrics.record_astra_request(method, path, started, status, payload, content)
+            delay = lambda_function.retry_delay(method, attempt, status, headers, error)
+            remaining = lambda_function.remaining_time()
+            if delay is not None and remaining is not None and delay >= remaining:
+                # The retry could not be made before the deadline
+                delay = None
+            if delay is None or attempt >= self.max_attempts or not self.retry_budget.withdraw():
+                if error is not None:
+                    raise error
+                break
+            metrics.count("AstraRetries", Endpoint=lambda_function.astra_endpoint_name(method, path))
+            logger.info("Retrying %s %s in %.2fs after attempt %d failed with %s", method, path, delay, attempt,
+                        error if error is not None else status)
+            await asyncio.sleep(delay)
+            attempt += 1
+        return AstraResponse(status, reason, headers, lambda_function.decode_API_body(content))
+
+    async def _call(self, method, path, body=None, expected=(200,)):
+        response = await self.request(method, path, body)
+        if response.status not in expected:
+            raise AstraAPIError(method, path, response)
+        return response
+
+    async def create_token(self, roles) -> AstraToken:
+        """Creates a token with the given roles, like create_astra_token"""
+        response = await self._call("POST", "/v2/clientIdSecrets", {"roles": roles}, expected=(200, 201))
+        data = response.data
+        return AstraToken(data["clientId"], data["secret"], data["token"], list(data.get("roles", roles)))
+
+    async def delete_token(self, client_id, missing_ok=False) -> bool:
+        """Deletes the token of a client ID, like delete_astra_token
+
+        Returns:
+            True when the token was deleted, False when it did not exist and missing_ok is set
+        """
+        expected = (200, 204, 404) if missing_ok else (200, 204)
+        response = await self._call("DELETE", f"/v2/clientIdSecrets/{client_id}", expected=expected)
+        return response.status != 404
+
+    async def list_clients(self) -> List[AstraClient]:
+        """Lists every client ID of the organization with its roles"""
+        response = await self._call("GET", "/v2/clientIdSecrets")
+        return [AstraClient(client["clientId"], client["roles"]) for client in response.data["clients"]]
+
+    async def get_token_roles(self, client_id) -> List[str]:
+        """Returns the roles of a client ID, like get_token_roles
+
+        Raises:
+            KeyError: If no client with the client ID exists in Astra
+        """
+        for client in await self.list_clients():
+            if client.client_id == client_id:
+                return client.roles
+        raise KeyError(f"Client ID {client_id} does not exist in Astra")
+
+    async def current_org(self) -> Optional[dict]:
+        """Returns the organization of the token, or None when the token is rejected
+
+        This is the probe used by test_secret to check that a token works.
+        """
+        response = await self.request("GET", "/v2/currentOrg")
+        if response.status in (401, 403):
+            return None
+        if response.status != 200:
+            raise AstraAPIError("GET", "/v2/currentOrg", response)
+        return response.data
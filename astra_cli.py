@@ -0,0 +1,269 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+"""
+This Python code gets, creates, rotates and deletes many Astra secrets in one run, doing the work of the
+example_*.py scripts for a whole batch of secrets.
+
+The secrets are given as names on the command line, or as the rows of a manifest: a JSON file (a list of objects,
+or one object per line) or a CSV file with a header row which has a name column, read from --manifest or from
+stdin. Each row has a name and, depending on the command, the fields below. Command line options give the default
+of each field:
+
+    get      name
+    new      name, roles (a list, or separated by spaces in CSV), rootarn
+    rotate   name, lambda_arn, schedule, duration; without lambda_arn the secret is rotated now with its current
+             configuration, with it the rotation is configured (with the schedule and duration when given)
+    delete   name; the Astra token of the secret is revoked, then the secret deleted without recovery
+
+The rows run concurrently on a thread pool, and a rate limiter bounds the number of operations started per second
+across all threads. Root keys are read once per root secret, through the root secret cache of lambda_function.py.
+boto3 and the other libraries are only imported once there is work to do, so that the script starts quickly.
+Every result is printed as a JSON line as soon as it is available, followed by a summary line.
+"""
+# Syntax:
+# python astra_cli.py get [--workers N] [--rate N] [--manifest FILE | -] [<NAME>...]
+# python astra_cli.py new [--roles ROLE...] [--root-arn <ROOT ARN>] [--manifest FILE | -] [<NAME>...]
+# python astra_cli.py rotate [--lambda-arn <LAMBDA ARN>] [--schedule EXPR] [--duration D] [--manifest FILE | -] [<NAME>...]
+# python astra_cli.py delete [--manifest FILE | -] [<NAME>...]
+
+# Example
+# python astra_cli.py new --root-arn arn:aws:secretsmanager:us-east-1:388318891461:secret:/astra/prod/rootkey-g1NqFK --manifest apps.csv
+# printf '/astra/prod/app1\n/astra/prod/app2\n' | python astra_cli.py rotate -
+
+# Fields of each command, with the name of their command line option
+commandFields = {
+    'get': [],
+    'new': ['roles', 'rootarn'],
+    'rotate': ['lambda_arn', 'schedule', 'duration'],
+    'delete': [],
+}
+
+
+def read_manifest(stream, fmt=None):
+    """Reads the rows of a manifest, as a list of dictionaries
+
+    Args:
+        stream: A text file-like object
+        fmt (string): 'json' or 'csv', or None to tell from the content: a CSV file has a name column in its
+            header row. Plain lines of names are also accepted.
+    """
+    text = stream.read()
+    stripped = text.lstrip()
+    header = next(csv.reader([stripped.split('\n', 1)[0]]), [])
+    if fmt == 'json' or (fmt is None and stripped[:1] in ('[', '{')):
+        if stripped.startswith('['):
+            rows = json.loads(text)
+        else:
+            rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+    elif fmt == 'csv' or (fmt is None and 'name' in (column.strip() for column in header)):
+        rows = [{key: value for key, value in row.items() if value not in (None, '')}
+                for row in csv.DictReader(io.StringIO(text))]
+        for row in rows:
+            if 'roles' in row:
+                row['roles'] = row['roles'].split()
+    else:
+        rows = [{'name': line.strip()} for line in text.splitlines() if line.strip()]
+    for row in rows:
+        if not isinstance(row, dict) or not row.get('name'):
+            raise ValueError(f"Every row of the manifest needs a name: {row}")
+    return rows
+
+
+class Operations:
+    """The operations of each command, sharing one Secrets Manager client and one rate limiter
+
+    Args:
+        service_client (client): The secrets manager service client
+        rate (float): The maximum number of operations started per second, or None for no limit
+    """
+
+    def __init__(self, service_client, rate=None):
+        # Imported here, so that parsing the command line does not pay for them
+        import lambda_function
+        from bulk_revocation import RateLimiter
+
+        self.lambda_function = lambda_function
+        self.service_client = service_client
+        self.limiter = RateLimiter(rate)
+
+    def _root_key(self, root_arn):
+        return self.lambda_function.root_secret_cache.get(self.service_client, root_arn)['astraKey']
+
+    def get(self, row):
+        response = self.service_client.get_secret_value(SecretId=row['name'])
+        return {'secret': json.loads(response['SecretString']), 'version': response['VersionId']}
+
+    def new(self, row):
+        from secretsmanager_lib import SecretsManagerSecret
+
+        if not row.get('roles') or not row.get('rootarn'):
+            raise ValueError("roles and rootarn are required to create a secret")
+        roles = [row['roles']] if isinstance(row['roles'], str) else list(row['roles'])
+        clientID, clientSecret, token = self.lambda_function.create_astra_token(self._root_key(row['rootarn']),
+                                                                                roles)
+        template = {'astraKey': token,
+                    'clientID': clientID,
+                    'clientSecret': clientSecret,
+                    'engine': 'Astra',
+                    'rootarn': row['rootarn']}
+        try:
+            response = SecretsManagerSecret(self.service_client).create(row['name'], json.dumps(template))
+        except Exception:
+            # Do not leave a token which no secret references
+            self.lambda_function.delete_astra_token(self._root_key(row['rootarn']), clientID)
+            raise
+        return {'clientID': clientID, 'arn': response['ARN']}
+
+    def rotate(self, row):
+        kwargs = {'SecretId': row['name']}
+        if row.get('lambda_arn'):
+            kwargs['RotationLambdaARN'] = row['lambda_arn']
+        if row.get('schedule'):
+            kwargs['RotationRules'] = {'ScheduleExpression': row['schedule']}
+            if row.get('duration'):
+                kwargs['RotationRules']['Duration'] = row['duration']
+        response = self.service_client.rotate_secret(**kwargs)
+        return {'version': response['VersionId']}
+
+    def delete(self, row):
+        secret_dict = self.lambda_function.get_secret_dict(self.service_client, row['name'], "AWSCURRENT")
+        status = self.lambda_function.delete_astra_token(self._root_key(secret_dict['rootarn']),
+                                                         secret_dict['clientID'])
+        if status not in [200, 204, 404]:
+            raise Exception(f"Unable to revoke token {secret_dict['clientID']}. Received status {status}")
+        self.service_client.delete_secret(SecretId=row['name'], ForceDeleteWithoutRecovery=True)
+        return {'clientID': secret_dict['clientID']}
+
+    def run(self, command, row):
+        """Runs one operation, returning its result instead of raising"""
+        started = time.monotonic()
+        result = {'name': row['name'], 'command': command}
+        try:
+            self.limiter.acquire()
+            result.update(getattr(self, command)(row))
+            result['status'] = 'ok'
+        except Exception as e:
+            logger.exception("%s failed for %s", command, row['name'])
+            result.update(status='failed', error=str(e))
+        result['seconds'] = round(time.monotonic() - started, 3)
+        return result
+
+
+def get_service_client():
+    """Returns a Secrets Manager client, reading from the closest region when SECRETS_MANAGER_ENDPOINTS is set"""
+    if os.environ.get('SECRETS_MANAGER_ENDPOINTS'):
+        from regional_endpoints import RegionalSecretsClient
+        return RegionalSecretsClient.from_environment()
+    import lambda_function
+    return lambda_function.get_service_client()
+
+
+def run(command, rows, service_client=None, rate=10, max_workers=8, on_result=None):
+    """Runs a command for every row concurrently, under a rate limit
+
+    Args:
+        command (string): get, new, rotate or delete
+        rows (list): The rows of the manifest
+        service_client (client): The secrets manager service client, by default from get_service_client
+        rate (float): The maximum number of operations started per second, or None for no limit
+        max_workers (int): The number of operations running at the same time
+        on_result (callable): Optional function called with every result as soon as it is available
+
+    Returns:
+        a tuple of the list of results, and a summary dictionary with the number of rows which succeeded and
+        failed, the elapsed seconds and the throughput in rows per second
+    """
+    started = time.monotonic()
+    operations = Operations(service_client or get_service_client(), rate)
+    results = []
+    lock = threading.Lock()
+
+    def run_one(row):
+        result = operations.run(command, row)
+        with lock:
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(run_one, rows))
+
+    elapsed = time.monotonic() - started
+    summary = {
+        'rows': len(results),
+        'ok': sum(1 for result in results if result['status'] == 'ok'),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'seconds': round(elapsed, 3),
+        'rowsPerSecond': round(len(results) / elapsed, 3) if elapsed else None,
+    }
+    return results, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Get, create, rotate or delete many Astra secrets")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subcommands = {
+        'get': subparsers.add_parser('get', help='print the value of secrets'),
+        'new': subparsers.add_parser('new', help='create Astra tokens and the secrets holding them'),
+        'rotate': subparsers.add_parser('rotate', help='rotate secrets, or configure their rotation'),
+        'delete': subparsers.add_parser('delete', help='revoke the Astra tokens of secrets and delete them'),
+    }
+    for subparser in subcommands.values():
+        subparser.add_argument('names', nargs='*', help='names or ARNs of the secrets, or - to read a manifest '
+                                                        'from stdin')
+        subparser.add_argument('--manifest', help='JSON or CSV file of the secrets, - for stdin')
+        subparser.add_argument('--format', choices=['json', 'csv'], help='format of the manifest, by default '
+                                                                         'told from its content')
+        subparser.add_argument('--workers', type=int, default=8, help='number of operations run at the same time')
+        subparser.add_argument('--rate', type=float, default=10, help='maximum number of operations per second')
+    subcommands['new'].add_argument('--roles', nargs='+', help='Astra role IDs of the new tokens')
+    subcommands['new'].add_argument('--root-arn', dest='rootarn', help='ARN of the root secret')
+    subcommands['rotate'].add_argument('--lambda-arn', help='ARN of the rotation function to configure')
+    subcommands['rotate'].add_argument('--schedule', help='ScheduleExpression, e.g. "cron(0 16 1,15 * ? *)"')
+    subcommands['rotate'].add_argument('--duration', help='rotation window, e.g. 2h')
+    args = parser.parse_args(argv)
+
+    names = [name for name in args.names if name != '-']
+    manifest = args.manifest or ('-' if '-' in args.names else None)
+    rows = []
+    try:
+        if manifest == '-':
+            rows = read_manifest(sys.stdin, args.format)
+        elif manifest:
+            with open(manifest) as f:
+                rows = read_manifest(f, args.format)
+    except ValueError as e:
+        parser.error(f"invalid manifest: {e}")
+    rows += [{'name': name} for name in names]
+    if not rows:
+        parser.error("no secrets given, either as names or with a manifest")
+    defaults = {field: getattr(args, field) for field in commandFields[args.command]
+                if getattr(args, field) is not None}
+    rows = [dict(defaults, **row) for row in rows]
+
+    logging.basicConfig(level=logging.WARNING)
+
+    def on_result(result):
+        print(json.dumps(result, default=str), flush=True)
+
+    results, summary = run(args.command, rows, rate=args.rate, max_workers=args.workers, on_result=on_result)
+    print(json.dumps({'summary': summary}), flush=True)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Purpose
+
+A rotation-aware provider of Astra credentials for services which consume an Astra secret.
+
+The provider keeps the secret in memory and refreshes it from a background thread, so that get() never makes a
+network call. It follows the rotation of the secret by its staging labels:
+
+  * Most of the time it only checks the secret with DescribeSecret every poll_interval seconds, and fetches
+    the value again when the AWSCURRENT version changes.
+  * Within rotation_window seconds of the next scheduled rotation, and while a rotation is in progress, it
+    checks every rotation_poll_interval seconds instead.
+  * As soon as createSecret has stored the new token in the AWSPENDING version, the provider fetches it, checks
+    that it authenticates with Astra, and starts serving it. The finishSecret step deletes the old token
+    before it moves AWSCURRENT, so the switch has happened by the time the old token is revoked.
+
+AstraSession makes Astra API requests with the token of a secret. When a request fails with 401 because the
+token was rotated away, it refreshes the secret once (shared by all the requests which failed with that token)
+and replays the request with the new token.
+
+Example:
+
+    provider = AstraTokenProvider(boto3.client('secretsmanager'), '/astra/prod/app1')
+    provider.start()
+    ...
+    headers = {'Authorization': f'Bearer {provider.token}'}
+
+    session = AstraSession(boto3.client('secretsmanager'), '/astra/prod/app1', provider)
+    status, reason, headers, data = session.make_API_request("GET", "/v2/databases")
+"""
+
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+import lambda_function
+
+logger = logging.getLogger(__name__)
+
+
+class AstraTokenProvider:
+    """Serves the Astra credentials of a secret from memory, refreshed ahead of rotations
+
+    Args:
+        service_client: A Boto3 Secrets Manager client.
+        secret_id: The name or ARN of the Astra secret.
+        poll_interval: Seconds between checks of the secret outside of rotations.
+        rotation_poll_interval: Seconds between checks around and during rotations.
+        rotation_window: Seconds before the next scheduled rotation from which checks are made every
+                         rotation_poll_interval seconds.
+        probe: When True, a pending token is only served once it authenticates with Astra.
+        on_change: Optional function called with the new secret dictionary whenever the served token changes.
+    """
+
+    def __init__(self, service_client, secret_id, poll_interval=300, rotation_poll_interval=10,
+                 rotation_window=900, probe=True, on_change=None):
+        self.service_client = service_client
+        self.secret_id = secret_id
+        self.poll_interval = poll_interval
+        self.rotation_poll_interval = rotation_poll_interval
+        self.rotation_window = rotation_window
+        self.probe = probe
+        self.on_change = on_change
+        self.served_version = None
+        self.next_rotation = None
+        self.rotating = False
+        self._versions = {}
+        self._probed = set()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Loads the secret, then keeps it fresh from a background thread"""
+        self.refresh()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=f"astra-token-{self.secret_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get(self):
+        """Returns a copy of the secret dictionary currently served, without any network call"""
+        with self._lock:
+            if self.served_version is None:
+                raise ValueError(f"The secret {self.secret_id} has not been loaded, call start() first")
+            return dict(self._versions[self.served_version])
+
+    @property
+    def token(self):
+        """The Astra token currently served"""
+        return self.get()['astraKey']
+
+    def _fetch(self, version, stage):
+        secret = self.service_client.get_secret_value(SecretId=self.secret_id, VersionId=version,
+                                                      VersionStage=stage)
+        return lambda_function.parse_secret_dict(secret['SecretString'])
+
+    def _authenticates(self, secret_dict):
+        status, reason, headers, data = lambda_function.make_API_request(
+            secret_dict['astraKey'], "GET", "/v2/currentOrg")
+        return status == 200
+
+    def refresh(self):
+        """Checks the secret once, fetching new versions and switching the served token when needed"""
+        with self._refresh_lock:
+            metadata = self.service_client.describe_secret(SecretId=self.secret_id)
+            current = pending = None
+            for version, stages in metadata['VersionIdsToStages'].items():
+                if 'AWSCURRENT' in stages:
+                    current = version
+                elif 'AWSPENDING' in stages:
+                    pending = version
+
+            versions = {}
+            with self._lock:
+                known = dict(self._versions)
+            if current is not None:
+                versions[current] = known.get(current) or self._fetch(current, "AWSCURRENT")
+            if pending is not None:
+                if pending in known:
+                    versions[pending] = known[pending]
+                else:
+                    try:
+                        versions[pending] = self._fetch(pending, "AWSPENDING")
+                    except self.service_client.exceptions.ResourceNotFoundException:
+                        # createSecret has not stored the new token yet
+                        pass
+
+            served = current
+            if pending in versions:
+                if not self.probe or pending in self._probed or self._probe(pending, versions[pending]):
+                    served = pending
+
+            with self._lock:
+                changed = served != self.served_version
+                self._versions = versions
+                self.served_version = served
+            self._probed &= set(versions)
+            self.rotating = pending is not None
+            self.next_rotation = self._next_rotation(metadata)
+            if changed:
+                logger.info("Serving version %s of secret %s.", served, self.secret_id)
+                if self.on_change is not None:
+                    self.on_change(dict(versions[served]))
+
+    def _probe(self, version, secret_dict):
+        try:
+            ok = self._authenticates(secret_dict)
+        except Exception:
+            logger.exception("Couldn't check the pending token of secret %s.", self.secret_id)
+            ok = False
+        if ok:
+            self._probed.add(version)
+        return ok
+
+    def _next_rotation(self, metadata):
+        """Returns the time of the next scheduled rotation, as a timestamp, if any"""
+        if not metadata.get('RotationEnabled'):
+            return None
+        if metadata.get('NextRotationDate'):
+            return metadata['NextRotationDate'].timestamp()
+        days = metadata.get('RotationRules', {}).get('AutomaticallyAfterDays')
+        if days and metadata.get('LastRotatedDate'):
+            return (metadata['LastRotatedDate'] + datetime.timedelta(days=days)).timestamp()
+        return None
+
+    def next_delay(self):
+        """Returns the number of seconds until the next check"""
+        if self.rotating:
+            return self.rotation_poll_interval
+        if self.next_rotation is not None:
+            until = self.next_rotation - time.time()
+            if until <= self.rotation_window:
+                return self.rotation_poll_interval
+            return min(self.poll_interval, until - self.rotation_window)
+        return self.poll_interval
+
+    def _run(self):
+        while not self._stopped.wait(self.next_delay()):
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the last known token, and try again at the next check
+                logger.exception("Couldn't refresh secret %s.", self.secret_id)
+
+
+class AstraSession:
+    """Astra API session which recovers from a rotated token with a single refresh
+
+    Requests are made with make_API_request using the token of the secret. When Astra answers 401, because
+    the token was rotated away, the secret is refreshed and the request replayed once with the new token. The
+    refresh is coalesced: concurrent requests which failed with the same token wait for one shared refresh,
+    instead of each fetching the secret. A refresh which finds no other token than the rejected one is
+    remembered for negative_ttl seconds, during which further 401 with that token return at once, instead of
+    each fetching the secret again (e.g. when the token was revoked and the secret not rotated yet).
+
+    Args:
+        service_client: A Boto3 Secrets Manager client.
+        secret_id: The name or ARN of the Astra secret.
+        provider: Optional AstraTokenProvider of the same secret to take the token from. Without one, the
+                  session fetches the secret itself, on first use and on 401.
+        negative_ttl: Seconds during which a token that no refresh could replace is not refreshed again.
+    """
+
+    def __init__(self, service_client, secret_id, provider=None, negative_ttl=10):
+        self.service_client = service_client
+        self.secret_id = secret_id
+        self.provider = provider
+        self.negative_ttl = negative_ttl
+        self.refreshes = 0
+        self._secret_dict = None
+        self._unreplaced = None
+        self._lock = threading.Lock()
+
+    def _current_token(self):
+        if self.provider is not None:
+            return self.provider.token
+        with self._lock:
+            if self._secret_dict is None:
+                self._secret_dict = lambda_function.get_secret_dict(self.service_client, self.secret_id,
+                                                                    "AWSCURRENT")
+            return self._secret_dict['astraKey']
+
+    @staticmethod
+    def _digest(token):
+        # Only a digest of the rejected token is kept, with the time of the refresh which could not replace it
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def _refresh(self, rejected_token):
+        """Replaces a rejected token, unless another request already did or a recent refresh could not"""
+        with self._lock:
+            if self._unreplaced is not None:
+                digest, refreshed_at = self._unreplaced
+                if time.monotonic() - refreshed_at < self.negative_ttl and digest == self._digest(rejected_token):
+                    return rejected_token
+            token = self._replace(rejected_token)
+            if token == rejected_token:
+                self._unreplaced = (self._digest(rejected_token), time.monotonic())
+            return token
+
+    def _replace(self, rejected_token):
+        if self.provider is not None:
+            if self.provider.token == rejected_token:
+                self.provider.refresh()
+                self.refreshes += 1
+            return self.provider.token
+        if self._secret_dict is not None and self._secret_dict['astraKey'] != rejected_token:
+            return self._secret_dict['astraKey']
+        self.refreshes += 1
+        secret_dict = lambda_function.get_secret_dict(self.service_client, self.secret_id, "AWSCURRENT")
+        if secret_dict['astraKey'] == rejected_token:
+            # Between finishSecret deleting the old token and moving AWSCURRENT, only AWSPENDING works
+            try:
+                secret_dict = lambda_function.get_secret_dict(self.service_client, self.secret_id, "AWSPENDING")
+            except self.service_client.exceptions.ResourceNotFoundException:
+                pass
+        self._secret_dict = secret_dict
+        return secret_dict['astraKey']
+
+    def make_API_request(self, method, path, body=None):
+        """Same as lambda_function.make_API_request, with the token of the secret and recovery from 401
+
+        Returns:
+            a tuple of the status, reason, headers and data of the response
+        """
+        token = self._current_token()
+        response = lambda_function.make_API_request(token, method, path, body)
+        if response[0] != 401:
+            return response
+        new_token = self._refresh(token)
+        if new_token == token:
+            return response
+        logger.info("Replaying %s %s with the refreshed token of secret %s.", method, path, self.secret_id)
+        return lambda_function.make_API_request(new_token, method, path, body)
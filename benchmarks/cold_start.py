@@ -0,0 +1,88 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Measures the cold start cost of the rotation function so that it can be tracked from one release to the next.
+
+Each run starts a fresh Python interpreter (the equivalent of a new Lambda container) and records:
+
+    import_ms         time to import lambda_function
+    first_client_ms   time to build the Secrets Manager client on the first invocation
+    warm_client_ms    time to get the client again, as a warm invocation does
+    ssl_context_ms    time to build the shared SSL context for Astra connections
+
+The median and worst value of every measurement are printed as a single JSON line, which can be appended to
+a results file with --output to compare releases.
+"""
+# Syntax:
+# python benchmarks/cold_start.py [--runs N] [--output FILE]
+
+# Example
+# python benchmarks/cold_start.py --runs 20 --output bench_output.txt
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, time
+t0 = time.perf_counter()
+import lambda_function
+t1 = time.perf_counter()
+lambda_function.get_service_client()
+t2 = time.perf_counter()
+lambda_function.get_service_client()
+t3 = time.perf_counter()
+lambda_function.get_ssl_context()
+t4 = time.perf_counter()
+print(json.dumps({
+    'import_ms': (t1 - t0) * 1000,
+    'first_client_ms': (t2 - t1) * 1000,
+    'warm_client_ms': (t3 - t2) * 1000,
+    'ssl_context_ms': (t4 - t3) * 1000,
+}))
+"""
+
+
+def run_once():
+    env = dict(os.environ)
+    # The client is never used to make a call, it only needs an endpoint and a region to be built
+    env.setdefault('SECRETS_MANAGER_ENDPOINT', 'https://secretsmanager.us-east-1.amazonaws.com/')
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=REPO_DIR, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    summary = {}
+    for key in samples[0]:
+        values = [sample[key] for sample in samples]
+        summary[key] = {'median': round(statistics.median(values), 3), 'max': round(max(values), 3)}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='number of fresh interpreters to start')
+    parser.add_argument('--output', help='file to append the JSON result line to')
+    args = parser.parse_args()
+
+    samples = [run_once() for _ in range(args.runs)]
+    result = {'benchmark': 'cold_start', 'timestamp': int(time.time()), 'runs': args.runs,
+              'python': sys.version.split()[0], 'results': summarize(samples)}
+    line = json.dumps(result, sort_keys=True)
+    print(line)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
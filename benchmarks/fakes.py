@@ -0,0 +1,433 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Local stand-ins for the Astra DevOps API and AWS Secrets Manager, used by the benchmarks.
+
+FakeAstraServer is an HTTPS server implementing the token endpoints used by lambda_function.py. It uses a
+self-signed certificate generated with the openssl command line tool; its ssl_context() trusts that
+certificate. The organization is pre-populated with org_size clients, and new tokens only authenticate after
+propagation_delay seconds, like real tokens which take a moment to propagate.
+
+FakeSecretsManagerServer is an HTTP server speaking the Secrets Manager JSON protocol, so that a regular boto3
+client pointed at its url (e.g. through SECRETS_MANAGER_ENDPOINT) can be used against it.
+
+Both servers sleep latency seconds before answering each request, count the requests they serve by operation in
+`calls`, and can be told to fail the next requests of an operation with fail_next().
+"""
+
+import http.server
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+
+class _FakeServer:
+    """Common request counting, latency and failure injection of the fakes"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.thread = None
+
+    def count(self, operation):
+        """Counts a request, and returns the status it must fail with, if any"""
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            pending = self.failures.get(operation)
+            if pending:
+                return pending.pop(0)
+        return None
+
+    def fail_next(self, operation, status, count=1):
+        """Makes the next count requests of an operation fail with the given status"""
+        with self.lock:
+            self.failures.setdefault(operation, []).extend([status] * count)
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = {}
+
+    def start(self, handler):
+        self.httpd = http.server.ThreadingHTTPServer(("localhost", 0), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer each response into a single write, so that Nagle's algorithm does not delay the body
+    wbufsize = -1
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status, payload=None, headers=None):
+        content = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if content:
+            self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        try:
+            self.wfile.write(content)
+        except (ConnectionError, ssl.SSLError):
+            # The client stopped reading a streamed response, e.g. once it found the client it looked for
+            self.close_connection = True
+
+
+class _AstraHandler(_Handler):
+
+    def _authorized(self):
+        token = self.headers.get("Authorization", "").replace("Bearer ", "", 1)
+        return self.fake.authenticate(token)
+
+    def _handle(self, method):
+        body = self.read_body()
+        operation = f"{method} {self.path.rsplit('/', 1)[0] if self.path.count('/') > 2 else self.path}"
+        failure = self.fake.count(operation)
+        time.sleep(self.fake.latency)
+        if failure:
+            return self.send_json(failure, {"errors": [{"message": "injected failure"}]}, {"Retry-After": "0"})
+        if not self._authorized():
+            return self.send_json(401, {"errors": [{"message": "unauthorized"}]})
+        if method == "GET" and self.path == "/v2/currentOrg":
+            return self.send_json(200, {"id": self.fake.org_id, "name": "benchmark"})
+        if method == "GET" and self.path == "/v2/clientIdSecrets":
+            return self.send_json(200, {"clients": self.fake.list_clients()})
+        if method == "POST" and self.path == "/v2/clientIdSecrets":
+            return self.send_json(200, self.fake.create_client(json.loads(body)["roles"]))
+        if method == "DELETE" and self.path.startswith("/v2/clientIdSecrets/"):
+            if self.fake.delete_client(self.path.rsplit("/", 1)[1]):
+                return self.send_json(204)
+            return self.send_json(404, {"errors": [{"message": "not found"}]})
+        self.send_json(404, {"errors": [{"message": "no such endpoint"}]})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class FakeAstraServer(_FakeServer):
+    """HTTPS stand-in for the Astra DevOps API token endpoints
+
+    Args:
+        org_size: number of clients the organization starts with, besides the root client
+        latency: seconds to wait before answering each request
+        propagation_delay: seconds before a new token authenticates
+    """
+
+    def __init__(self, org_size=100, latency=0, propagation_delay=0):
+        super().__init__(latency)
+        self.propagation_delay = propagation_delay
+        self.org_id = str(uuid.uuid4())
+        self.clients = {}
+        self.tokens = {}
+        self.root = self.create_client(["org-admin"], propagated=True)
+        for _ in range(org_size):
+            self.create_client(["read-only-user"], propagated=True)
+        self._certificate_dir = None
+
+    def create_client(self, roles, propagated=False):
+        client_id = str(uuid.uuid4())
+        token = "AstraCS:" + uuid.uuid4().hex
+        valid_from = time.monotonic() + (0 if propagated else self.propagation_delay)
+        with self.lock:
+            self.clients[client_id] = {"clientId": client_id, "roles": list(roles),
+                                       "generatedOn": time.strftime("%Y-%m-%dT%H:%M:%SZ")}
+            self.tokens[token] = (client_id, valid_from)
+        return {"clientId": client_id, "secret": uuid.uuid4().hex, "orgId": self.org_id,
+                "roles": list(roles), "token": token}
+
+    def delete_client(self, client_id):
+        with self.lock:
+            if self.clients.pop(client_id, None) is None:
+                return False
+            for token in [t for t, (c, _) in self.tokens.items() if c == client_id]:
+                del self.tokens[token]
+            return True
+
+    def list_clients(self):
+        with self.lock:
+            return list(self.clients.values())
+
+    def authenticate(self, token):
+        with self.lock:
+            entry = self.tokens.get(token)
+        return entry is not None and entry[1] <= time.monotonic()
+
+    @property
+    def host(self):
+        return f"localhost:{self.port}"
+
+    def ssl_context(self):
+        """Returns a client SSL context which trusts the certificate of the server"""
+        return ssl.create_default_context(cafile=os.path.join(self._certificate_dir, "cert.pem"))
+
+    def start(self):
+        self._certificate_dir = tempfile.mkdtemp(prefix="fake-astra-")
+        cert = os.path.join(self._certificate_dir, "cert.pem")
+        key = os.path.join(self._certificate_dir, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                        "-keyout", key, "-out", cert], check=True, capture_output=True)
+        super().start(_AstraHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+
+    def stop(self):
+        super().stop()
+        if self._certificate_dir is not None:
+            shutil.rmtree(self._certificate_dir, ignore_errors=True)
+            self._certificate_dir = None
+
+
+class _SecretsManagerError(Exception):
+    def __init__(self, error_type, message):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+class _SecretsManagerHandler(_Handler):
+
+    def do_POST(self):
+        body = self.read_body()
+        operation = self.headers.get("X-Amz-Target", "").split(".")[-1]
+        failure = self.fake.count(operation)
+        time.sleep(self.fake.latency)
+        if failure:
+            return self.send_json(failure, {"__type": "InternalServiceError", "message": "injected failure"})
+        try:
+            handler = getattr(self.fake, "op_" + operation)
+        except AttributeError:
+            return self.send_json(400, {"__type": "InvalidRequestException",
+                                        "message": f"{operation} is not supported by the fake"})
+        try:
+            self.send_json(200, handler(json.loads(body or b"{}")))
+        except _SecretsManagerError as e:
+            self.send_json(400, {"__type": e.error_type, "message": str(e)})
+
+
+class FakeSecretsManagerServer(_FakeServer):
+    """HTTP stand-in for the Secrets Manager API, for boto3 clients using its url as endpoint_url
+
+    Supports CreateSecret, DescribeSecret, GetSecretValue, BatchGetSecretValue, PutSecretValue,
+    UpdateSecretVersionStage, ListSecrets, DeleteSecret and RotateSecret (which only stages a new AWSPENDING version, see begin_rotation).
+    """
+
+    def __init__(self, latency=0, region="us-east-1"):
+        super().__init__(latency)
+        self.region = region
+        self.secrets = {}
+
+    @property
+    def url(self):
+        return f"http://localhost:{self.port}/"
+
+    def start(self):
+        super().start(_SecretsManagerHandler)
+
+    def add_secret(self, name, secret_dict):
+        """Creates a secret directly in the store, and returns its ARN"""
+        return self.op_CreateSecret({"Name": name, "SecretString": json.dumps(secret_dict)})["ARN"]
+
+    def begin_rotation(self, secret_id):
+        """Stages AWSPENDING on a new version without a value, as Secrets Manager does before createSecret"""
+        token = str(uuid.uuid4())
+        with self.lock:
+            secret = self._find(secret_id)
+            secret["RotationEnabled"] = True
+            self._move_stage(secret, "AWSPENDING", token)
+        return token
+
+    def _find(self, secret_id):
+        for secret in self.secrets.values():
+            if secret_id in (secret["ARN"], secret["Name"]) and not secret.get("Deleted"):
+                return secret
+        raise _SecretsManagerError("ResourceNotFoundException",
+                                   "Secrets Manager can't find the specified secret.")
+
+    @staticmethod
+    def _move_stage(secret, stage, version_id):
+        for stages in secret["Stages"].values():
+            if stage in stages:
+                stages.remove(stage)
+        secret["Stages"].setdefault(version_id, []).append(stage)
+
+    def op_CreateSecret(self, request):
+        with self.lock:
+            name = request["Name"]
+            if any(s["Name"] == name and not s.get("Deleted") for s in self.secrets.values()):
+                raise _SecretsManagerError("ResourceExistsException", f"The secret {name} already exists.")
+            arn = f"arn:aws:secretsmanager:{self.region}:123456789012:secret:{name}-{uuid.uuid4().hex[:6]}"
+            version_id = request.get("ClientRequestToken") or str(uuid.uuid4())
+            self.secrets[arn] = {"ARN": arn, "Name": name, "CreatedDate": time.time(), "Tags": request.get("Tags", []),
+                                 "Values": {version_id: request["SecretString"]},
+                                 "Stages": {version_id: ["AWSCURRENT"]}, "RotationEnabled": False}
+            return {"ARN": arn, "Name": name, "VersionId": version_id}
+
+    def op_DescribeSecret(self, request):
+        with self.lock:
+            secret = self._find(request["SecretId"])
+            return {"ARN": secret["ARN"], "Name": secret["Name"], "CreatedDate": secret["CreatedDate"],
+                    "RotationEnabled": secret["RotationEnabled"], "Tags": secret["Tags"],
+                    "RotationRules": secret.get("RotationRules", {}),
+                    "VersionIdsToStages": {v: list(s) for v, s in secret["Stages"].items() if s}}
+
+    def op_GetSecretValue(self, request):
+        with self.lock:
+            secret = self._find(request["SecretId"])
+            version_id = request.get("VersionId")
+            stage = request.get("VersionStage")
+            if version_id is None:
+                stage = stage or "AWSCURRENT"
+                version_id = next((v for v, s in secret["Stages"].items() if stage in s), None)
+            if version_id not in secret["Values"] or (stage and stage not in secret["Stages"].get(version_id, [])):
+                raise _SecretsManagerError("ResourceNotFoundException",
+                                           "Secrets Manager can't find the specified secret value.")
+            return {"ARN": secret["ARN"], "Name": secret["Name"], "VersionId": version_id,
+                    "SecretString": secret["Values"][version_id],
+                    "VersionStages": list(secret["Stages"][version_id]), "CreatedDate": time.time()}
+
+    def op_PutSecretValue(self, request):
+        with self.lock:
+            secret = self._find(request["SecretId"])
+            version_id = request.get("ClientRequestToken") or str(uuid.uuid4())
+            secret["Values"][version_id] = request["SecretString"]
+            for stage in request.get("VersionStages", ["AWSCURRENT"]):
+                self._move_stage(secret, stage, version_id)
+            return {"ARN": secret["ARN"], "Name": secret["Name"], "VersionId": version_id,
+                    "VersionStages": list(secret["Stages"][version_id])}
+
+    def op_UpdateSecretVersionStage(self, request):
+        with self.lock:
+            secret = self._find(request["SecretId"])
+            stage = request["VersionStage"]
+            attached = next((v for v, s in secret["Stages"].items() if stage in s), None)
+            if attached not in (None, request.get("MoveToVersionId"), request.get("RemoveFromVersionId")):
+                raise _SecretsManagerError("InvalidParameterException",
+                                           f"The staging label {stage} is attached to version {attached}.")
+            if request.get("RemoveFromVersionId"):
+                stages = secret["Stages"].get(request["RemoveFromVersionId"], [])
+                if stage in stages:
+                    stages.remove(stage)
+            if request.get("MoveToVersionId"):
+                self._move_stage(secret, stage, request["MoveToVersionId"])
+                if stage == "AWSCURRENT":
+                    # Like Secrets Manager, the previous current version becomes AWSPREVIOUS
+                    if request.get("RemoveFromVersionId"):
+                        self._move_stage(secret, "AWSPREVIOUS", request["RemoveFromVersionId"])
+                    pending = secret["Stages"][request["MoveToVersionId"]]
+                    if "AWSPENDING" in pending:
+                        pending.remove("AWSPENDING")
+            return {"ARN": secret["ARN"], "Name": secret["Name"]}
+
+    def op_ListSecrets(self, request):
+        with self.lock:
+            secrets = [s for s in self.secrets.values() if not s.get("Deleted")]
+            for flt in request.get("Filters", []):
+                if flt["Key"] == "name":
+                    secrets = [s for s in secrets if any(s["Name"].startswith(v) for v in flt["Values"])]
+            secrets.sort(key=lambda s: s["Name"])
+            start = int(request.get("NextToken") or 0)
+            size = request.get("MaxResults", 100)
+            page = secrets[start:start + size]
+            response = {"SecretList": [{"ARN": s["ARN"], "Name": s["Name"], "Tags": s["Tags"],
+                                        "RotationEnabled": s["RotationEnabled"],
+                                        "RotationRules": s.get("RotationRules", {}),
+                                        "RotationLambdaARN": s.get("RotationLambdaARN"),
+                                        "SecretVersionsToStages": {v: list(st) for v, st in s["Stages"].items() if st}}
+                                       for s in page]}
+            if start + size < len(secrets):
+                response["NextToken"] = str(start + size)
+            return response
+
+    def op_BatchGetSecretValue(self, request):
+        if "SecretIdList" in request:
+            secret_ids = request["SecretIdList"]
+            next_token = None
+        else:
+            listing = self.op_ListSecrets({"Filters": request.get("Filters", []),
+                                           "MaxResults": request.get("MaxResults", 20),
+                                           "NextToken": request.get("NextToken")})
+            secret_ids = [secret["ARN"] for secret in listing["SecretList"]]
+            next_token = listing.get("NextToken")
+        response = {"SecretValues": [], "Errors": []}
+        for secret_id in secret_ids:
+            try:
+                response["SecretValues"].append(self.op_GetSecretValue({"SecretId": secret_id}))
+            except _SecretsManagerError as e:
+                response["Errors"].append({"SecretId": secret_id, "ErrorCode": e.error_type, "Message": str(e)})
+        if next_token:
+            response["NextToken"] = next_token
+        return response
+
+    def op_TagResource(self, request):
+        with self.lock:
+            secret = self._find(request["SecretId"])
+            keys = {tag["Key"] for tag in request["Tags"]}
+            secret["Tags"] = [tag for tag in secret["Tags"] if tag["Key"] not in keys] + request["Tags"]
+            return {}
+
+    def op_DeleteSecret(self, request):
+        with self.lock:
+            secret = self._find(request["SecretId"])
+            secret["Deleted"] = True
+            return {"ARN": secret["ARN"], "Name": secret["Name"], "DeletionDate": time.time()}
+
+    def op_RotateSecret(self, request):
+        with self.lock:
+            secret = self._find(request["SecretId"])
+            secret["RotationEnabled"] = True
+            if "RotationRules" in request:
+                secret["RotationRules"] = request["RotationRules"]
+            if "RotationLambdaARN" in request:
+                secret["RotationLambdaARN"] = request["RotationLambdaARN"]
+            token = request.get("ClientRequestToken") or str(uuid.uuid4())
+            if request.get("RotateImmediately", True):
+                self._move_stage(secret, "AWSPENDING", token)
+            return {"ARN": secret["ARN"], "Name": secret["Name"], "VersionId": token}
@@ -0,0 +1,132 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Offline benchmark of the ranking and failover of RegionalSecretsClient (regional_endpoints.py) against local fakes.
+
+One fake Secrets Manager endpoint (benchmarks/fakes.py) is started per --regions item, each answering after its
+own latency. The fakes do not replicate secrets between each other, so the benchmark writes the same secret to
+every one of them, as replication would. The client ranks the endpoints, then reads the secret with
+get_secret_dict --reads times in each of these phases:
+
+    steady    every endpoint answers, reads go to the lowest latency one
+    slowdown  the endpoint ranked first becomes slower than every other one, and the moving average of its
+              latency moves it down the ranking
+    errors    the endpoint ranked first answers every read with a 500, reads fail over to the next one
+    timeout   the endpoint ranked first stops answering within the read timeout of the client
+
+For every phase, the result has the read latency (p50/p95/max, in ms), the number of reads which failed, the
+requests received by each region and the ranking at the end of the phase. It is printed as a single JSON line,
+which can be appended to a results file with --output.
+"""
+# Syntax:
+# python benchmarks/regional.py [--regions REGION=MS,...] [--reads N] [--read-timeout S] [--output FILE]
+
+# Example
+# python benchmarks/regional.py --regions us-east-1=80,eu-west-1=5,ap-southeast-2=30 --reads 50
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from botocore.config import Config  # noqa: E402
+
+import lambda_function  # noqa: E402
+from fakes import FakeSecretsManagerServer  # noqa: E402
+from regional_endpoints import RegionalSecretsClient  # noqa: E402
+from rotation import distribution  # noqa: E402
+
+SECRET_NAME = "/benchmark/regional"
+
+SECRET = {'astraKey': 'AstraCS:benchmark', 'clientID': 'benchmark', 'clientSecret': 'benchmark',
+          'engine': 'Astra', 'rootarn': 'arn:aws:secretsmanager:us-east-1:123456789012:secret:/benchmark/root'}
+
+
+def parse_regions(value):
+    """Parses a comma-separated list of region=milliseconds items into (region, seconds) tuples"""
+    regions = []
+    for item in value.split(','):
+        region, _, latency = item.partition('=')
+        regions.append((region.strip(), float(latency or 0) / 1000))
+    return regions
+
+
+def bench_phase(client, servers, reads):
+    for server in servers.values():
+        server.reset_calls()
+    latencies = []
+    errors = 0
+    for _ in range(reads):
+        started = time.perf_counter()
+        try:
+            lambda_function.get_secret_dict(client, SECRET_NAME, "AWSCURRENT")
+        except Exception:
+            errors += 1
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {'latency_ms': distribution(latencies), 'errors': errors,
+            'requests': {region: server.calls.get('GetSecretValue', 0) for region, server in servers.items()},
+            'ranking': [repr(endpoint) for endpoint in client.ranking()]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--regions', default='us-east-1=80,eu-west-1=5,ap-southeast-2=30',
+                        help='comma-separated region=latency items, latency in milliseconds, the first is primary')
+    parser.add_argument('--reads', type=int, default=30, help='number of reads in each phase')
+    parser.add_argument('--read-timeout', type=float, default=1, help='read timeout of the regional clients, in '
+                                                                      'seconds')
+    parser.add_argument('--output', help='file to append the JSON result line to')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    regions = parse_regions(args.regions)
+    servers = {region: FakeSecretsManagerServer(latency=latency, region=region) for region, latency in regions}
+    for server in servers.values():
+        server.start()
+    try:
+        # Stand-in for replication: every region holds the secret
+        for server in servers.values():
+            server.add_secret(SECRET_NAME, SECRET)
+        # Reranking and cooldowns are kept out of the way of the phases, which last a few seconds
+        client = RegionalSecretsClient(
+            [(region, server.url) for region, server in servers.items()], probe_secret_id=SECRET_NAME,
+            rerank_interval=3600, cooldown=3600,
+            client_config=Config(connect_timeout=1, read_timeout=args.read_timeout,
+                                 retries={'total_max_attempts': 1}))
+        client.rank()
+        initial = [repr(endpoint) for endpoint in client.ranking()]
+
+        phases = {'steady': bench_phase(client, servers, args.reads)}
+
+        first = servers[client.ranking()[0].region]
+        first.latency = max(server.latency for server in servers.values()) * 3
+        phases['slowdown'] = bench_phase(client, servers, args.reads)
+
+        first = servers[client.ranking()[0].region]
+        first.fail_next('GetSecretValue', 500, args.reads)
+        phases['errors'] = bench_phase(client, servers, args.reads)
+
+        first = servers[client.ranking()[0].region]
+        first.latency = args.read_timeout * 2
+        phases['timeout'] = bench_phase(client, servers, args.reads)
+    finally:
+        for server in servers.values():
+            server.stop()
+
+    result = {'benchmark': 'regional', 'timestamp': int(time.time()), 'python': sys.version.split()[0],
+              'regions': {region: latency * 1000 for region, latency in regions}, 'reads': args.reads,
+              'initial_ranking': initial, 'phases': phases}
+    line = json.dumps(result, sort_keys=True)
+    print(line)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
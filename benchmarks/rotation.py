@@ -0,0 +1,177 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Offline benchmark of the rotation function against the local fakes in benchmarks/fakes.py.
+
+A fake Astra organization with --org-size clients and a fake Secrets Manager endpoint (used through
+SECRETS_MANAGER_ENDPOINT) are started, each answering after --latency milliseconds. --secrets Astra secrets
+sharing one root secret are then rotated --rounds times each through lambda_handler, and the helpers of
+lambda_function.py are timed on their own. The result is printed as a single JSON line with:
+
+    steps              latency (p50/p95/max, in ms) of each rotation step, and with --allocations the peak
+                       and total memory allocated by the step
+    calls_per_rotation average number of Secrets Manager operations and Astra endpoint requests per rotation
+    helpers            latency of get_secret_dict, get_token_roles, create_astra_token, delete_astra_token and
+                       make_API_request
+
+Append results to a file with --output to compare them between releases. openssl is needed to generate the
+certificate of the fake Astra server.
+"""
+# Syntax:
+# python benchmarks/rotation.py [--secrets N] [--rounds N] [--org-size N] [--latency MS] [--allocations] [--output FILE]
+
+# Example
+# python benchmarks/rotation.py --secrets 20 --rounds 3 --org-size 5000 --latency 20 --output bench_output.txt
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lambda_function  # noqa: E402
+from fakes import FakeAstraServer, FakeSecretsManagerServer  # noqa: E402
+
+STEPS = ["createSecret", "setSecret", "testSecret", "finishSecret"]
+
+
+def configure(astra, secrets_manager):
+    """Points lambda_function at the fakes, and resets every cache of the module"""
+    os.environ['SECRETS_MANAGER_ENDPOINT'] = secrets_manager.url
+    os.environ.setdefault('AWS_DEFAULT_REGION', secrets_manager.region)
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    lambda_function.debug = False
+    lambda_function._config = None
+    lambda_function._service_client = None
+    lambda_function.astra_pool = lambda_function.AstraConnectionPool(astra.host, ssl_context=astra.ssl_context())
+    lambda_function.root_secret_cache = lambda_function.RootSecretCache()
+    lambda_function.client_index = lambda_function.AstraClientIndex()
+    lambda_function.rotation_contexts = lambda_function.RotationContextStore()
+    # Keep the metrics of the function out of the benchmark output
+    lambda_function.rotation_metrics = lambda_function.RotationMetrics(output=io.StringIO())
+
+
+def seed(astra, secrets_manager, count):
+    """Creates a root secret and count application secrets pointing at it, returns their ARNs"""
+    root = astra.root
+    root_arn = secrets_manager.add_secret("/benchmark/root", {
+        'astraKey': root['token'], 'clientID': root['clientId'], 'clientSecret': root['secret'],
+        'engine': 'Astra'})
+    arns = []
+    for i in range(count):
+        client = astra.create_client(["read-write-user"], propagated=True)
+        arns.append(secrets_manager.add_secret(f"/benchmark/app{i}", {
+            'astraKey': client['token'], 'clientID': client['clientId'], 'clientSecret': client['secret'],
+            'engine': 'Astra', 'rootarn': root_arn}))
+    return root_arn, arns
+
+
+def distribution(values):
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
+    return {'p50': round(statistics.median(values), 3), 'p95': round(p95, 3), 'max': round(values[-1], 3),
+            'n': len(values)}
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - started) * 1000, result
+
+
+def bench_rotations(astra, secrets_manager, arns, rounds, allocations):
+    latencies = {step: [] for step in STEPS}
+    peaks = {step: [] for step in STEPS}
+    totals = {step: [] for step in STEPS}
+    astra.reset_calls()
+    secrets_manager.reset_calls()
+    rotations = 0
+    for _ in range(rounds):
+        for arn in arns:
+            token = secrets_manager.begin_rotation(arn)
+            for step in STEPS:
+                event = {'SecretId': arn, 'ClientRequestToken': token, 'Step': step}
+                if allocations:
+                    tracemalloc.start()
+                    tracemalloc.reset_peak()
+                elapsed, _ = timed(lambda_function.lambda_handler, event, None)
+                if allocations:
+                    current, peak = tracemalloc.get_traced_memory()
+                    snapshot = tracemalloc.take_snapshot()
+                    tracemalloc.stop()
+                    peaks[step].append(peak / 1024)
+                    totals[step].append(sum(stat.size for stat in snapshot.statistics('filename')) / 1024)
+                latencies[step].append(elapsed)
+            rotations += 1
+
+    steps = {}
+    for step in STEPS:
+        steps[step] = {'latency_ms': distribution(latencies[step])}
+        if allocations:
+            steps[step]['peak_kib'] = distribution(peaks[step])
+            steps[step]['retained_kib'] = distribution(totals[step])
+    calls = {f"secretsmanager:{operation}": round(count / rotations, 2)
+             for operation, count in sorted(secrets_manager.calls.items())}
+    calls.update({f"astra:{operation}": round(count / rotations, 2)
+                  for operation, count in sorted(astra.calls.items())})
+    return steps, calls
+
+
+def bench_helpers(astra, arns, iterations):
+    service_client = lambda_function.get_service_client()
+    root_key = astra.root['token']
+    clientID = lambda_function.get_secret_dict(service_client, arns[0], "AWSCURRENT")['clientID']
+    results = {name: [] for name in ['get_secret_dict', 'get_token_roles_indexed', 'get_token_roles_refresh',
+                                     'create_astra_token', 'delete_astra_token', 'make_API_request']}
+    for _ in range(iterations):
+        results['get_secret_dict'].append(
+            timed(lambda_function.get_secret_dict, service_client, arns[0], "AWSCURRENT")[0])
+        results['get_token_roles_indexed'].append(timed(lambda_function.get_token_roles, root_key, clientID)[0])
+        elapsed, _ = timed(lambda_function.client_index.refresh, root_key)
+        results['get_token_roles_refresh'].append(elapsed)
+        elapsed, created = timed(lambda_function.create_astra_token, root_key, ["read-only-user"])
+        results['create_astra_token'].append(elapsed)
+        results['delete_astra_token'].append(timed(lambda_function.delete_astra_token, root_key, created[0])[0])
+        results['make_API_request'].append(
+            timed(lambda_function.make_API_request, root_key, "GET", "/v2/currentOrg")[0])
+    return {name: {'latency_ms': distribution(values)} for name, values in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--secrets', type=int, default=10, help='number of secrets to rotate')
+    parser.add_argument('--rounds', type=int, default=3, help='number of times each secret is rotated')
+    parser.add_argument('--org-size', type=int, default=1000, help='number of clients in the fake organization')
+    parser.add_argument('--latency', type=float, default=0, help='latency of the fakes, in milliseconds')
+    parser.add_argument('--iterations', type=int, default=20, help='number of calls of each helper')
+    parser.add_argument('--allocations', action='store_true', help='also measure memory allocated by each step')
+    parser.add_argument('--output', help='file to append the JSON result line to')
+    args = parser.parse_args()
+
+    with FakeAstraServer(org_size=args.org_size, latency=args.latency / 1000) as astra, \
+            FakeSecretsManagerServer(latency=args.latency / 1000) as secrets_manager:
+        configure(astra, secrets_manager)
+        root_arn, arns = seed(astra, secrets_manager, args.secrets)
+        steps, calls = bench_rotations(astra, secrets_manager, arns, args.rounds, args.allocations)
+        helpers = bench_helpers(astra, arns, args.iterations)
+
+    result = {'benchmark': 'rotation', 'timestamp': int(time.time()), 'python': sys.version.split()[0],
+              'secrets': args.secrets, 'rounds': args.rounds, 'org_size': args.org_size,
+              'latency_ms': args.latency, 'steps': steps, 'calls_per_rotation': calls, 'helpers': helpers,
+              'astra_pool': lambda_function.astra_pool.stats()}
+    line = json.dumps(result, sort_keys=True)
+    print(line)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_function
+
+logger = logging.getLogger(__name__)
+
+"""
+This Python code revokes many Astra tokens at once, for example to clean up stale tokens after an incident or to
+decommission many applications.
+
+Tokens are given either by client ID, together with the root secret whose key revokes them, or by the name of
+the Astra secret holding them. For a secret, the token of its AWSCURRENT version is revoked, as well as the token
+of its AWSPENDING version while a rotation is in progress, and with --delete-secrets the secret is then deleted
+like example_delete_astra_secret.py does.
+
+Revocations run on a thread pool, and a rate limiter bounds the number of Astra requests per second across all
+threads. A token which no longer exists (404) counts as revoked. Every result is printed as a JSON line and, with
+--progress, appended to a progress log; running again with the same log skips the tokens and secrets it already
+records as done, so an interrupted run picks up where it stopped.
+"""
+# Syntax:
+# python bulk_revocation.py [--workers N] [--rate N] [--progress FILE] --root-secret <ROOT NAME> <CLIENT ID>...
+# python bulk_revocation.py [--workers N] [--rate N] [--progress FILE] [--delete-secrets] --secrets <NAME>...
+
+# Example
+# python bulk_revocation.py --rate 5 --progress revoke.log --root-secret /astra/prod/root 2aef8ccd-6c21-40c4-b0c0-6542817fe2d5
+# python bulk_revocation.py --progress decommission.log --delete-secrets --secrets /astra/prod/app1 /astra/prod/app2
+
+
+class RateLimiter:
+    """Token bucket limiting the rate of calls shared by many threads
+
+    Args:
+        rate: The number of calls per second, or None for no limit.
+        burst: The number of calls which can be made at once after an idle period, by default one second worth.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a call can be made"""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ProgressLog:
+    """Append-only JSON lines log of results, read back to skip what an earlier run already did
+
+    Args:
+        path: The path of the log, or None to keep no log.
+    """
+
+    DONE = ('revoked', 'missing')
+
+    def __init__(self, path=None):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        self._file = None
+        if path is None:
+            return
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # A line cut short by an interruption
+                        continue
+                    if result.get('status') in self.DONE:
+                        self.done.add(result['key'])
+        self._file = open(path, 'a')
+
+    def record(self, result):
+        if self._file is None:
+            return
+        with self._lock:
+            self._file.write(json.dumps(result) + '\n')
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _secret_client_ids(service_client, secret_id):
+    """Returns the root ARN of an Astra secret, and the client IDs of its AWSCURRENT and AWSPENDING versions"""
+    metadata = service_client.describe_secret(SecretId=secret_id)
+    client_ids = []
+    root_arn = None
+    for version, stages in metadata['VersionIdsToStages'].items():
+        stage = "AWSCURRENT" if "AWSCURRENT" in stages else "AWSPENDING" if "AWSPENDING" in stages else None
+        if stage is None:
+            continue
+        try:
+            secret_dict = lambda_function.get_secret_dict(service_client, metadata['ARN'], stage, version)
+        except service_client.exceptions.ResourceNotFoundException:
+            # A pending version is only staged until createSecret puts its value
+            continue
+        if stage == "AWSCURRENT":
+            root_arn = secret_dict['rootarn']
+        client_ids.append(secret_dict['clientID'])
+    return root_arn, client_ids
+
+
+def revoke_token(root_key, clientID, limiter):
+    """Revokes one Astra token, returning 'revoked', or 'missing' when it no longer exists"""
+    limiter.acquire()
+    status = lambda_function.delete_astra_token(root_key, clientID)
+    if status == 404:
+        return 'missing'
+    if status not in [200, 204]:
+        raise Exception(f"Unable to revoke token {clientID}. Received status {status}")
+    return 'revoked'
+
+
+def revoke(service_client, client_ids=(), root_arn=None, secret_ids=(), delete_secrets=False, rate=10,
+           max_workers=8, progress=None, on_result=None):
+    """Revokes many Astra tokens concurrently, under a rate limit
+
+    Args:
+        service_client (client): The secrets manager service client
+        client_ids (list): Client IDs of tokens to revoke with the key of root_arn
+        root_arn (string): The root secret used to revoke client_ids
+        secret_ids (list): Names or ARNs of Astra secrets whose tokens are revoked
+        delete_secrets (bool): Also delete secret_ids once their tokens are revoked
+        rate (float): The maximum number of Astra requests per second, or None for no limit
+        max_workers (int): The number of revocations made at the same time
+        progress (ProgressLog): Optional log of the results, whose done entries are skipped
+        on_result (callable): Optional function called with every result as soon as it is available
+
+    Returns:
+        a tuple of the list of results, and a summary dictionary with the number of tokens or secrets revoked,
+        missing, skipped (done by an earlier run) and failed, and the elapsed seconds
+    """
+    if client_ids and root_arn is None:
+        raise ValueError("A root secret is required to revoke client IDs")
+    progress = progress or ProgressLog()
+    limiter = RateLimiter(rate)
+    started = time.monotonic()
+    results = []
+    lock = threading.Lock()
+
+    def report(result):
+        with lock:
+            results.append(result)
+        if result['status'] != 'skipped':
+            progress.record(result)
+        if on_result is not None:
+            on_result(result)
+
+    def revoke_client(clientID):
+        result = {'key': clientID, 'clientID': clientID}
+        try:
+            root_key = lambda_function.root_secret_cache.get(service_client, root_arn)['astraKey']
+            result['status'] = revoke_token(root_key, clientID, limiter)
+        except Exception as e:
+            logger.exception("Revocation failed for %s", clientID)
+            result.update(status='failed', error=str(e))
+        report(result)
+
+    def revoke_secret(secret_id):
+        result = {'key': secret_id, 'secret': secret_id}
+        try:
+            try:
+                secret_root_arn, secret_client_ids = _secret_client_ids(service_client, secret_id)
+            except service_client.exceptions.ResourceNotFoundException:
+                # Only a missing secret is missing, a missing root secret is a failure
+                result['status'] = 'missing'
+                report(result)
+                return
+            root_key = lambda_function.root_secret_cache.get(service_client, secret_root_arn)['astraKey']
+            statuses = [revoke_token(root_key, clientID, limiter) for clientID in secret_client_ids]
+            result['clientIDs'] = secret_client_ids
+            result['status'] = 'revoked' if 'revoked' in statuses else 'missing'
+            if delete_secrets:
+                try:
+                    service_client.delete_secret(SecretId=secret_id, ForceDeleteWithoutRecovery=True)
+                    result['deleted'] = True
+                except service_client.exceptions.ResourceNotFoundException:
+                    # Deleted since its tokens were read
+                    result['deleted'] = False
+        except Exception as e:
+            logger.exception("Revocation failed for %s", secret_id)
+            result.update(status='failed', error=str(e))
+        report(result)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for key, function in [(clientID, revoke_client) for clientID in client_ids] + \
+                             [(secret_id, revoke_secret) for secret_id in secret_ids]:
+            if key in progress.done:
+                report({'key': key, 'status': 'skipped'})
+            else:
+                executor.submit(function, key)
+
+    elapsed = time.monotonic() - started
+    summary = {status: sum(1 for result in results if result['status'] == status)
+               for status in ('revoked', 'missing', 'skipped', 'failed')}
+    summary['seconds'] = round(elapsed, 3)
+    return results, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Revoke many Astra tokens concurrently")
+    parser.add_argument('client_ids', nargs='*', help='client IDs of the tokens to revoke')
+    parser.add_argument('--root-secret', help='name or ARN of the root secret used to revoke the client IDs')
+    parser.add_argument('--secrets', nargs='+', default=[], help='names or ARNs of secrets whose tokens to revoke')
+    parser.add_argument('--delete-secrets', action='store_true',
+                        help='delete the secrets, without recovery, once their tokens are revoked')
+    parser.add_argument('--rate', type=float, default=10, help='maximum number of Astra requests per second')
+    parser.add_argument('--workers', type=int, default=8, help='number of revocations made at the same time')
+    parser.add_argument('--progress', help='progress log to append to, and to resume from')
+    args = parser.parse_args(argv)
+    if not args.client_ids and not args.secrets:
+        parser.error("either client IDs or --secrets is required")
+    if args.client_ids and not args.root_secret:
+        parser.error("--root-secret is required to revoke client IDs")
+
+    def on_result(result):
+        print(json.dumps(result), flush=True)
+
+    progress = ProgressLog(args.progress)
+    try:
+        results, summary = revoke(lambda_function.get_service_client(), args.client_ids, args.root_secret,
+                                  args.secrets, args.delete_secrets, args.rate, args.workers, progress, on_result)
+    finally:
+        progress.close()
+    print(json.dumps({'summary': summary}), flush=True)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
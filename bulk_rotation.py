@@ -0,0 +1,197 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import argparse
+import json
+import logging
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_function
+from secretsmanager_lib import SecretsManagerSecret
+
+logger = logging.getLogger(__name__)
+
+"""
+This Python code rotates many Astra secrets at once, running the createSecret, setSecret, testSecret and
+finishSecret steps of lambda_function.py locally instead of through the rotation Lambda.
+
+The secrets are given by name or ARN, or selected with a name prefix filter. Their AWSCURRENT values are read
+first to find each secret's rootarn, and the secrets are grouped by it. For every group the root key is read
+and the Astra client listing is indexed once (through the root_secret_cache and client_index of
+lambda_function.py), after which the secrets of the group are rotated on a bounded thread pool. A secret with
+an AWSPENDING version which is not AWSCURRENT, left by a failed step of an earlier run or by a rotation started by
+Secrets Manager, has that rotation resumed: the steps run again with its version ID as the ClientRequestToken,
+and they are idempotent for a given token, so no token is created twice or left behind.
+A root secret that is part of the run, whether of its own group or of another one, is rotated after every other
+secret, and after the root secrets it is itself the root of, since rotating it deletes the root key they use.
+
+One JSON result line is printed per secret, followed by a summary line with the overall throughput.
+"""
+# Syntax:
+# python bulk_rotation.py [--workers N] (--prefix <NAME PREFIX> | <NAME> [<NAME> ...])
+
+# Example
+# python bulk_rotation.py --workers 16 --prefix /astra/prod/
+
+
+def rotate_secret_locally(service_client, arn, token=None):
+    """Runs the four rotation steps of lambda_function.py for a single secret
+
+    Args:
+        service_client (client): The secrets manager service client
+        arn (string): The secret ARN or other identifier
+        token (string): The version ID of an AWSPENDING version to resume the rotation of, or None to start a
+            new rotation
+
+    Returns:
+        the ClientRequestToken of the new secret version
+    """
+    token = token or str(uuid.uuid4())
+    lambda_function.create_secret(service_client, arn, token)
+    lambda_function.set_secret(service_client, arn, token)
+    lambda_function.test_secret(service_client, arn, token)
+    lambda_function.finish_secret(service_client, arn, token)
+    return token
+
+
+def list_secret_ids(service_client, prefix, max_results=10000):
+    """Returns the ARNs of the secrets whose name starts with prefix"""
+    secret = SecretsManagerSecret(service_client)
+    filters = [{'Key': 'name', 'Values': [prefix]}]
+    return [entry['ARN'] for entry in secret.list(max_results, filters)]
+
+
+def _read_root_arn(service_client, arn):
+    """Returns the ARN and the root ARN of a secret, and the version ID of its rotation in progress, if any"""
+    metadata = service_client.describe_secret(SecretId=arn)
+    pending = next((version for version, stages in metadata.get('VersionIdsToStages', {}).items()
+                    if 'AWSPENDING' in stages and 'AWSCURRENT' not in stages), None)
+    current_dict = lambda_function.get_secret_dict(service_client, arn, "AWSCURRENT")
+    return metadata['ARN'], current_dict['rootarn'], pending
+
+
+def _rotate(service_client, arn, pending=None):
+    started = time.monotonic()
+    result = {'secret': arn}
+    if pending is not None:
+        result['resumed'] = pending
+    try:
+        result['version'] = rotate_secret_locally(service_client, arn, pending)
+        result['status'] = 'rotated'
+    except Exception as e:
+        logger.exception("Rotation failed for %s", arn)
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    result['seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+def _prefetch(service_client, root_arn):
+    root_key = lambda_function.root_secret_cache.get(service_client, root_arn)['astraKey']
+    lambda_function.client_index.refresh(root_key)
+
+
+def rotate_secrets(service_client, secret_ids, max_workers=8, on_result=None):
+    """Rotates many secrets concurrently, grouped by their root secret
+
+    Args:
+        service_client (client): The secrets manager service client
+        secret_ids (list): The secret ARNs or other identifiers to rotate
+        max_workers (int): The number of secrets rotated at the same time
+        on_result (callable): Optional function called with every result as soon as it is available
+
+    Returns:
+        a tuple of the list of per secret results, and a summary dictionary with the number of secrets
+        rotated, failed and skipped, the elapsed seconds and the throughput in secrets per second
+    """
+    started = time.monotonic()
+    results = []
+
+    def report(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Find the root secret of every secret, skipping those that are not Astra secrets
+        groups = {}
+        arns_of = {}
+        root_of = {}
+        pending_of = {}
+        lookups = {arn: executor.submit(_read_root_arn, service_client, arn) for arn in secret_ids}
+        for arn, lookup in lookups.items():
+            try:
+                arns_of[arn], root_of[arn], pending_of[arn] = lookup.result()
+            except Exception as e:
+                report({'secret': arn, 'status': 'skipped', 'error': str(e), 'seconds': 0})
+                continue
+            groups.setdefault(root_of[arn], []).append(arn)
+
+        # Read each root key and index its client listing once per group
+        prefetches = {root_arn: executor.submit(_prefetch, service_client, root_arn) for root_arn in groups}
+        rotations = []
+        roots = []
+        for root_arn, arns in groups.items():
+            try:
+                prefetches[root_arn].result()
+            except Exception as e:
+                for arn in arns:
+                    report({'secret': arn, 'status': 'failed', 'error': f"Root secret {root_arn}: {e}",
+                            'seconds': 0})
+                continue
+            for arn in arns:
+                if arns_of[arn] in groups:
+                    roots.append(arn)
+                else:
+                    rotations.append(executor.submit(_rotate, service_client, arn, pending_of[arn]))
+
+        for rotation in rotations:
+            report(rotation.result())
+        # Root secrets last, once nothing uses their current key anymore: a root secret waits for the root
+        # secrets whose root it is
+        while roots:
+            deferred = {root_of[arn] for arn in roots if root_of[arn] != arns_of[arn]}
+            wave = [arn for arn in roots if arns_of[arn] not in deferred] or roots
+            roots = [arn for arn in roots if arn not in wave]
+            for rotation in [executor.submit(_rotate, service_client, arn, pending_of[arn]) for arn in wave]:
+                report(rotation.result())
+
+    elapsed = time.monotonic() - started
+    summary = {
+        'secrets': len(results),
+        'rotated': sum(1 for result in results if result['status'] == 'rotated'),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'skipped': sum(1 for result in results if result['status'] == 'skipped'),
+        'seconds': round(elapsed, 3),
+        'secretsPerSecond': round(len(results) / elapsed, 3) if elapsed else None,
+    }
+    return results, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rotate many Astra secrets concurrently")
+    parser.add_argument('names', nargs='*', help='names or ARNs of the secrets to rotate')
+    parser.add_argument('--prefix', help='rotate every secret whose name starts with this prefix')
+    parser.add_argument('--workers', type=int, default=8, help='number of secrets rotated at the same time')
+    args = parser.parse_args(argv)
+    if not args.names and not args.prefix:
+        parser.error("either secret names or --prefix is required")
+
+    service_client = lambda_function.get_service_client()
+    secret_ids = list(args.names)
+    if args.prefix:
+        secret_ids += list_secret_ids(service_client, args.prefix)
+
+    def on_result(result):
+        print(json.dumps(result), flush=True)
+
+    results, summary = rotate_secrets(service_client, secret_ids, args.workers, on_result)
+    print(json.dumps({'summary': summary}), flush=True)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
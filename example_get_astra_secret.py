@@ -4,6 +4,7 @@
 # SPDX-License-Identifier: MIT-0
 
 import boto3
+import os
 import sys
 from botocore.exceptions import ClientError
 
@@ -14,6 +15,10 @@ to create a client for AWS Secrets Manager and then calls the
 get_secret_value method of the client to retrieve the secret. If the
 retrieval is successful, it decrypts the secret using the associated KMS key
 and prints the secret. 
+
+For a secret replicated to several regions, set SECRETS_MANAGER_ENDPOINTS to
+the regions (for example us-east-1,eu-west-1) and the secret is read from the
+region with the lowest latency, see regional_endpoints.py.
 """
 # Syntax:
 # python example_get_astra_secret.py <NAME>
@@ -29,11 +34,15 @@ def get_secret(name):
     region_name = "us-east-1"
 
     # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+    if os.environ.get('SECRETS_MANAGER_ENDPOINTS'):
+        from regional_endpoints import RegionalSecretsClient
+        client = RegionalSecretsClient.from_environment(probe_secret_id=name)
+    else:
+        session = boto3.session.Session()
+        client = session.client(
+            service_name='secretsmanager',
+            region_name=region_name
+        )
 
     try:
         get_secret_value_response = client.get_secret_value(
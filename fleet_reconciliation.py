@@ -0,0 +1,205 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import argparse
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_function
+from secretsmanager_lib import SecretsManagerSecret
+
+logger = logging.getLogger(__name__)
+
+"""
+This Python code audits the Astra secrets of an account against the Astra tokens of their organizations.
+
+Every secret is listed (with SecretsManagerSecret.list, optionally filtered by name prefix) and its AWSCURRENT
+value read, as well as its AWSPENDING value while a rotation is in progress; secrets which are not Astra secrets
+are skipped. The spare tokens of the token pool (TOKEN_POOL_SECRET) count as referenced by the pool secret. With
+a prefix, the secrets outside of it are still read, so that their tokens are not reported as orphaned, but only the
+organizations and the missing or shared clients of the secrets under the prefix are reported. The
+clientIDs are then collected in a hash table per Astra organization. Each organization is identified with one
+/v2/currentOrg call per root secret, and its /v2/clientIdSecrets listing is streamed once and joined against that
+table in a single pass, so the audit costs one Astra listing per organization no matter how many secrets
+reference it.
+
+The report lists:
+
+    orphaned_tokens   Astra tokens which no secret references, e.g. left behind by a failed createSecret
+                      retry or an interrupted deletion
+    missing_clients   secrets whose clientID no longer exists in Astra
+    shared_clients    clientIDs referenced by more than one secret
+    errors            secrets or root secrets which could not be read
+"""
+# Syntax:
+# python fleet_reconciliation.py [--prefix <NAME PREFIX>] [--workers N]
+
+# Example
+# python fleet_reconciliation.py --prefix /astra/prod/
+
+
+def _read_references(service_client, entry):
+    """Returns the Astra references of a listed secret, or None when it is not an Astra secret"""
+    arn = entry['ARN']
+    references = []
+    stages = entry.get('SecretVersionsToStages', {})
+    pending = [version for version, labels in stages.items()
+               if 'AWSPENDING' in labels and 'AWSCURRENT' not in labels]
+    for stage, version in [("AWSCURRENT", None)] + [("AWSPENDING", version) for version in pending]:
+        try:
+            secret = service_client.get_secret_value(SecretId=arn, VersionStage=stage,
+                                                     **({'VersionId': version} if version else {}))
+        except service_client.exceptions.ResourceNotFoundException:
+            # A pending version is only staged until createSecret puts its value
+            continue
+        try:
+            secret_dict = lambda_function.parse_secret_dict(secret['SecretString'], True)
+        except (KeyError, ValueError, TypeError):
+            return None
+        references.append({'secret': entry['Name'], 'arn': arn, 'stage': stage,
+                           'clientID': secret_dict['clientID'],
+                           'rootarn': secret_dict.get('rootarn', arn)})
+    return references
+
+
+def _pool_references(service_client):
+    """Returns the references of the spare tokens of the token pool of lambda_function.py"""
+    pool_arn = lambda_function.token_pool.pool_arn
+    pool = json.loads(service_client.get_secret_value(SecretId=pool_arn)['SecretString'] or '{}')
+    return [{'secret': pool_arn, 'arn': pool_arn, 'stage': 'SPARE', 'clientID': spare['clientID'], 'rootarn': root_arn}
+            for root_arn, role_sets in pool.get('spares', {}).items()
+            for spares in role_sets.values() for spare in spares]
+
+
+def stream_references(service_client, prefix=None, max_workers=8, max_results=100000):
+    """Yields the Astra references of every secret, reading secret values on a thread pool
+
+    Args:
+        service_client (client): The secrets manager service client
+        prefix (string): Only read the secrets whose name starts with prefix
+        max_workers (int): The number of secret values read at the same time
+
+    Yields:
+        a (listed secret, references) tuple per secret, where references is a list of dictionaries with the
+        secret, arn, stage, clientID and rootarn keys, None for secrets which are not Astra secrets, or the
+        exception raised while reading the secret
+    """
+    secret = SecretsManagerSecret(service_client)
+    filters = [{'Key': 'name', 'Values': [prefix]}] if prefix else None
+
+    def read(entry):
+        try:
+            return entry, _read_references(service_client, entry)
+        except Exception as e:
+            return entry, e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(read, secret.list(max_results, filters))
+
+
+def reconcile(service_client, prefix=None, max_workers=8):
+    """Joins the clientIDs referenced by secrets with the Astra client listings of their organizations
+
+    Args:
+        service_client (client): The secrets manager service client
+        prefix (string): Only audit the secrets whose name starts with prefix
+        max_workers (int): The number of secret values read at the same time
+
+    Returns:
+        a report dictionary, see the module documentation
+    """
+    report = {'secrets': 0, 'skipped': 0, 'organizations': 0, 'orphaned_tokens': [], 'missing_clients': [],
+              'shared_clients': [], 'errors': []}
+
+    def in_scope(reference):
+        return not prefix or reference['secret'].startswith(prefix)
+
+    # Build side: clientID -> referencing secrets, per root secret. Every secret is read, even with a prefix, as a
+    # token referenced by a secret outside of the prefix is not orphaned.
+    by_root = {}
+    scoped_roots = set()
+    for entry, references in stream_references(service_client, None, max_workers):
+        scoped = not prefix or entry['Name'].startswith(prefix)
+        if isinstance(references, Exception):
+            report['errors'].append({'secret': entry['Name'], 'error': str(references)})
+            continue
+        if references is None:
+            report['skipped'] += scoped
+            continue
+        report['secrets'] += scoped
+        for reference in references:
+            by_root.setdefault(reference['rootarn'], {}).setdefault(reference['clientID'], []).append(reference)
+            if scoped:
+                scoped_roots.add(reference['rootarn'])
+
+    # Spare tokens are referenced by the token pool secret, when the pool is enabled
+    if lambda_function.token_pool.enabled:
+        try:
+            for reference in _pool_references(service_client):
+                by_root.setdefault(reference['rootarn'], {}).setdefault(reference['clientID'], []).append(reference)
+        except Exception as e:
+            report['errors'].append({'secret': lambda_function.token_pool.pool_arn, 'error': str(e)})
+
+    # Root secrets of the same organization share one listing
+    organizations = {}
+    for root_arn, table in by_root.items():
+        try:
+            root_key = lambda_function.root_secret_cache.get(service_client, root_arn)['astraKey']
+            status, reason, headers, data = lambda_function.make_API_request(root_key, "GET", "/v2/currentOrg")
+            if status != 200:
+                raise Exception(f"Unable to identify the organization. Received status {status} {reason}")
+        except Exception as e:
+            report['errors'].append({'rootarn': root_arn, 'error': str(e)})
+            continue
+        organization = organizations.setdefault(data['id'], {'root_key': root_key, 'table': {}, 'scoped': False})
+        organization['scoped'] |= root_arn in scoped_roots
+        for clientID, references in table.items():
+            organization['table'].setdefault(clientID, []).extend(references)
+    # Only the organizations of the secrets under the prefix are audited
+    organizations = {org_id: organization for org_id, organization in organizations.items()
+                     if not prefix or organization['scoped']}
+    report['organizations'] = len(organizations)
+
+    # Probe side: one pass over each organization's listing
+    for org_id, organization in organizations.items():
+        table = organization['table']
+        found = set()
+        orphaned = []
+        try:
+            # The listing is streamed, so only the clients which are not referenced are kept in memory
+            for client in lambda_function.iter_astra_clients(organization['root_key']):
+                clientID = client['clientId']
+                if clientID in table:
+                    found.add(clientID)
+                else:
+                    orphaned.append({'organization': org_id, 'clientID': clientID, 'roles': client.get('roles'),
+                                     'generatedOn': client.get('generatedOn')})
+        except Exception as e:
+            report['errors'].append({'organization': org_id, 'error': str(e)})
+            continue
+        report['orphaned_tokens'].extend(orphaned)
+        for clientID, references in table.items():
+            if clientID not in found:
+                for reference in filter(in_scope, references):
+                    report['missing_clients'].append(dict(reference, organization=org_id))
+            secrets = sorted({reference['secret'] for reference in references})
+            if len(secrets) > 1 and any(map(in_scope, references)):
+                report['shared_clients'].append({'organization': org_id, 'clientID': clientID, 'secrets': secrets})
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find Astra tokens and secrets which are out of sync")
+    parser.add_argument('--prefix', help='only audit the secrets whose name starts with this prefix')
+    parser.add_argument('--workers', type=int, default=8, help='number of secret values read at the same time')
+    args = parser.parse_args(argv)
+
+    report = reconcile(lambda_function.get_service_client(), args.prefix, args.workers)
+    print(json.dumps(report, indent=4, sort_keys=True, default=str))
+    return 1 if report['orphaned_tokens'] or report['missing_clients'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,11 +3,26 @@
 # Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
+import codecs
+import collections
+import contextlib
+import contextvars
+import email.utils
+import hashlib
+import hmac
 import json
 import logging
+import math
 import os
 import http.client
+import random
+import re
+import select
+import sys
+import ssl
+import threading
+import time
+import uuid
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -18,6 +33,214 @@ debug = True
 
 astraAPIhost = "api.astra.datastax.com"
 
+# Keep-alive tuning for the Astra connection pool. Idle sockets older than astraAPIidleTimeout seconds are
+# discarded instead of reused, since the server side will usually have closed them by then.
+astraAPImaxIdle = 8
+astraAPIidleTimeout = 50
+
+# Retry tuning for Astra API requests. Retries back off exponentially with full jitter (or wait as long as a
+# Retry-After header asks, up to astraAPIretryAfterMax seconds), and are only made while the process wide retry
+# budget allows it: every request earns astraAPIretryBudgetRatio of a retry, and each retry spends one.
+astraAPImaxAttempts = 4
+astraAPIbackoffBase = 0.25
+astraAPIbackoffMax = 5
+astraAPIretryAfterMax = 30
+astraAPIretryBudgetRatio = 0.2
+astraAPIretryBudgetMin = 10
+astraAPIretryStatuses = [429, 500, 502, 503, 504]
+
+# Methods of Astra API requests which can be sent again when it is unknown whether the first one was processed
+astraAPIidempotentMethods = ["GET", "PUT", "DELETE"]
+
+# Size, in bytes, of the chunks in which streamed Astra API responses (such as the client listing) are read
+astraStreamChunkSize = 16384
+
+# Timeouts, in seconds, of connecting to the Astra API and of waiting for its responses. Within a Lambda
+# invocation they are also cut to the time left before the deadline.
+astraAPIconnectTimeout = 5
+astraAPIreadTimeout = 20
+
+# Timeouts, in seconds, of each attempt of a Secrets Manager operation. botocore can not change them per call, so
+# within a Lambda invocation the first attempt of an operation is sent as long as secretsManagerMinAttemptTime
+# seconds are left before the deadline (most complete in a fraction of the timeouts), and a retry only when both
+# timeouts fit in the time left.
+secretsManagerConnectTimeout = 1
+secretsManagerReadTimeout = 3
+secretsManagerMinAttemptTime = 0.25
+
+# Number of seconds kept free before the Lambda timeout, so that a step which runs out of time stops cleanly
+# (logging its error and flushing its metrics) instead of being killed. Short function timeouts keep
+# deadlineMarginRatio of the invocation instead, so that the default timeout of 3 seconds still works.
+deadlineMargin = 1.5
+deadlineMarginRatio = 0.1
+
+# Polling of a new token by testSecret until it authenticates. The first wait follows the propagation delay
+# observed by earlier rotations in the container (starting from astraPropagationInitial seconds), later waits
+# back off exponentially between astraPropagationMinPoll and astraPropagationMaxPoll seconds. Polling stops at
+# the invocation deadline, or after astraPropagationMaxWait seconds when there is none.
+astraPropagationInitial = 1
+astraPropagationMinPoll = 0.25
+astraPropagationMaxPoll = 5
+astraPropagationMaxWait = 60
+
+# Number of seconds between checks of the AWSCURRENT version of a cached root secret
+rootSecretCacheTTL = 300
+
+# Number of seconds during which a root key that Astra rejected, but is still the current key of its root secret,
+# is not fetched again
+rootKeyRecheckInterval = 10
+
+# Number of seconds a clientId to roles index built from the Astra client listing is trusted
+clientIndexTTL = 60
+
+# Number of rotations whose context is kept in memory by a warm container
+rotationContextSize = 64
+
+# Tag of the secret recording the Astra token created by createSecret for a ClientRequestToken, until it is stored
+rotationJournalTag = "AstraRotationJournal"
+
+# Number of spare tokens kept per role set by the optional token pool (the TOKEN_POOL_SECRET environment variable),
+# the attempts of a pool update which races with another one, and the checks of a new spare before it is pooled
+tokenPoolSize = 2
+tokenPoolUpdateAttempts = 5
+tokenPoolTestAttempts = 5
+
+# Minimum number of seconds between two refills of the spares of one role set. Every claim and every refill writes a
+# new version of the pool secret, and Secrets Manager keeps the versions of the last 24 hours (about 100 of them at
+# most), so refills are made by a scheduled invocation and bounded to about 86400 / tokenPoolRefillInterval per day
+# and role set, each followed by at most tokenPoolSize claims, whatever the number of rotations.
+tokenPoolRefillInterval = 3600
+
+# Number of handed out tokens whose roles the pool remembers, oldest forgotten first, which keeps the pool secret
+# well under the 64 KB limit of a SecretString. The roles of a forgotten token are found in the client listing.
+tokenPoolMaxAssigned = 200
+
+# CloudWatch namespace of the metrics written in Embedded Metric Format at the end of each invocation
+metricsNamespace = "AstraSecretsRotation"
+
+# Container scoped state. These are built on first use and then reused by every warm invocation of the
+# container, so that boto3 (and its service models) are only loaded once, and only when actually needed.
+_config = None
+_service_client = None
+_ssl_context = None
+_init_lock = threading.Lock()
+
+# Deadline (a time.monotonic() value) of the current invocation, or None outside of one
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+# Number of attempts made so far by the current Secrets Manager operation of the thread
+_secrets_manager_attempts = contextvars.ContextVar('secrets_manager_attempts', default=0)
+
+
+def get_config():
+    """Returns the configuration of the function, parsed from the environment once per container
+
+    Raises:
+        KeyError: If the SECRETS_MANAGER_ENDPOINT environment variable is not set
+
+    """
+    global _config
+    if _config is None:
+        _config = {
+            'secrets_manager_endpoint': os.environ['SECRETS_MANAGER_ENDPOINT'],
+        }
+    return _config
+
+
+def get_service_client():
+    """Returns the Secrets Manager client shared by every invocation of the container
+
+    boto3 is imported on the first call rather than at module import, which keeps it off the import path
+    of callers that only need the Astra helpers.
+    """
+    global _service_client
+    if _service_client is None:
+        with _init_lock:
+            if _service_client is None:
+                import boto3
+                from botocore.config import Config
+                client = boto3.client(
+                    'secretsmanager', endpoint_url=get_config()['secrets_manager_endpoint'],
+                    config=Config(connect_timeout=secretsManagerConnectTimeout,
+                                  read_timeout=secretsManagerReadTimeout))
+                rotation_metrics.instrument(client)
+                enforce_deadline(client)
+                _service_client = client
+    return _service_client
+
+
+def get_ssl_context():
+    """Returns the SSL context used for Astra API connections, built (and CA certificates loaded) once"""
+    global _ssl_context
+    if _ssl_context is None:
+        with _init_lock:
+            if _ssl_context is None:
+                _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of starting (or waiting for) a call which can not complete before the invocation deadline"""
+
+
+@contextlib.contextmanager
+def deadline(context):
+    """Sets the deadline of the calls made within the block from the remaining time of a Lambda invocation
+
+    Args:
+        context (LambdaContext): The Lambda runtime information, or None for no deadline (e.g. run locally)
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        yield
+        return
+    remaining = context.get_remaining_time_in_millis() / 1000
+    reset = _deadline.set(time.monotonic() + remaining - min(deadlineMargin, remaining * deadlineMarginRatio))
+    try:
+        yield
+    finally:
+        _deadline.reset(reset)
+
+
+def remaining_time():
+    """Returns the number of seconds left before the deadline, or None when there is no deadline"""
+    current = _deadline.get()
+    return None if current is None else current - time.monotonic()
+
+
+def call_timeout(timeout, operation="call"):
+    """Returns timeout, cut to the time left before the deadline
+
+    Raises:
+        DeadlineExceeded: If the deadline has passed
+    """
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded(f"No time left for {operation} before the Lambda timeout")
+    return min(timeout, remaining)
+
+
+def enforce_deadline(service_client):
+    """Registers botocore event handlers which stop Secrets Manager calls from being sent once less than
+    secretsManagerMinAttemptTime seconds are left before the deadline, and their retries once the timeouts of the
+    client configuration do not fit in the time left: a retry follows a failure, often a stalled attempt."""
+    def before_call(**kwargs):
+        _secrets_manager_attempts.set(0)
+
+    def before_send(request, **kwargs):
+        attempt = _secrets_manager_attempts.get() + 1
+        _secrets_manager_attempts.set(attempt)
+        remaining = remaining_time()
+        required = secretsManagerMinAttemptTime if attempt == 1 else \
+            secretsManagerConnectTimeout + secretsManagerReadTimeout
+        if remaining is not None and remaining < required:
+            raise DeadlineExceeded(f"Not enough time left for a Secrets Manager request to {request.url} "
+                                   f"before the Lambda timeout")
+
+    service_client.meta.events.register('before-call.secrets-manager', before_call)
+    service_client.meta.events.register('before-send.secrets-manager', before_send)
+
 
 def lambda_handler(event, context):
     """Secrets Manager Datastax API Tokens
@@ -41,6 +264,7 @@ def lambda_handler(event, context):
             - SecretId: The secret ARN or identifier
             - ClientRequestToken: The ClientRequestToken of the secret version
             - Step: The rotation step (one of createSecret, setSecret, testSecret, or finishSecret)
+            A scheduled invocation with {"Step": "refillTokenPool"} as its event refills the token pool instead.
 
         context (LambdaContext): The Lambda runtime information
 
@@ -57,57 +281,74 @@ def lambda_handler(event, context):
         logger.info(f"event: {event}")
         logger.info(f"context: {context}")
 
+    if event.get('Step') == "refillTokenPool":
+        # Out of band of the rotations, e.g. from an EventBridge schedule, and bounded by this invocation
+        with rotation_metrics.invocation(event['Step']), deadline(context):
+            token_pool.refill_all(get_service_client())
+        return
+
     arn = event['SecretId']
     token = event['ClientRequestToken']
     step = event['Step']
 
-    # Setup the client
-    service_client = boto3.client(
-        'secretsmanager', endpoint_url=os.environ['SECRETS_MANAGER_ENDPOINT'])
-
-    # Make sure the version is staged correctly
-    metadata = service_client.describe_secret(SecretId=arn)
-    if "RotationEnabled" in metadata and not metadata['RotationEnabled']:
-        logger.error("Secret %s is not enabled for rotation" % arn)
-        raise ValueError("Secret %s is not enabled for rotation" % arn)
-    versions = metadata['VersionIdsToStages']
-    if token not in versions:
-        logger.error(
-            "Secret version %s has no stage for rotation of secret %s." % (token, arn))
-        raise ValueError(
-            "Secret version %s has no stage for rotation of secret %s." % (token, arn))
-    if "AWSCURRENT" in versions[token]:
-        logger.info(
-            "Secret version %s already set as AWSCURRENT for secret %s." % (token, arn))
-        return
-    elif "AWSPENDING" not in versions[token]:
-        logger.error(
-            "Secret version %s not set as AWSPENDING for rotation of secret %s." % (token, arn))
-        raise ValueError(
-            "Secret version %s not set as AWSPENDING for rotation of secret %s." % (token, arn))
+    # Record how long the step takes, and write every metric of the invocation when it ends. Every call made by
+    # the step is bounded by the time left in the invocation.
+    with rotation_metrics.invocation(step), deadline(context):
+        # Get the client, which is only built on the first invocation of the container
+        service_client = get_service_client()
+
+        # Make sure the version is staged correctly
+        metadata = service_client.describe_secret(SecretId=arn)
+        # Pick up what earlier steps of this rotation already read, when they ran in this container
+        rotation = rotation_contexts.get(arn, token)
+        rotation.metadata = metadata
+        if "RotationEnabled" in metadata and not metadata['RotationEnabled']:
+            logger.error("Secret %s is not enabled for rotation" % arn)
+            raise ValueError("Secret %s is not enabled for rotation" % arn)
+        versions = metadata['VersionIdsToStages']
+        if token not in versions:
+            logger.error(
+                "Secret version %s has no stage for rotation of secret %s." % (token, arn))
+            raise ValueError(
+                "Secret version %s has no stage for rotation of secret %s." % (token, arn))
+        if "AWSCURRENT" in versions[token]:
+            logger.info(
+                "Secret version %s already set as AWSCURRENT for secret %s." % (token, arn))
+            return
+        elif "AWSPENDING" not in versions[token]:
+            logger.error(
+                "Secret version %s not set as AWSPENDING for rotation of secret %s." % (token, arn))
+            raise ValueError(
+                "Secret version %s not set as AWSPENDING for rotation of secret %s." % (token, arn))
 
 
-    # Call the appropriate step
-    if step == "createSecret":
-        create_secret(service_client, arn, token)
+        # Call the appropriate step
+        if step == "createSecret":
+            create_secret(service_client, arn, token, rotation)
+            rotation_contexts.save(rotation)
 
-    elif step == "setSecret":
-        set_secret(service_client, arn, token)
+        elif step == "setSecret":
+            set_secret(service_client, arn, token)
 
-    elif step == "testSecret":
-        test_secret(service_client, arn, token)
+        elif step == "testSecret":
+            test_secret(service_client, arn, token, rotation)
+            rotation_contexts.save(rotation)
 
-    elif step == "finishSecret":
-        finish_secret(service_client, arn, token)
+        elif step == "finishSecret":
+            finish_secret(service_client, arn, token, rotation)
+            rotation_contexts.discard(rotation)
 
-    else:
-        logger.error(
-            "lambda_handler: Invalid step parameter %s for secret %s" % (step, arn))
-        raise ValueError(
-            "Invalid step parameter %s for secret %s" % (step, arn))
+        else:
+            logger.error(
+                "lambda_handler: Invalid step parameter %s for secret %s" % (step, arn))
+            raise ValueError(
+                "Invalid step parameter %s for secret %s" % (step, arn))
 
+        if debug:
+            logger.info(f"Astra connection pool: {astra_pool.stats()}")
 
-def create_secret(service_client, arn, token):
+
+def create_secret(service_client, arn, token, rotation=None):
     """Generate a new Astra token
 
     This method first checks for the existence of a secret for the passed in token. If one does not exist, it will generate a
@@ -120,19 +361,22 @@ def create_secret(service_client, arn, token):
 
         token (string): The ClientRequestToken associated with the secret version
 
+        rotation (RotationContext): The context shared by the steps of this rotation, if any
+
     Raises:
         ValueError: If the current secret is not valid JSON
 
         KeyError: If the secret json does not contain the expected keys
 
     """
+    if rotation is None:
+        rotation = RotationContext(arn, token)
     # Get the current secret configuration
-    current_dict = get_secret_dict(service_client, arn, "AWSCURRENT")
+    current_dict = rotation.get_secret_dict(service_client, "AWSCURRENT")
     # Find the defined root arn
     root_arn = current_dict['rootarn']
     # Get the root secret configuration
-    root_dict = get_secret_dict(
-        service_client, root_arn, "AWSCURRENT", None, True)
+    root_dict = root_secret_cache.get(service_client, root_arn)
     # Get the root Astra key
     root_key = root_dict['astraKey']
     # Get the client ID for the current secret
@@ -140,27 +384,63 @@ def create_secret(service_client, arn, token):
 
     # Now try to get the secret version, if that fails, put a new secret
     try:
-        get_secret_dict(service_client, arn, "AWSPENDING", token)
+        rotation.get_secret_dict(service_client, "AWSPENDING", token)
         logger.info(f"createSecret: Successfully retrieved secret for {arn}.")
     except service_client.exceptions.ResourceNotFoundException:
-        # Get the roles for the AWSCURRENT configuration directly from Astra
-        roles = get_token_roles(root_key, current_clientID)
-        # Create a new Astra token using the root key, which mirrors the AWSCURRENT secret configuration
-        try:
-            new_clientId, new_secret, new_token = create_astra_token(
-                root_key, roles)
-            logger.info(
-                f"Sucessfully created token with clientID {new_clientId} to replace {current_clientID}")
-        except Exception:
-            raise Exception(f"Unable to create replacement token for {current_clientID}")
-        
-        # Create a new configuration based on the current one, then populate the new configuraiton items
-        new_dict = current_dict
-        new_dict['clientID'] = new_clientId
-        new_dict['clientSecret'] = new_secret
-        new_dict['astraKey'] = new_token
+        # An earlier attempt of this step in this container may have created the token but failed to store it
+        new_dict = rotation.created
+        if new_dict is not None:
+            logger.info(f"createSecret: Resuming with token {new_dict['clientID']} created by an earlier attempt")
+        else:
+            if rotation.metadata is None:
+                rotation.metadata = service_client.describe_secret(SecretId=arn)
+            roles = None
+            journal = get_rotation_journal(rotation.metadata, token)
+            if journal is not None:
+                # An earlier attempt in another container created a token whose value was never stored
+                journal_clientID, roles = journal
+                status = delete_astra_token(root_key, journal_clientID)
+                if status not in [200, 204, 404]:
+                    raise Exception(f"Unable to revoke token {journal_clientID} created by an earlier attempt. "
+                                    f"Received status {status}")
+                logger.info(f"createSecret: Revoked token {journal_clientID} created by an earlier attempt")
+            spare = None
+            if token_pool.enabled:
+                # Claim a spare token, already created and tested, instead of calling Astra
+                try:
+                    spare, roles = token_pool.claim(service_client, root_arn, root_key, current_clientID, roles)
+                except Exception:
+                    logger.exception("createSecret: Unable to claim a spare token, creating one instead")
+            if spare is not None:
+                new_clientId, new_secret, new_token = spare['clientID'], spare['clientSecret'], spare['astraKey']
+                rotation.claimed = new_clientId
+                logger.info(f"Claimed spare token with clientID {new_clientId} to replace {current_clientID}")
+            else:
+                if not roles:
+                    # Get the roles for the AWSCURRENT configuration directly from Astra
+                    roles = get_token_roles(root_key, current_clientID)
+                # Create a new Astra token using the root key, which mirrors the AWSCURRENT secret configuration
+                try:
+                    new_clientId, new_secret, new_token = create_astra_token(
+                        root_key, roles)
+                    logger.info(
+                        f"Sucessfully created token with clientID {new_clientId} to replace {current_clientID}")
+                except Exception:
+                    raise Exception(f"Unable to create replacement token for {current_clientID}")
+
+            # Create a new configuration based on the current one, then populate the new configuraiton items
+            new_dict = current_dict
+            new_dict['clientID'] = new_clientId
+            new_dict['clientSecret'] = new_secret
+            new_dict['astraKey'] = new_token
+            # Record the new token before storing it, so that a retry resumes instead of leaking it
+            rotation.created = new_dict
+            rotation_contexts.save(rotation)
+            put_rotation_journal(service_client, arn, token, new_clientId, roles)
         # Put the secret
-        service_client.put_secret_value(SecretId=arn, ClientRequestToken=token, SecretString=json.dumps(current_dict), VersionStages=['AWSPENDING'])
+        service_client.put_secret_value(SecretId=arn, ClientRequestToken=token, SecretString=json.dumps(new_dict), VersionStages=['AWSPENDING'])
+        rotation.created = None
+        rotation.put_secret_dict(token, new_dict)
         logger.info(f"createSecret: Successfully put secret for ARN {arn} and version {token}.")
 
 
@@ -171,11 +451,13 @@ def set_secret(service_client, arn, token):
     
 
 
-def test_secret(service_client, arn, token):
+def test_secret(service_client, arn, token, rotation=None):
     """Test the pending Astra token
 
     This method uses the newly created token that was storred in the AWSPENDING version from the create_secret
-    step to make a test API call to Astra.
+    step to make a test API call to Astra. While the token is rejected with 401 but exists in the client listing of
+    the organization, it has not propagated yet, and the call is made again (spaced by propagation_estimator)
+    until the token works or the deadline of the invocation is near.
 
     Args:
         service_client (client): The secrets manager service client
@@ -184,35 +466,66 @@ def test_secret(service_client, arn, token):
 
         token (string): The ClientRequestToken associated with the secret version
 
+        rotation (RotationContext): The context shared by the steps of this rotation, if any
+
     Raises:
         ResourceNotFoundException: If the secret with the specified arn and stage does not exist
 
         ValueError: If the secret is not valid JSON or pending credentials could not be used to login to the database
 
+        Exception: If the token does not exist in Astra, fails with another status, or does not work in time
+
         KeyError: If the secret json does not contain the expected keys
 
     """
-
-    # Get the current secret configuration
-    pending_dict = get_secret_dict(service_client, arn, "AWSPENDING")
+    if rotation is None:
+        rotation = RotationContext(arn, token)
+    # Get the pending secret configuration, which createSecret may already have stored in the context
+    pending_dict = rotation.get_secret_dict(service_client, "AWSPENDING")
     # Find the defined root arn
     pending_token = pending_dict['astraKey']
 
-    # Now try to get the secret version, if that fails, put a new secret
-    try:
-        status, reason, headers, data = make_API_request(pending_token, "GET", "/v2/currentOrg", body=None)
-
-        if status != 200:
+    # A new token answers 401 until it has propagated in Astra, so poll it until it authenticates. A token which
+    # is not in the client listing of the organization will never authenticate, and fails the test at once. A
+    # token claimed from the token pool authenticated when it was added to the pool, so it is known to exist.
+    started = time.monotonic()
+    limit = remaining_time()
+    if limit is None:
+        limit = astraPropagationMaxWait
+    exists = rotation.claimed is not None and rotation.claimed == pending_dict['clientID']
+    while True:
+        try:
+            status, reason, headers, data = make_API_request(pending_token, "GET", "/v2/currentOrg", body=None)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            raise Exception(f"Token test failed. Failure detail: {e}")
+        elapsed = time.monotonic() - started
+        if status == 200:
+            propagation_estimator.observe(elapsed)
+            rotation_metrics.record("AstraPropagationDelay", elapsed * 1000)
+            logger.info(f"Successfully tested new secret for {arn} after {elapsed:.2f}s.")
+            return
+        if status != 401:
             raise Exception(f"Token test failed. Failure detail: {data}")
-        else:
-            logger.info(f"Successfully tested new secret for {arn}.")
-
-    except Exception:
-        raise Exception("Token test failed with no details.")
-
-
-
-def finish_secret(service_client, arn, token):
+        if not exists and 'rootarn' in pending_dict:
+            root_key = root_secret_cache.get(service_client, pending_dict['rootarn'])['astraKey']
+            # The client index already has the tokens created or listed recently, the listing is only scanned
+            # when it misses
+            if not client_index.contains(root_key, pending_dict['clientID']) and \
+                    find_astra_client(root_key, pending_dict['clientID']) is None:
+                raise Exception(f"Token test failed. Client ID {pending_dict['clientID']} does not exist in Astra")
+            exists = True
+        # The last poll is made just before the limit rather than given up
+        delay = min(propagation_estimator.next_delay(elapsed), limit - elapsed - astraPropagationMinPoll)
+        if delay <= 0:
+            raise Exception(f"Token test failed. Token {pending_dict['clientID']} did not authenticate within "
+                            f"{elapsed:.1f}s, it may not have propagated yet")
+        logger.info(f"New token {pending_dict['clientID']} not propagated yet, testing again in {delay:.2f}s")
+        time.sleep(delay)
+
+
+def finish_secret(service_client, arn, token, rotation=None):
     """Finish the rotation by marking the pending secret as current
 
     This method moves the secret from the AWSPENDING stage to the AWSCURRENT stage.
@@ -224,19 +537,22 @@ def finish_secret(service_client, arn, token):
 
         token (string): The ClientRequestToken associated with the secret version
 
+        rotation (RotationContext): The context shared by the steps of this rotation, if any
+
     Raises:
         ResourceNotFoundException: If the secret with the specified arn and stage does not exist
 
     """
+    if rotation is None:
+        rotation = RotationContext(arn, token)
 
     ###### Delete the old Astra Token 
     # First getting current secret configuration
-    current_dict = get_secret_dict(service_client, arn, "AWSCURRENT")
+    current_dict = rotation.get_secret_dict(service_client, "AWSCURRENT")
     # Grab the root ARN
     root_arn = current_dict['rootarn']
     # Get the root secret configuration
-    root_dict = get_secret_dict(
-        service_client, root_arn, "AWSCURRENT", None, True)
+    root_dict = root_secret_cache.get(service_client, root_arn)
     # Get the root Astra key
     root_key = root_dict['astraKey']
     # Get the clientID to delete
@@ -244,7 +560,10 @@ def finish_secret(service_client, arn, token):
     # And finally delete it
 
     status = delete_astra_token(root_key, clientID)
-    if status not in [200, 204]:
+    if status == 404:
+        # Deleted by an earlier attempt of this step, or by a retried request whose first response was lost
+        logger.info(f"Old token {clientID} was already deleted")
+    elif status not in [200, 204]:
         raise Exception(f"Failed to delete old token {clientID}. Recieved status {status}")
     else:
         logger.info(f"Successfully deleted old token {clientID}")
@@ -252,8 +571,10 @@ def finish_secret(service_client, arn, token):
 
 
     ###### Now we can set the pending version to current 
-    # First describe the secret to get the current version
-    metadata = service_client.describe_secret(SecretId=arn)
+    # First describe the secret to get the current version, unless lambda_handler already did
+    metadata = rotation.metadata
+    if metadata is None:
+        metadata = service_client.describe_secret(SecretId=arn)
     current_version = None
     for version in metadata["VersionIdsToStages"]:
         if "AWSCURRENT" in metadata["VersionIdsToStages"][version]:
@@ -266,6 +587,8 @@ def finish_secret(service_client, arn, token):
 
     # Finalize by staging the secret version current
     service_client.update_secret_version_stage(SecretId=arn, VersionStage="AWSCURRENT", MoveToVersionId=token, RemoveFromVersionId=current_version)
+    # If this secret is itself a root secret, the cached version has just been deleted from Astra
+    root_secret_cache.invalidate(arn)
     logger.info("finishSecret: Successfully set AWSCURRENT stage to version %s for secret %s." % (token, arn))
 
 
@@ -273,6 +596,7 @@ def finish_secret(service_client, arn, token):
 
 
 
+
 def get_secret_dict(service_client, arn, stage, token=None, root_secret=False):
     """Gets the secret dictionary corresponding for the secret arn, stage, and token
     This helper function gets credentials for the arn and stage passed in and returns the dictionary by parsing the JSON string
@@ -289,9 +613,6 @@ def get_secret_dict(service_client, arn, stage, token=None, root_secret=False):
         ValueError: If the secret is not valid JSON    
     """
 
-    required_fields = ['astraKey', 'clientID',
-                       'clientSecret', 'engine']
-
     # Only do VersionId validation against the stage if a token is passed in
     if token:
         secret = service_client.get_secret_value(
@@ -300,7 +621,26 @@ def get_secret_dict(service_client, arn, stage, token=None, root_secret=False):
     else:
         secret = service_client.get_secret_value(
             SecretId=arn, VersionStage=stage)
-    plaintext = secret['SecretString']
+
+    # Parse and return the secret JSON string
+    return parse_secret_dict(secret['SecretString'], root_secret)
+
+
+def parse_secret_dict(plaintext, root_secret=False):
+    """Parses and validates the JSON string of an Astra secret
+    Args:
+        plaintext (string): The SecretString of the secret version
+        root_secret (boolean): A flag that indicates if this is a root secret, which does not need a rootarn.
+    Returns:
+        SecretDictionary: Secret dictionary
+    Raises:
+        ValueError: If the secret is not valid JSON
+        KeyError: If the secret json does not contain the expected keys, or is not an Astra secret
+    """
+
+    required_fields = ['astraKey', 'clientID',
+                       'clientSecret', 'engine']
+
     secret_dict = json.loads(plaintext)
 
     # If not a root secret, require the arn for the root secret
@@ -315,10 +655,46 @@ def get_secret_dict(service_client, arn, stage, token=None, root_secret=False):
         raise KeyError(
             "Database engine must be set to 'Astra' in order to use this rotation lambda")
 
-    # Parse and return the secret JSON string
     return secret_dict
 
 
+def get_rotation_journal(metadata, token):
+    """Reads the token creation journal of a secret
+
+    Args:
+        metadata (dict): The DescribeSecret response of the secret
+
+        token (string): The ClientRequestToken of the rotation
+
+    Returns:
+        a tuple of the client ID of the token created for this rotation and its roles (None when they were not
+        recorded), or None when no token was recorded for this rotation
+    """
+    for tag in metadata.get('Tags', []):
+        if tag['Key'] == rotationJournalTag:
+            fields = tag['Value'].split()
+            if len(fields) >= 2 and fields[0] == token:
+                return fields[1], fields[2:] or None
+    return None
+
+
+def put_rotation_journal(service_client, arn, token, clientID, roles):
+    """Records the token created for a rotation in a tag of the secret, before its value is stored
+
+    The tag holds the ClientRequestToken, the client ID and, when they fit in a tag value, the roles of the
+    token. It is only used by a retry of createSecret with the same ClientRequestToken, so the tag of an
+    earlier rotation needs no cleanup. Failing to write the journal (e.g. without secretsmanager:TagResource
+    permission) is logged and does not fail the rotation.
+    """
+    value = " ".join([token, clientID] + list(roles))
+    if len(value) > 256 or not all(re.fullmatch(r"[\w.:/=+@-]+", role) for role in roles):
+        value = f"{token} {clientID}"
+    try:
+        service_client.tag_resource(SecretId=arn, Tags=[{'Key': rotationJournalTag, 'Value': value}])
+    except Exception as e:
+        logger.warning(f"createSecret: Unable to record token {clientID} in the journal of {arn}: {e}")
+
+
 def delete_astra_token(root_key, clientID):
     """The delete_astra_token function is used to delete a token associated 
     with a particular client ID in Astra. The function takes two arguments:
@@ -327,9 +703,9 @@ def delete_astra_token(root_key, clientID):
         root_key: a string representing the root key used for authentication with the Astra API.
         clientID: a string representing the ID of the client whose token needs to be deleted.
     
-    The function first establishes an HTTPS connection to the Astra API using the 
-    api.astra.datastax.com endpoint. It then constructs the API endpoint for deleting
-    the client's token by appending the clientID to the base path /v2/clientIdSecrets/.
+    The function constructs the API endpoint for deleting the client's token by appending
+    the clientID to the base path /v2/clientIdSecrets/, and sends the request through the
+    shared Astra connection pool.
 
     The response from the make_API_request function is then unpacked into four variables:
     status, reason, headers, and data. 
@@ -339,12 +715,13 @@ def delete_astra_token(root_key, clientID):
         token deletion was successful or not.
 
     """
-    conn = http.client.HTTPSConnection("api.astra.datastax.com")
     payload = ''
     endpoint = f"/v2/clientIdSecrets/{clientID}"
     status, reason, headers, data = make_API_request(
         root_key, "DELETE", endpoint, payload
     )
+    if status in [200, 204, 404]:
+        client_index.discard(root_key, clientID)
 
     return status
 
@@ -357,9 +734,8 @@ def create_astra_token(root_key, roles):
         root_key: a string representing the root key used for authentication with the Astra API.
         roles: a list of strings representing the roles that the token should be granted access to.
 
-    The function begins by establishing an HTTPS connection to the Astra API using the 
-    api.astra.datastax.com endpoint. The payload variable is then defined, which contains a JSON
-    object representing the roles that the token should be granted access to.
+    The payload variable is defined first, which contains a JSON object representing the roles
+    that the token should be granted access to.
 
     The make_API_request function is called with the root_key, "POST" HTTP method,
     /v2/clientIdSecrets endpoint, and payload as arguments. The response from the 
@@ -370,7 +746,6 @@ def create_astra_token(root_key, roles):
         a tuple containing the clientId, secret, and token values as its output. These values can be used 
         to authenticate with the Astra API and perform authorized actions on the platform.
     """
-    conn = http.client.HTTPSConnection("api.astra.datastax.com")
     payload = json.dumps({
         "roles":
         roles
@@ -378,6 +753,8 @@ def create_astra_token(root_key, roles):
 
     status, reason, headers, data = make_API_request(
         root_key, "POST", "/v2/clientIdSecrets", payload)
+    # Keep the shared index current, so that rotating the new token does not need a fresh listing
+    client_index.add(root_key, data["clientId"], roles)
 
     return data["clientId"], data["secret"], data["token"]
 
@@ -390,30 +767,177 @@ def get_token_roles(root_key, clientID):
         root_key: a string representing the root key used for authentication with the Astra API.
         clientID: a string representing the ID of the client whose roles need to be retrieved.
 
-    The function first calls the make_API_request function with the root_key, "GET" HTTP method
-    /v2/clientIdSecrets endpoint, and None as the request body.
+    The roles are looked up in the module level client_index, a clientId to roles index built from a single
+    GET /v2/clientIdSecrets listing and shared by every rotation in the process. The index is rebuilt when it
+    is older than clientIndexTTL seconds, or when the clientID is not found in it.
 
-    The response from the make_API_request function is then unpacked into four variables:
-    status, reason, headers, and data. The data variable contains a dictionary with a key
-    clients that represents a list of all client IDs and their associated roles.
+    Returns:
+        the list of roles associated with the specified clientID.
 
-    The function then loops through the list of clients to find the one with the matching clientID.
-    Once the client is found, the roles associated with that client are extracted and stored in a variable.
+    Raises:
+        KeyError: If no client with the clientID exists in Astra
+    """
+    return client_index.get_roles(root_key, clientID)
 
-    Finally, the function returns the roles associated with the specified clientID. 
+
+def iter_astra_clients(root_key):
+    """ The iter_astra_clients function yields the clients of the organization one at a time.
+
+    Args:
+        root_key: a string representing the root key used for authentication with the Astra API.
+
+    The GET /v2/clientIdSecrets response is parsed incrementally, astraStreamChunkSize bytes at a time, as it is
+    read from the socket, so memory use does not grow with the size of the organization. Closing the generator
+    early (e.g. by breaking out of a loop over it) stops reading the response and closes its connection.
+
+    Yields:
+        each client of the listing, a dictionary with (at least) clientId and roles keys.
+
+    Raises:
+        Exception: If Astra does not return the listing
+        ValueError: If the listing is not valid JSON
     """
-    # Make the API call to get the list of secrets
     status, reason, headers, data = make_API_request(
-        root_key, "GET", "/v2/clientIdSecrets", body=None)
-    # find and return the roles for the given clientId
-    for client in data['clients']:
-        if client['clientId'] == clientID:
-            roles = client['roles']
-            break
-    return roles
+        root_key, "GET", "/v2/clientIdSecrets", body=None, stream=True)
+    if status != 200:
+        raise Exception(f"Unable to list Astra clients. Received status {status} {reason}")
+    with data:
+        yield from JSONStreamParser(data).items('clients')
 
 
-def make_API_request(root_key, method, path, body=None):
+def find_astra_client(root_key, clientID):
+    """ The find_astra_client function looks up one client in the listing of the organization.
+
+    Args:
+        root_key: a string representing the root key used for authentication with the Astra API.
+        clientID: a string representing the ID of the client to find.
+
+    The listing is streamed, and reading it stops as soon as the client is found.
+
+    Returns:
+        the client dictionary, or None when no client with the clientID exists in Astra.
+    """
+    clients = iter_astra_clients(root_key)
+    try:
+        for client in clients:
+            if client['clientId'] == clientID:
+                return client
+    finally:
+        clients.close()
+    return None
+
+
+class JSONStreamParser:
+    """Incremental parser of a JSON document read from a binary stream
+
+    Only the structure leading to the values of interest is parsed by hand; each value is then decoded with
+    json.JSONDecoder.raw_decode from a buffer holding little more than one chunk of the stream, so the document
+    is never held in memory as a whole.
+
+    Args:
+        stream: a binary file-like object with a read(size) method
+        chunk_size: the number of bytes read from the stream at a time
+    """
+
+    _whitespace = re.compile(r'[ \t\n\r]*')
+    _number_tail = re.compile(r'[0-9.eE+-]*')
+
+    def __init__(self, stream, chunk_size=astraStreamChunkSize):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _more(self):
+        if self._eof:
+            raise ValueError("Unexpected end of the JSON document")
+        chunk = self.stream.read(self.chunk_size)
+        self._eof = not chunk
+        # Drop what was parsed already, so the buffer does not grow with the document
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(chunk, final=self._eof)
+        self._pos = 0
+
+    def _peek(self):
+        """Skips whitespace and returns the next character"""
+        while True:
+            self._pos = self._whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            self._more()
+
+    def _expect(self, characters):
+        character = self._peek()
+        if character not in characters:
+            raise ValueError(f"Expected one of {characters!r} in the JSON document, found {character!r}")
+        self._pos += 1
+        return character
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # The value may continue in the next chunk
+                if self._eof:
+                    raise
+                self._more()
+                continue
+            if not self._eof and self._number_tail.match(self._buffer, end).end() == len(self._buffer):
+                # So may a number which ends with the buffer, or whose fraction or exponent was cut by its end
+                self._more()
+                continue
+            self._pos = end
+            return value
+
+    def _end(self):
+        """Reads the stream to its end, which may only hold whitespace after the document"""
+        while True:
+            self._pos = self._whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                raise ValueError("Extra data after the JSON document")
+            if self._eof:
+                return
+            self._more()
+
+    def items(self, key):
+        """Yields the items of the array under key in the top-level object of the document
+
+        Raises:
+            KeyError: If the top-level object has no such key
+            ValueError: If the document is not valid JSON
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            raise KeyError(key)
+        found = False
+        while True:
+            name = self._value()
+            self._expect(':')
+            if name == key and not found:
+                found = True
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self._value()
+            if self._expect(',}') == '}':
+                break
+        if not found:
+            raise KeyError(key)
+        # A response read to its end gives its connection back to the pool
+        self._end()
+
+
+def make_API_request(root_key, method, path, body=None, max_attempts=None, stream=False):
     """The make_API_request function is a helper function used to make HTTP requests to the Astra API. 
     
     Args:
@@ -422,35 +946,1108 @@ def make_API_request(root_key, method, path, body=None):
         method: a string representing the HTTP method to be used for the request (e.g. "GET", "POST", "PUT", "DELETE").
         path: a string representing the path to the endpoint being requested (e.g. /v2/clientIdSecrets).
         body: an optional parameter that can be used to include a JSON payload in the request.
+        max_attempts: the maximum number of attempts, astraAPImaxAttempts by default.
+        stream: when True, the body of a 200 response is not read nor parsed. data is then an AstraResponseStream,
+            which must be closed once read to give its connection back to the pool.
 
     The function begins by defining the headers for the HTTP request. These headers include the Content-Type
     and Authorization headers, where the Authorization header includes the root_key for authentication.
 
-    The function then establishes an HTTPS connection to the Astra API using the astraAPIhost endpoint.
-    The HTTP request is made with the specified method, path, body, and headers.
+    The request is then sent through the module level astra_pool, which reuses a keep-alive HTTPS connection
+    to the astraAPIhost endpoint when one is idle, and opens (and resumes the TLS session of) a new one when not.
+    Connections are kept open across calls and across warm Lambda invocations.
+
+    Requests which fail with a transient error (a connection error, 429 or 5xx) are retried with exponential
+    backoff and jitter, honoring Retry-After, as long as retry_delay allows it for the method and the shared
+    astra_retry_budget is not exhausted. Otherwise the last response is returned, or the last error raised.
+
+    Connecting and waiting for the response time out after astraAPIconnectTimeout and astraAPIreadTimeout
+    seconds, or when the deadline of the Lambda invocation comes first. No attempt is started, and no retry
+    waited for, past the deadline; DeadlineExceeded is raised when the first attempt can not be made.
+
+    When Astra answers 401 to a root key handed out by root_secret_cache, whose root secret was rotated by another
+    container since it was cached, the request is made again once with the new root key.
 
     Once the response is received, the function retrieves the HTTP status code, reason phrase, headers,
     and response body. If the response body contains data, it is loaded into a Python dictionary using 
-    the json.loads method. If the response body is empty, the data variable is set to an empty string.
+    the json.loads method, or kept as text when it is not JSON (e.g. the HTML error page of a proxy). If the
+    response body is empty, the data variable is set to an empty string.
 
-    Finally, the HTTPS connection is closed and the function returns a tuple containing the 
-    status, reason, headers, and data variables as its output. This function can be used as a helper
-    function for making HTTP requests to the Astra API from other functions.
+    Finally, the function returns a tuple containing the status, reason, headers, and data variables as
+    its output. This function can be used as a helper function for making HTTP requests to the Astra API
+    from other functions.
     """
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {root_key}',
     }
-    conn = http.client.HTTPSConnection(astraAPIhost)
-    conn.request(method, path, body, headers)
-    response = conn.getresponse()
-    status = response.status
-    reason = response.reason
-    headers = response.getheaders()
-    content = response.read()
-    if content:
-        data = json.loads(content.decode("utf-8"))
+    if max_attempts is None:
+        max_attempts = astraAPImaxAttempts
+    astra_retry_budget.deposit()
+    attempt = 1
+    while True:
+        error = None
+        started = time.monotonic()
+        timeouts = (call_timeout(astraAPIconnectTimeout, f"{method} {path}"),
+                    call_timeout(astraAPIreadTimeout, f"{method} {path}"))
+        try:
+            status, reason, response_headers, content = astra_pool.request(method, path, body, headers, timeouts,
+                                                                           stream)
+        except (OSError, http.client.HTTPException) as e:
+            error = e
+            status, response_headers, content = None, [], b''
+        rotation_metrics.record_astra_request(method, path, started, status, body, content)
+        delay = retry_delay(method, attempt, status, response_headers, error)
+        remaining = remaining_time()
+        if delay is not None and remaining is not None and delay >= remaining:
+            # The retry could not be made before the deadline
+            delay = None
+        if delay is None or attempt >= max_attempts or not astra_retry_budget.withdraw():
+            if error is not None:
+                raise error
+            break
+        rotation_metrics.count("AstraRetries", Endpoint=astra_endpoint_name(method, path))
+        logger.info(f"Retrying {method} {path} in {delay:.2f}s after attempt {attempt} failed with "
+                    f"{error if error is not None else status}")
+        time.sleep(delay)
+        attempt += 1
+
+    if status == 401:
+        # A cached root key rotated away by another container is replaced, and the request made again once
+        new_key = root_secret_cache.replacement(root_key)
+        if new_key is not None:
+            logger.info(f"Retrying {method} {path} with the new root key")
+            return make_API_request(new_key, method, path, body, max_attempts, stream)
+
+    if isinstance(content, AstraResponseStream):
+        data = content
     else:
-        data = ''
-    conn.close()
-    return status, reason, headers, data
+        data = decode_API_body(content)
+    return status, reason, response_headers, data
+
+
+def decode_API_body(content):
+    """Returns the JSON document of an Astra API response body, the body as text when it is not JSON, or an
+    empty string when the body is empty"""
+    if not content:
+        return ''
+    text = content.decode("utf-8", "replace")
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def retry_delay(method, attempt, status, headers, error=None):
+    """Decides whether a failed Astra API request is retried, and after how long
+
+    GET, PUT and DELETE requests are idempotent, so they are retried after connection errors and after the
+    statuses in astraAPIretryStatuses. A POST (which creates a token) is only retried when it can not have been
+    processed: when it was rejected with 429, or when no connection could be established to send it.
+
+    Args:
+        method: the HTTP method of the request
+        attempt: the number of attempts made so far
+        status: the status of the response, or None when the request failed with an error
+        headers: the list of response headers
+        error: the exception raised by the request, if any
+
+    Returns:
+        the number of seconds to wait before retrying, or None if the request must not be retried
+    """
+    idempotent = method in astraAPIidempotentMethods
+    if error is not None:
+        if not idempotent and not isinstance(error, AstraConnectionError):
+            return None
+    elif status not in astraAPIretryStatuses or (not idempotent and status != 429):
+        return None
+
+    delay = random.uniform(0, min(astraAPIbackoffMax, astraAPIbackoffBase * 2 ** (attempt - 1)))
+    retry_after = next((value for name, value in headers if name.lower() == 'retry-after'), None)
+    if retry_after is not None:
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                wait = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                wait = 0
+        if wait > astraAPIretryAfterMax:
+            return None
+        delay = max(delay, wait)
+    return delay
+
+
+class RetryBudget:
+    """Process wide budget which bounds Astra API retries to a fraction of the requests
+
+    Every request deposits ratio of a token and every retry withdraws a whole one, so that a sustained outage
+    can not multiply the load on the API by max_attempts. The balance never drops below zero nor exceeds
+    minimum + ratio * 100, and starts at minimum so that isolated failures can always be retried.
+    """
+
+    def __init__(self, ratio=astraAPIretryBudgetRatio, minimum=astraAPIretryBudgetMin):
+        self.ratio = ratio
+        self.cap = minimum + ratio * 100
+        self.balance = minimum
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.cap, self.balance + self.ratio)
+
+    def withdraw(self):
+        """Returns True and spends a token when a retry is allowed"""
+        with self._lock:
+            if self.balance < 1:
+                self.exhausted += 1
+                return False
+            self.balance -= 1
+            self.retries += 1
+            return True
+
+
+astra_retry_budget = RetryBudget()
+
+
+class AstraConnectionError(ConnectionError):
+    """Raised when no connection could be established to the Astra API, so the request was never sent"""
+
+
+class _AstraHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection which resumes the last TLS session negotiated by its pool"""
+
+    def __init__(self, pool):
+        super().__init__(pool.host, context=pool.ssl_context or get_ssl_context())
+        self.pool = pool
+        self.released_at = None
+
+    def connect(self):
+        # Same as http.client.HTTPSConnection.connect, with session resumption
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host if self._tunnel_host else self.host
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=server_hostname, session=self.pool.tls_session)
+
+
+class AstraConnectionPool:
+    """Keep-alive pool of HTTPS connections to the Astra DevOps API
+
+    When no ssl_context is given, the shared one from get_ssl_context is used, so that building the pool
+    does not load the CA certificates at import time.
+
+    Idle connections are reused last-in first-out, so the most recently used (and most likely still open)
+    socket is picked first. An idle socket which is readable has been closed by the server (or holds data no
+    request asked for), and is dropped instead of being reused. A reused connection that still turns out to have
+    been closed by the server is replaced by a fresh one and the request is sent again, once, unless it was
+    sent and is not idempotent.
+
+    Attributes:
+        hits: number of requests served by an idle pooled connection
+        misses: number of requests which had to open a new connection
+        reconnects: number of reused connections found closed by the server
+    """
+
+    def __init__(self, host, max_idle=astraAPImaxIdle, idle_timeout=astraAPIidleTimeout, ssl_context=None):
+        self.host = host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self.tls_session = None
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if now - conn.released_at < self.idle_timeout and not self._at_eof(conn):
+                    self.hits += 1
+                    return conn, True
+                conn.close()
+            self.misses += 1
+        return _AstraHTTPSConnection(self), False
+
+    @staticmethod
+    def _at_eof(conn):
+        # An idle socket has nothing to read until the server closes it (with a TLS close_notify or a FIN)
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _release(self, conn):
+        if conn.sock is not None and conn.sock.session is not None:
+            self.tls_session = conn.sock.session
+        conn.released_at = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, path, body=None, headers=None, timeouts=None, stream=False):
+        """Send a request over a pooled connection
+
+        Args:
+            method: the HTTP method
+            path: the request path
+            body: optional request body
+            headers: optional dictionary of request headers
+            timeouts: optional tuple of the connect and read timeouts, in seconds
+            stream: when True, the body of a 200 response is left unread, and returned as an AstraResponseStream
+                which holds the connection until it is closed
+
+        Returns:
+            a tuple of the status, reason, response headers and raw response body
+        """
+        connect_timeout, read_timeout = timeouts or (None, None)
+        conn, reused = self._acquire()
+        sent = False
+        try:
+            try:
+                if not reused:
+                    self._connect(conn, connect_timeout)
+                conn.sock.settimeout(read_timeout)
+                conn.request(method, path, body, headers or {})
+                sent = True
+                response = conn.getresponse()
+            except (ConnectionResetError, BrokenPipeError, ssl.SSLEOFError, ssl.SSLZeroReturnError):
+                # RemoteDisconnected is a ConnectionResetError, and the SSL errors are raised when the TLS session
+                # was shut down: the server closed an idle socket. Once the request was sent, the server may have
+                # processed it before closing, so only idempotent requests are sent again.
+                if not reused or (sent and method not in astraAPIidempotentMethods):
+                    raise
+                conn.close()
+                with self._lock:
+                    self.reconnects += 1
+                conn = _AstraHTTPSConnection(self)
+                self._connect(conn, connect_timeout)
+                conn.sock.settimeout(read_timeout)
+                conn.request(method, path, body, headers or {})
+                response = conn.getresponse()
+            if stream and response.status == 200:
+                return response.status, response.reason, response.getheaders(), \
+                    AstraResponseStream(self, conn, response, astra_endpoint_name(method, path))
+            content = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return response.status, response.reason, response.getheaders(), content
+
+    def _connect(self, conn, timeout=None):
+        conn.timeout = timeout
+        try:
+            conn.connect()
+        except OSError as e:
+            conn.close()
+            raise AstraConnectionError(f"Unable to connect to {self.host}: {e}") from e
+
+    def stats(self):
+        """Returns a dictionary with the pool hit, miss and reconnect counts"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects,
+                'idle': len(self._idle),
+            }
+
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class AstraResponseStream:
+    """Body of a streamed Astra API response, read from its pooled connection
+
+    Closing the stream gives the connection back to the pool when the body was read to the end, and closes it
+    otherwise, since the rest of the body would still be waiting on the socket.
+    """
+
+    def __init__(self, pool, conn, response, endpoint):
+        self.pool = pool
+        self.endpoint = endpoint
+        self.bytes_read = 0
+        self._conn = conn
+        self._response = response
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, size=-1):
+        chunk = self._response.read(None if size < 0 else size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self.pool._release(self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+        rotation_metrics.record("AstraResponseBytes", self.bytes_read, "Bytes", Endpoint=self.endpoint)
+
+
+astra_pool = AstraConnectionPool(astraAPIhost)
+
+
+class RootSecretCache:
+    """Version aware cache of root secrets
+
+    Root secrets are shared by every secret which points at them through rootarn, so they are fetched through
+    a SecretCache from the aws_secretsmanager_caching package. It only checks the AWSCURRENT version of the
+    root secret with DescribeSecret once per ttl, and fetches the secret value again (by VersionId) when that
+    version has changed. Only the public SecretCache.get_secret_string is used, and the parsed and validated
+    dictionary is memoized by root ARN and a digest of the secret string, which changes with the version.
+
+    When aws_secretsmanager_caching is not installed (e.g. when only lambda_function.py is deployed), every
+    call falls back to get_secret_dict.
+
+    A root secret rotated by another container is only seen here at the next check, so Astra may reject the
+    cached root key with 401 until then. make_API_request asks replacement for the current key in that case,
+    which fetches the root secret again at once.
+    """
+
+    def __init__(self, ttl=rootSecretCacheTTL, recheck_interval=rootKeyRecheckInterval):
+        self.ttl = ttl
+        self.recheck_interval = recheck_interval
+        self._secret_caches = {}
+        self._parsed = {}
+        self._sources = {}
+        self._replaced = {}
+        self._unreplaced = {}
+        self._lock = threading.Lock()
+        self._replace_lock = threading.Lock()
+        self._caching = None
+
+    @staticmethod
+    def _key_digest(root_key):
+        # The root keys handed out are tracked by digest, so that the cache does not hold on to old keys
+        return hashlib.sha256(root_key.encode("utf-8")).hexdigest()
+
+    def _get_secret_cache(self, service_client, root_arn):
+        # aws_secretsmanager_caching imports botocore, so it is only imported once a root secret is needed
+        if self._caching is None:
+            try:
+                import aws_secretsmanager_caching
+                self._caching = aws_secretsmanager_caching
+            except ImportError:
+                logger.info("aws_secretsmanager_caching is not installed, root secrets will not be cached")
+                self._caching = False
+        if not self._caching:
+            return None
+        key = (service_client, root_arn)
+        with self._lock:
+            if key not in self._secret_caches:
+                config = self._caching.SecretCacheConfig(secret_refresh_interval=self.ttl)
+                self._secret_caches[key] = self._caching.SecretCache(config=config, client=service_client)
+            return self._secret_caches[key]
+
+    def get(self, service_client, root_arn):
+        """Gets the AWSCURRENT root secret dictionary for the root arn
+
+        Args:
+            service_client (client): The secrets manager service client
+            root_arn (string): The ARN of the root secret
+        Returns:
+            SecretDictionary: A copy of the cached root secret dictionary
+        Raises:
+            ResourceNotFoundException: If the root secret does not exist
+            ValueError: If the root secret is not valid JSON or has no AWSCURRENT version
+            KeyError: If the root secret json does not contain the expected keys
+        """
+        secret_cache = self._get_secret_cache(service_client, root_arn)
+        if secret_cache is None:
+            secret_dict = get_secret_dict(service_client, root_arn, "AWSCURRENT", None, True)
+            self._track(service_client, root_arn, secret_dict)
+            return secret_dict
+
+        secret_string = secret_cache.get_secret_string(root_arn, "AWSCURRENT")
+        if secret_string is None:
+            raise ValueError("Root secret %s has no AWSCURRENT version" % root_arn)
+        key = (root_arn, hashlib.sha256(secret_string.encode("utf-8")).hexdigest())
+        with self._lock:
+            secret_dict = self._parsed.get(key)
+        if secret_dict is None:
+            secret_dict = parse_secret_dict(secret_string, True)
+            with self._lock:
+                # Only the current version of each root secret is worth keeping
+                for stale in [k for k in self._parsed if k[0] == root_arn]:
+                    del self._parsed[stale]
+                self._parsed[key] = secret_dict
+            self._track(service_client, root_arn, secret_dict)
+        return dict(secret_dict)
+
+    def _track(self, service_client, root_arn, secret_dict):
+        with self._lock:
+            self._sources[self._key_digest(secret_dict['astraKey'])] = (service_client, root_arn)
+
+    def replacement(self, root_key):
+        """Returns the current key of the root secret of a root key which Astra rejected
+
+        The root secret is fetched again, bypassing the cache. Keys replaced once are remembered, so that
+        callers still holding the old key only cost one fetch in all. A key found to still be current is not
+        fetched again for recheck_interval seconds, so that a burst of 401 with it costs one fetch too.
+
+        Returns:
+            the new root key, or None when root_key is not a root key handed out by this cache, or is still
+            the current key of its root secret
+        """
+        digest = self._key_digest(root_key)
+        with self._replace_lock:
+            with self._lock:
+                if digest in self._replaced:
+                    return self._replaced[digest]
+                if time.monotonic() - self._unreplaced.get(digest, -math.inf) < self.recheck_interval:
+                    return None
+                source = self._sources.get(digest)
+            if source is None:
+                return None
+            service_client, root_arn = source
+            self.invalidate(root_arn)
+            new_key = self.get(service_client, root_arn)['astraKey']
+            if new_key == root_key:
+                with self._lock:
+                    self._unreplaced[digest] = time.monotonic()
+                return None
+            with self._lock:
+                self._sources.pop(digest, None)
+                self._unreplaced.pop(digest, None)
+                self._replaced[digest] = new_key
+            logger.info(f"Root secret {root_arn} was rotated, using its new key")
+            return new_key
+
+    def invalidate(self, root_arn):
+        """Drops the cached versions of a root secret, so that the next get fetches it again"""
+        with self._lock:
+            for key in [k for k in self._secret_caches if k[1] == root_arn]:
+                del self._secret_caches[key]
+            for key in [k for k in self._parsed if k[0] == root_arn]:
+                del self._parsed[key]
+
+
+root_secret_cache = RootSecretCache()
+
+
+class AstraClientIndex:
+    """Index of Astra clientId to roles, built from one listing per root key
+
+    Each root key (i.e. each organization) gets its own index, built from a single iter_astra_clients call and
+    shared by every lookup in the process until it is older than ttl seconds. A lookup for a clientId which is
+    not in the index rebuilds it once, in case the client was created after the listing. Rebuilds are
+    serialized, so concurrent rotations missing at the same time share a single listing.
+    """
+
+    def __init__(self, ttl=clientIndexTTL):
+        self.ttl = ttl
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @staticmethod
+    def _key(root_key):
+        # Keyed by a digest, so that the index does not hold on to the root keys themselves
+        return hashlib.sha256(root_key.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key, clientID):
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None or time.monotonic() - index['built'] >= self.ttl:
+                return None, None
+            return index['built'], index['roles'].get(clientID)
+
+    def refresh(self, root_key, built_before=None):
+        """Rebuilds the index of a root key from a new listing
+
+        Args:
+            root_key: the root key used for authentication with the Astra API.
+            built_before: only rebuild when the current index was built before this time.monotonic() value,
+                which lets concurrent callers that missed on the same index share one rebuild.
+        """
+        key = self._key(root_key)
+        with self._refresh_lock:
+            with self._lock:
+                index = self._indexes.get(key)
+            if index is not None and built_before is not None and index['built'] > built_before:
+                return
+            started = time.monotonic()
+            roles = {client['clientId']: client['roles'] for client in iter_astra_clients(root_key)}
+            with self._lock:
+                self._indexes[key] = {'built': started, 'roles': roles}
+            logger.info(f"Indexed {len(roles)} Astra clients")
+
+    def get_roles(self, root_key, clientID):
+        """Returns the roles of a clientId, rebuilding the index once when it is stale or misses
+
+        Raises:
+            KeyError: If no client with the clientID exists in Astra
+        """
+        key = self._key(root_key)
+        started = time.monotonic()
+        built, roles = self._lookup(key, clientID)
+        if roles is None:
+            # A stale or missing index is not looked up, so any index built since this call started will do
+            self.refresh(root_key, built_before=started if built is None else built)
+            built, roles = self._lookup(key, clientID)
+        if roles is None:
+            raise KeyError(f"Client ID {clientID} does not exist in Astra")
+        return list(roles)
+
+    def contains(self, root_key, clientID):
+        """Returns whether the current index of a root key has a clientId, without listing the clients"""
+        built, roles = self._lookup(self._key(root_key), clientID)
+        return roles is not None
+
+    def add(self, root_key, clientID, roles):
+        """Records a client created after the index was built"""
+        with self._lock:
+            index = self._indexes.get(self._key(root_key))
+            if index is not None:
+                index['roles'][clientID] = list(roles)
+
+    def discard(self, root_key, clientID):
+        """Forgets a deleted client"""
+        with self._lock:
+            index = self._indexes.get(self._key(root_key))
+            if index is not None:
+                index['roles'].pop(clientID, None)
+
+
+client_index = AstraClientIndex()
+
+
+class PropagationEstimator:
+    """Plans the polling of new tokens from the propagation delays observed in the warm container
+
+    The estimate is a moving average of the time new tokens took to authenticate. Polls are first spaced to
+    land when the estimate says the token should work, then back off exponentially with jitter.
+    """
+
+    def __init__(self, initial=astraPropagationInitial, weight=0.3):
+        self.estimate = initial
+        self.weight = weight
+        self.observations = 0
+
+    def observe(self, delay):
+        """Records the number of seconds a new token took to authenticate"""
+        self.estimate = (1 - self.weight) * self.estimate + self.weight * delay
+        self.observations += 1
+
+    def next_delay(self, elapsed):
+        """Returns the number of seconds to wait before the next poll
+
+        Args:
+            elapsed: the number of seconds since the first poll
+        """
+        if elapsed < self.estimate:
+            delay = self.estimate - elapsed
+        else:
+            # Overdue: wait about as long again as the token is already late, so the waits double
+            delay = (elapsed - self.estimate) * random.uniform(0.5, 1)
+        return min(max(delay, astraPropagationMinPoll), astraPropagationMaxPoll)
+
+
+propagation_estimator = PropagationEstimator()
+
+
+class RotationContext:
+    """Metadata and parsed secret versions of one rotation, shared by its steps
+
+    Parsed secrets are kept by VersionId. Since the value of a secret version never changes, a cached version
+    stays valid for the whole rotation; the current metadata (from DescribeSecret) decides which version a
+    stage resolves to.
+    """
+
+    def __init__(self, arn, token):
+        self.arn = arn
+        self.token = token
+        self.metadata = None
+        self.versions = {}
+        # The token created by createSecret, until it is stored in the AWSPENDING version
+        self.created = None
+        # The clientID of the token claimed from the token pool, which was tested when the pool was refilled
+        self.claimed = None
+
+    def version_for_stage(self, stage):
+        """Returns the VersionId of a stage according to the metadata, or None when it is unknown"""
+        if self.metadata is None:
+            return None
+        for version, stages in self.metadata['VersionIdsToStages'].items():
+            if stage in stages:
+                return version
+        return None
+
+    def get_secret_dict(self, service_client, stage, token=None):
+        """Gets the secret dictionary for a stage, reading it from Secrets Manager only when not already known
+
+        Args:
+            service_client (client): The secrets manager service client
+            stage (string): The stage identifying the secret version
+            token (string): The VersionId the stage must resolve to, or None if no validation is desired
+        Returns:
+            SecretDictionary: A copy of the secret dictionary
+        """
+        version = token or self.version_for_stage(stage)
+        if version is not None and version in self.versions:
+            return dict(self.versions[version])
+        secret_dict = get_secret_dict(service_client, self.arn, stage, token)
+        if version is not None:
+            self.versions[version] = secret_dict
+        return dict(secret_dict)
+
+    def put_secret_dict(self, version, secret_dict):
+        """Records a secret version written during the rotation"""
+        self.versions[version] = dict(secret_dict)
+
+
+class RotationContextStore:
+    """Rotation contexts of a warm container, keyed by ClientRequestToken
+
+    The most recent contexts are kept in memory. When a directory is given (the ROTATION_CONTEXT_DIR
+    environment variable, e.g. /tmp/rotations), contexts are also written there, so that they survive a restart
+    of the runtime process within the same container. Files are only readable by the function's user and carry
+    an HMAC-SHA256 of their content, keyed with the ROTATION_CONTEXT_KEY environment variable when it is set;
+    files which fail the check are ignored.
+    """
+
+    def __init__(self, size=rotationContextSize, directory=None, key=None):
+        self.size = size
+        self.directory = directory
+        self.key = (key or '').encode("utf-8")
+        self._contexts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, token):
+        return os.path.join(self.directory, hashlib.sha256(token.encode("utf-8")).hexdigest() + ".json")
+
+    def _digest(self, content):
+        return hmac.new(self.key, content, hashlib.sha256).hexdigest()
+
+    def _load(self, arn, token):
+        try:
+            with open(self._path(token), "rb") as f:
+                digest, _, content = f.read().partition(b"\n")
+        except OSError:
+            return None
+        if not hmac.compare_digest(digest.decode("ascii", "replace"), self._digest(content)):
+            logger.info(f"Ignoring rotation context for version {token} which failed its integrity check")
+            return None
+        state = json.loads(content)
+        if state['arn'] != arn or state['token'] != token:
+            return None
+        rotation = RotationContext(arn, token)
+        rotation.versions = state['versions']
+        rotation.created = state.get('created')
+        rotation.claimed = state.get('claimed')
+        return rotation
+
+    def get(self, arn, token):
+        """Returns the context of a rotation, or a new one when this container has not seen it yet"""
+        with self._lock:
+            rotation = self._contexts.get(token)
+            if rotation is not None and rotation.arn == arn:
+                self._contexts.move_to_end(token)
+                return rotation
+        if self.directory:
+            rotation = self._load(arn, token)
+            if rotation is not None:
+                return rotation
+        return RotationContext(arn, token)
+
+    def save(self, rotation):
+        """Keeps a context for the next steps of its rotation"""
+        with self._lock:
+            self._contexts[rotation.token] = rotation
+            self._contexts.move_to_end(rotation.token)
+            while len(self._contexts) > self.size:
+                self._contexts.popitem(last=False)
+        if self.directory:
+            content = json.dumps({'arn': rotation.arn, 'token': rotation.token,
+                                  'versions': rotation.versions, 'created': rotation.created,
+                                  'claimed': rotation.claimed}).encode("utf-8")
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            path = self._path(rotation.token)
+            fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._digest(content).encode("ascii") + b"\n" + content)
+            os.replace(path + ".tmp", path)
+
+    def discard(self, rotation):
+        """Forgets the context of a finished rotation"""
+        with self._lock:
+            self._contexts.pop(rotation.token, None)
+        if self.directory:
+            try:
+                os.remove(self._path(rotation.token))
+            except OSError:
+                pass
+
+
+rotation_contexts = RotationContextStore(directory=os.environ.get('ROTATION_CONTEXT_DIR'),
+                                         key=os.environ.get('ROTATION_CONTEXT_KEY'))
+
+
+class TokenPool:
+    """Spare Astra tokens, created and tested ahead of the rotations which claim them
+
+    The pool is a secret of its own (the TOKEN_POOL_SECRET environment variable) holding, per root secret and
+    role set, up to size spare tokens, the time each role set was last refilled, and the roles of the tokens
+    handed out:
+
+        {"spares": {"<rootarn>": {"<sorted roles>": [{"clientID": ..., "clientSecret": ..., "astraKey": ...}]}},
+         "refills": {"<rootarn>": {"<sorted roles>": <time of the last refill>}},
+         "assigned": {"<clientID>": [<roles>]}}
+
+    Only the last tokenPoolMaxAssigned tokens handed out are kept in assigned.
+
+    createSecret claims a spare instead of listing the clients and creating a token, which also records its role
+    set in refills. The pool is refilled out of band by refill_all, from a scheduled invocation of the function,
+    so that the Astra calls and the propagation of the new tokens are off the rotations entirely.
+
+    Every update writes a new version and then moves AWSCURRENT to it from the version it was computed from.
+    Secrets Manager rejects the move when AWSCURRENT has moved in between, so an update which raced with another
+    one is computed again, and a spare is never claimed twice. As Secrets Manager keeps about 100 versions of the
+    last 24 hours at most, each role set is refilled at most once per refill_interval seconds, and a claim
+    which finds no spare writes nothing once its role set is recorded: the pool writes at most
+    86400 / refill_interval * (size + 1) versions a day per role set, however many secrets rotate. With the
+    defaults, that is 72 versions a day for a single role set; use a longer refill_interval (TOKEN_POOL_REFILL_INTERVAL)
+    or a pool secret per function when more role sets share one pool.
+    """
+
+    def __init__(self, pool_arn=None, size=tokenPoolSize, refill_interval=tokenPoolRefillInterval):
+        self.pool_arn = pool_arn
+        self.size = size
+        self.refill_interval = refill_interval
+
+    @property
+    def enabled(self):
+        return bool(self.pool_arn) and self.size > 0
+
+    @staticmethod
+    def _role_set(roles):
+        return ",".join(sorted(roles))
+
+    def _read(self, service_client):
+        try:
+            secret = service_client.get_secret_value(SecretId=self.pool_arn, VersionStage="AWSCURRENT")
+        except service_client.exceptions.ResourceNotFoundException:
+            raise KeyError(f"The token pool secret {self.pool_arn} does not exist")
+        pool = json.loads(secret.get('SecretString') or '{}')
+        for key in ('spares', 'refills', 'assigned'):
+            pool.setdefault(key, {})
+        return secret['VersionId'], pool
+
+    def _update(self, service_client, change):
+        """Applies change to the pool dictionary, returning its result; change returns None for no update"""
+        for attempt in range(tokenPoolUpdateAttempts):
+            current_version, pool = self._read(service_client)
+            result = change(pool)
+            if result is None:
+                return None
+            version = str(uuid.uuid4())
+            service_client.put_secret_value(SecretId=self.pool_arn, ClientRequestToken=version,
+                                            SecretString=json.dumps(pool), VersionStages=['AWSPENDING'])
+            try:
+                service_client.update_secret_version_stage(SecretId=self.pool_arn, VersionStage="AWSCURRENT",
+                                                           MoveToVersionId=version,
+                                                           RemoveFromVersionId=current_version)
+                return result
+            except service_client.exceptions.InvalidParameterException:
+                logger.info(f"Token pool {self.pool_arn} changed during the update, retrying")
+        raise Exception(f"Unable to update the token pool {self.pool_arn} after {tokenPoolUpdateAttempts} attempts")
+
+    def claim(self, service_client, root_arn, root_key, clientID, roles=None):
+        """Claims a spare token with the roles of clientID
+
+        Args:
+            service_client (client): The secrets manager service client
+            root_arn (string): The root secret of the tokens
+            root_key (string): The root Astra key, used when the roles of clientID are not known to the pool
+            clientID (string): The client ID of the token being replaced
+            roles (list): The roles of clientID, when already known
+
+        Returns:
+            a tuple of the spare token dictionary (None when the pool has none) and the roles of clientID
+        """
+        found = {}
+
+        def take(pool):
+            found['roles'] = roles or pool['assigned'].get(clientID) or get_token_roles(root_key, clientID)
+            role_set = self._role_set(found['roles'])
+            refills = pool['refills'].setdefault(root_arn, {})
+            spares = pool['spares'].get(root_arn, {}).get(role_set)
+            if not spares:
+                if role_set in refills:
+                    return None
+                # Record the role set, so that the next refill creates spares for it
+                refills[role_set] = 0
+                return {}
+            refills.setdefault(role_set, 0)
+            spare = spares.pop(0)
+            pool['assigned'].pop(clientID, None)
+            pool['assigned'][spare['clientID']] = found['roles']
+            for forgotten in list(pool['assigned'])[:-tokenPoolMaxAssigned]:
+                del pool['assigned'][forgotten]
+            return spare
+
+        spare = self._update(service_client, take)
+        return spare or None, found['roles']
+
+    def _test(self, astraKey):
+        for attempt in range(tokenPoolTestAttempts):
+            status, reason, headers, data = make_API_request(astraKey, "GET", "/v2/currentOrg")
+            if status == 200:
+                return True
+            delay = 2 ** attempt * 0.5
+            remaining = remaining_time()
+            if remaining is not None and delay >= remaining:
+                break
+            time.sleep(delay)
+        return False
+
+    def refill_all(self, service_client):
+        """Refills every role set recorded by a claim which is short of spares and was not refilled within
+        refill_interval seconds. Role sets are refilled one after the other, until the invocation deadline.
+
+        Returns:
+            the number of spare tokens added
+        """
+        _, pool = self._read(service_client)
+        now = time.time()
+        added = 0
+        for root_arn, role_sets in pool['refills'].items():
+            for role_set, refilled in role_sets.items():
+                if len(pool['spares'].get(root_arn, {}).get(role_set, [])) >= self.size or \
+                        now - refilled < self.refill_interval:
+                    continue
+                try:
+                    root_key = root_secret_cache.get(service_client, root_arn)['astraKey']
+                    added += self.refill(service_client, root_arn, root_key, role_set.split(',') if role_set else [])
+                except DeadlineExceeded:
+                    logger.warning(f"Token pool refill stopped by the deadline, after adding {added} spare tokens")
+                    return added
+                except Exception:
+                    logger.exception(f"Unable to refill the token pool for {root_arn} and roles {role_set}")
+        return added
+
+    def refill(self, service_client, root_arn, root_key, roles):
+        """Creates and tests spare tokens with the given roles, until the pool holds size of them
+
+        When the refill fails, the tokens it created are deleted, except those the pool already holds.
+
+        Returns:
+            the number of spare tokens added
+        """
+        role_set = self._role_set(roles)
+        _, pool = self._read(service_client)
+        missing = self.size - len(pool['spares'].get(root_arn, {}).get(role_set, []))
+        created = []
+        surplus = []
+
+        def add(pool):
+            spares = pool['spares'].setdefault(root_arn, {}).setdefault(role_set, [])
+            room = max(self.size - len(spares), 0)
+            surplus[:] = created[room:]
+            if room == 0:
+                return None
+            spares.extend(created[:room])
+            pool['refills'].setdefault(root_arn, {})[role_set] = time.time()
+            return room
+
+        try:
+            for _ in range(max(missing, 0)):
+                new_clientId, new_secret, new_token = create_astra_token(root_key, roles)
+                created.append({'clientID': new_clientId, 'clientSecret': new_secret, 'astraKey': new_token})
+                if not self._test(new_token):
+                    logger.error(f"Spare token {new_clientId} failed its test, deleting it")
+                    created.pop()
+                    delete_astra_token(root_key, new_clientId)
+            if not created:
+                return 0
+            added = min(self._update(service_client, add) or 0, len(created))
+        except Exception:
+            self._discard(service_client, root_key, created)
+            raise
+        # Another refill filled the pool in the meantime
+        for spare in surplus:
+            delete_astra_token(root_key, spare['clientID'])
+        logger.info(f"Added {added} spare tokens to the pool for {root_arn}")
+        return added
+
+    def _discard(self, service_client, root_key, created):
+        """Deletes the tokens of a failed refill which did not make it into the pool"""
+        # The deadline may be what failed the refill: clean up in the margin kept before the Lambda timeout
+        reset = _deadline.set(None)
+        try:
+            try:
+                secret = service_client.get_secret_value(SecretId=self.pool_arn, VersionStage="AWSCURRENT")
+                pooled = {spare['clientID'] for role_sets in json.loads(secret['SecretString'])['spares'].values()
+                          for spares in role_sets.values() for spare in spares}
+            except Exception:
+                pooled = set()
+            for spare in created:
+                if spare['clientID'] in pooled:
+                    continue
+                try:
+                    delete_astra_token(root_key, spare['clientID'])
+                except Exception:
+                    logger.exception(f"Unable to delete spare token {spare['clientID']} of a failed refill")
+        finally:
+            _deadline.reset(reset)
+
+
+token_pool = TokenPool(os.environ.get('TOKEN_POOL_SECRET'), int(os.environ.get('TOKEN_POOL_SIZE', tokenPoolSize)),
+                       int(os.environ.get('TOKEN_POOL_REFILL_INTERVAL', tokenPoolRefillInterval)))
+
+
+def astra_endpoint_name(method, path):
+    """Returns the name of an Astra endpoint for metrics, with identifiers replaced by {id}"""
+    return method + " " + re.sub(r"/[0-9a-fA-F-]{8,}(?=/|$)", "/{id}", path.split("?", 1)[0])
+
+
+class Histogram:
+    """Compact histogram of positive values, bucketed logarithmically
+
+    Values are rounded to the nearest power of resolution, which keeps the relative error under
+    (resolution - 1) / 2 while storing only a handful of buckets per metric. The buckets map directly to the
+    Values and Counts arrays of an Embedded Metric Format distribution. Exact histograms (used for counts) keep
+    values as they are.
+    """
+
+    resolution = 1.05
+
+    def __init__(self, exact=False):
+        self.exact = exact
+        self.buckets = {}
+
+    def add(self, value, count=1):
+        if self.exact:
+            pass
+        elif value > 0:
+            bucket = round(math.log(value, self.resolution))
+            value = round(self.resolution ** bucket, 3)
+        else:
+            value = 0
+        self.buckets[value] = self.buckets.get(value, 0) + count
+
+    def to_emf(self):
+        values = sorted(self.buckets)
+        return {'Values': values, 'Counts': [self.buckets[value] for value in values]}
+
+
+class RotationMetrics:
+    """In-process metrics of the rotation function, written in CloudWatch Embedded Metric Format
+
+    Step durations, Astra API requests (count, latency, retries and payload sizes, per endpoint) and Secrets
+    Manager operations (count, latency, SDK retries and response sizes, per operation) are accumulated in
+    histograms, and written as one EMF JSON line per dimension set when the invocation ends. CloudWatch extracts
+    the metrics from the function logs, so no API call or agent is needed.
+    """
+
+    def __init__(self, namespace=metricsNamespace, output=None):
+        self.namespace = namespace
+        self.output = output
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, value, unit="Milliseconds", **dimensions):
+        """Adds a value to the histogram of a metric for the given dimensions"""
+        key = tuple(sorted(dimensions.items()))
+        with self._lock:
+            metrics = self._metrics.setdefault(key, {})
+            if name not in metrics:
+                metrics[name] = (unit, Histogram(exact=unit == "Count"))
+            metrics[name][1].add(value)
+
+    def count(self, name, value=1, **dimensions):
+        self.record(name, value, "Count", **dimensions)
+
+    def record_astra_request(self, method, path, started, status, body, content):
+        endpoint = astra_endpoint_name(method, path)
+        self.record("AstraLatency", (time.monotonic() - started) * 1000, Endpoint=endpoint)
+        self.count("AstraRequests", Endpoint=endpoint)
+        if status is None or status >= 400:
+            self.count("AstraErrors", Endpoint=endpoint)
+        self.record("AstraRequestBytes", len(body or ''), "Bytes", Endpoint=endpoint)
+        if not isinstance(content, AstraResponseStream):
+            # A streamed response records its size once it is read
+            self.record("AstraResponseBytes", len(content or b''), "Bytes", Endpoint=endpoint)
+
+    def instrument(self, service_client):
+        """Registers botocore event handlers which time every Secrets Manager operation of the client"""
+        def before_call(context, **kwargs):
+            context['metrics_started'] = time.monotonic()
+
+        def after_call(model, context, http_response=None, parsed=None, **kwargs):
+            operation = model.name
+            if 'metrics_started' in context:
+                self.record("SecretsManagerLatency", (time.monotonic() - context['metrics_started']) * 1000,
+                            Operation=operation)
+            self.count("SecretsManagerRequests", Operation=operation)
+            retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            if retries:
+                self.count("SecretsManagerRetries", retries, Operation=operation)
+            if http_response is not None:
+                self.record("SecretsManagerResponseBytes", len(http_response.content or b''), "Bytes",
+                            Operation=operation)
+
+        service_client.meta.events.register('before-call.secrets-manager', before_call)
+        service_client.meta.events.register('after-call.secrets-manager', after_call)
+
+    @contextlib.contextmanager
+    def invocation(self, step):
+        """Times a rotation step, counts its errors, and flushes every metric when it ends"""
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.count("StepErrors", Step=step)
+            raise
+        finally:
+            self.record("StepDuration", (time.monotonic() - started) * 1000, Step=step)
+            self.flush()
+
+    def flush(self):
+        """Writes one EMF line per dimension set to the output (stdout by default), and resets the histograms"""
+        with self._lock:
+            metrics, self._metrics = self._metrics, {}
+        timestamp = int(time.time() * 1000)
+        for key, values in metrics.items():
+            document = dict(key)
+            document['_aws'] = {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [[name for name, _ in key]],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in values.items()],
+                }],
+            }
+            for name, (unit, histogram) in values.items():
+                document[name] = histogram.to_emf()
+            print(json.dumps(document), file=self.output or sys.stdout, flush=True)
+
+
+rotation_metrics = RotationMetrics()
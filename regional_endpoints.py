@@ -0,0 +1,235 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Purpose
+
+Reads replicated secrets from the Secrets Manager region with the lowest latency.
+
+RegionalSecretsClient stands in for a boto3 Secrets Manager client: it can be passed as the service_client of
+get_secret_dict, AstraTokenProvider, SharedSecretCache or SecretsManagerSecret. Read operations are sent to
+the regional endpoints in order of their measured latency:
+
+  * At first use, and every rerank_interval seconds after that (from a background thread), each endpoint is
+    probed a few times with DescribeSecret of probe_secret_id (or ListSecrets when none is given), and the
+    endpoints are ranked by their median latency. Endpoints which fail the probe are ranked last.
+  * Between probes, the latency of every read updates a moving average of its endpoint, so the ranking follows
+    a region which slows down.
+  * When a read fails with a connection error, a timeout, throttling or a server error, its endpoint is ranked
+    last for cooldown seconds and the read is retried on the next endpoint. A read of a secret or version
+    which does not exist (yet) in a replica region, because of replication lag, also falls back to the next
+    endpoint, without demoting it.
+
+Every other operation, including all writes, goes to the primary region, the first of the endpoints. The
+rotation function itself keeps using SECRETS_MANAGER_ENDPOINT only, since its steps must read the versions
+they just wrote in the primary region.
+
+Endpoints are given as "region" or "region=url" items, either as a list or comma-separated in the
+SECRETS_MANAGER_ENDPOINTS environment variable for from_environment(), for example:
+
+    SECRETS_MANAGER_ENDPOINTS=us-east-1,eu-west-1,ap-southeast-2=https://secretsmanager.ap-southeast-2.amazonaws.com
+
+Example:
+
+    service_client = RegionalSecretsClient.from_environment(probe_secret_id='/astra/prod/app1')
+    secret_dict = lambda_function.get_secret_dict(service_client, '/astra/prod/app1', "AWSCURRENT")
+"""
+
+import logging
+import os
+import statistics
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Read operations which are served by the lowest latency replica
+readOperations = ['get_secret_value', 'describe_secret', 'batch_get_secret_value', 'list_secrets',
+                  'list_secret_version_ids', 'get_resource_policy']
+
+# Error codes after which a read is retried on the next endpoint, which is also ranked last for a while
+failoverErrorCodes = ['InternalServiceError', 'InternalFailure', 'ServiceUnavailable', 'ThrottlingException',
+                      'Throttling', 'RequestTimeout']
+
+# Error codes after which a read is retried on the next endpoint, without ranking the endpoint last
+replicaErrorCodes = ['ResourceNotFoundException']
+
+# Weight of the latest read in the moving average of the latency of an endpoint
+latencyWeight = 0.2
+
+
+class RegionalEndpoint:
+    """A regional Secrets Manager endpoint, its client, and its measured latency"""
+
+    def __init__(self, region, url, client):
+        self.region = region
+        self.url = url
+        self.client = client
+        self.latency = None
+        self.unhealthy_until = 0
+
+    def healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def observe(self, elapsed):
+        self.latency = elapsed if self.latency is None else \
+            (1 - latencyWeight) * self.latency + latencyWeight * elapsed
+
+    def __repr__(self):
+        latency = "unknown" if self.latency is None else f"{self.latency * 1000:.1f} ms"
+        return f"RegionalEndpoint({self.region}, {latency}{'' if self.healthy() else ', unhealthy'})"
+
+
+def parse_endpoints(value):
+    """Parses a comma-separated list of "region" or "region=url" items into (region, url) tuples"""
+    endpoints = []
+    for item in value.split(','):
+        item = item.strip()
+        if item:
+            region, _, url = item.partition('=')
+            endpoints.append((region.strip(), url.strip() or None))
+    if not endpoints:
+        raise ValueError("At least one Secrets Manager endpoint is required")
+    return endpoints
+
+
+class RegionalSecretsClient:
+    """Secrets Manager client which reads replicated secrets from the lowest latency healthy region
+
+    Args:
+        endpoints: A list of (region, url) tuples, or "region=url" strings, the first being the primary region.
+                   The url may be None to use the default endpoint of the region.
+        probe_secret_id: The name of a replicated secret, described to measure the latency of each endpoint.
+        rerank_interval: The number of seconds between two rankings of the endpoints.
+        probes: The number of requests made to each endpoint by a ranking.
+        cooldown: The number of seconds an endpoint which failed stays ranked last.
+        client_config: Optional botocore Config of the regional clients. By default they time out after a few
+                       seconds and do not retry, so that a failing region is left at once for the next one.
+    """
+
+    def __init__(self, endpoints, probe_secret_id=None, rerank_interval=300, probes=3, cooldown=60,
+                 client_config=None):
+        import boto3
+        from botocore.config import Config
+
+        if client_config is None:
+            client_config = Config(connect_timeout=2, read_timeout=5, retries={'total_max_attempts': 1})
+        self.probe_secret_id = probe_secret_id
+        self.rerank_interval = rerank_interval
+        self.probes = probes
+        self.cooldown = cooldown
+        self.endpoints = []
+        for endpoint in endpoints:
+            region, url = parse_endpoints(endpoint)[0] if isinstance(endpoint, str) else endpoint
+            client = boto3.client('secretsmanager', region_name=region, endpoint_url=url, config=client_config)
+            self.endpoints.append(RegionalEndpoint(region, url, client))
+        if not self.endpoints:
+            raise ValueError("At least one Secrets Manager endpoint is required")
+        self.primary = self.endpoints[0]
+        self._ranking = list(self.endpoints)
+        self._next_rank = 0
+        self._ranking_thread = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, **kwargs):
+        """Creates a client for the endpoints of the SECRETS_MANAGER_ENDPOINTS environment variable, or of
+        SECRETS_MANAGER_ENDPOINT alone when it is not set"""
+        if os.environ.get('SECRETS_MANAGER_ENDPOINTS'):
+            endpoints = parse_endpoints(os.environ['SECRETS_MANAGER_ENDPOINTS'])
+        else:
+            import boto3
+            endpoints = [(boto3.session.Session().region_name, os.environ['SECRETS_MANAGER_ENDPOINT'])]
+        return cls(endpoints, **kwargs)
+
+    @property
+    def exceptions(self):
+        return self.primary.client.exceptions
+
+    def _probe(self, endpoint):
+        latencies = []
+        try:
+            for _ in range(self.probes):
+                started = time.perf_counter()
+                if self.probe_secret_id:
+                    endpoint.client.describe_secret(SecretId=self.probe_secret_id)
+                else:
+                    endpoint.client.list_secrets(MaxResults=1)
+                latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            logger.warning("Secrets Manager endpoint %s failed its probe: %s", endpoint.region, e)
+            endpoint.unhealthy_until = time.monotonic() + self.cooldown
+            return
+        endpoint.latency = statistics.median(latencies)
+        endpoint.unhealthy_until = 0
+
+    def rank(self):
+        """Probes every endpoint at the same time, and ranks them by latency"""
+        threads = [threading.Thread(target=self._probe, args=(endpoint,), daemon=True)
+                   for endpoint in self.endpoints]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with self._lock:
+            self._next_rank = time.monotonic() + self.rerank_interval
+            self._sort()
+        logger.info("Ranked Secrets Manager endpoints: %s", self._ranking)
+
+    def _sort(self):
+        # Healthy endpoints first, then by latency, endpoints never measured last
+        self._ranking = sorted(self.endpoints, key=lambda endpoint: (
+            not endpoint.healthy(), endpoint.latency is None, endpoint.latency or 0))
+
+    def ranking(self):
+        """Returns the endpoints in the order reads try them, ranking them first when they are due for it"""
+        if self._next_rank == 0:
+            # Nothing is known about the endpoints yet, the first read waits for the ranking
+            self.rank()
+        elif time.monotonic() >= self._next_rank:
+            with self._lock:
+                if self._ranking_thread is None or not self._ranking_thread.is_alive():
+                    self._next_rank = time.monotonic() + self.rerank_interval
+                    self._ranking_thread = threading.Thread(target=self.rank, name="rank-endpoints",
+                                                            daemon=True)
+                    self._ranking_thread.start()
+        with self._lock:
+            return list(self._ranking)
+
+    def _read(self, operation, **kwargs):
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        error = None
+        for endpoint in self.ranking():
+            started = time.perf_counter()
+            try:
+                response = getattr(endpoint.client, operation)(**kwargs)
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code not in replicaErrorCodes + failoverErrorCodes:
+                    raise
+                error = error or e
+                if code in replicaErrorCodes:
+                    continue
+                failure = e
+            except BotoCoreError as e:
+                failure = e
+                error = error or e
+            else:
+                with self._lock:
+                    endpoint.observe(time.perf_counter() - started)
+                    self._sort()
+                return response
+            logger.warning("Secrets Manager endpoint %s failed, trying the next one: %s", endpoint.region, failure)
+            with self._lock:
+                endpoint.unhealthy_until = time.monotonic() + self.cooldown
+                self._sort()
+        raise error
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'primary':
+            raise AttributeError(name)
+        if name in readOperations and hasattr(self.primary.client, name):
+            return lambda **kwargs: self._read(name, **kwargs)
+        # Writes and everything else go to the primary region
+        return getattr(self.primary.client, name)
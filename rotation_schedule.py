@@ -0,0 +1,362 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_function
+from bulk_revocation import RateLimiter
+from secretsmanager_lib import SecretsManagerSecret
+
+logger = logging.getLogger(__name__)
+
+"""
+This Python code spreads the rotations of a fleet of Astra secrets over their rotation interval, so that they do
+not all run in the same window as with the single schedule of example_rotate_astra_secret.py.
+
+The rotation interval is divided into slots, one per rotation window (Duration) of each day of the interval:
+
+    interval 1 day          cron(0 H * * ? *)       every day
+    interval 7 days         cron(0 H ? * D *)       every week, on day D
+    interval 2 to 27 days   cron(0 H D/N * ? *)     every N days of the month from day D
+    interval 28 to 31 days  cron(0 H D * ? *)       every month, on day D (1 to 28)
+
+Longer intervals can not be expressed with a cron schedule, and are rejected. The D/N form starts over every
+month, so the gap between the last rotation of a month and the first of the next one differs from N days: it is
+shorter for some slots and longer for others (up to a whole month for a large D). The plan reports the longest
+gap between two rotations of a slot, so that it can be checked against the intended interval.
+
+Windows start on the hour, as Secrets Manager requires, and do not overlap, so no two slots are ever open at
+the same time. Secrets Manager starts each rotation at a random time of its window, so the peak number of
+rotations running at once, and of Astra requests made within a second, are random: they follow the scan
+statistic of the random start times, from the number of secrets in the slot and the duration and Astra requests
+of one rotation. The capacity of a slot is the number of secrets for which both peaks stay under their limits
+in all but peakExceedProbability of the windows, which is well below what the average load would allow.
+
+Each secret has a sequence of slots chosen by hashes of its name. Secrets are placed in rounds: in each round,
+every secret not placed yet tries the next slot of its sequence, and a slot with more candidates than room keeps
+those with the lowest hash. The plan therefore only depends on the set of names: the same fleet always gets the
+same schedule, and a new secret only moves a secret out of a full slot in which it ranks lower, which then moves
+to its own next slot rather than pushing the secrets of the neighbouring slots. Planning fails when the fleet
+does not fit in the interval under the limits.
+
+The secrets are those listed (with SecretsManagerSecret.list, optionally filtered by name prefix) whose rotation
+uses the given Lambda function, and with --enable the secrets which have no rotation configured yet and whose
+value is an Astra secret (not a root secret, nor a secret of another kind). Only the
+secrets whose schedule differs from the plan are updated, with RotateSecret (without rotating them immediately),
+under a rate limit. Without --apply, the changes are only printed.
+"""
+# Syntax:
+# python rotation_schedule.py --lambda-arn <LAMBDA ARN> [--prefix <NAME PREFIX>] [--interval DAYS] [--duration HOURS]
+#                             [--max-concurrency N] [--astra-rate N] [--enable] [--apply]
+
+# Example
+# python rotation_schedule.py --lambda-arn arn:aws:lambda:us-east-1:388533891461:function:rotateAstraToken --prefix /astra/prod/ --interval 14 --duration 2 --apply
+
+# Days of the week of weekly schedules, in cron notation
+weekDays = ['SUN', 'MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT']
+
+# Number of days of each month, in a year without February 29
+monthDays = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+# Probability that the peak concurrency or Astra request rate of a full rotation window exceeds its limit
+peakExceedProbability = 0.01
+
+# Number of rounds in which secrets try the slots chosen by their hashes, before taking any slot with room
+placementRounds = 16
+
+
+def schedule_slots(interval_days, duration_hours):
+    """Returns the ScheduleExpression of every slot of the interval, in the order they open
+
+    Args:
+        interval_days (int): The number of days between two rotations of a secret
+        duration_hours (int): The length of each rotation window, in hours, a divisor of 24
+    """
+    if interval_days < 1:
+        raise ValueError("The rotation interval must be at least one day")
+    if duration_hours < 1 or 24 % duration_hours:
+        raise ValueError("The rotation window must be a whole number of hours dividing 24")
+    hours = range(0, 24, duration_hours)
+    if interval_days == 1:
+        return [f"cron(0 {hour} * * ? *)" for hour in hours]
+    if interval_days == 7:
+        return [f"cron(0 {hour} ? * {day} *)" for day in weekDays for hour in hours]
+    if interval_days < 28:
+        return [f"cron(0 {hour} {day}/{interval_days} * ? *)" for day in range(1, interval_days + 1)
+                for hour in hours]
+    if interval_days <= 31:
+        return [f"cron(0 {hour} {day} * ? *)" for day in range(1, 29) for hour in hours]
+    raise ValueError("Rotation intervals longer than a month can not be expressed with a cron schedule")
+
+
+def longest_gap(interval_days):
+    """Returns the longest number of days between two rotations of any slot of schedule_slots over a year"""
+    if interval_days in (1, 7):
+        return interval_days
+    if interval_days >= 28:
+        return max(monthDays)
+    longest = 0
+    for first in range(1, interval_days + 1):
+        # Days of the year (0 based) on which the slot fires, in a year without February 29
+        fired = [sum(monthDays[:month]) + day - 1 for month in range(12)
+                 for day in range(first, monthDays[month] + 1, interval_days)]
+        gaps = [b - a for a, b in zip(fired, fired[1:])] + [fired[0] + 365 - fired[-1]]
+        longest = max(longest, max(gaps))
+    return longest
+
+
+def scan_quantile(arrivals, period, width, probability):
+    """Returns the smallest k such that, with the given probability, no interval of width holds more than k of
+    arrivals made at random times of period, with the approximation of the Poisson scan statistic by Alm"""
+    mean = arrivals * width / period
+    if mean <= 0:
+        return 0
+    k = 0
+    cumulative = 0.0
+    while True:
+        term = math.exp(-mean + k * math.log(mean) - math.lgamma(k + 1))
+        cumulative += term
+        if k + 1 > mean:
+            rate = arrivals * (period - width) / period
+            exceeded = 1 - cumulative * math.exp(-(k + 1 - mean) / (k + 1) * rate * term)
+            if exceeded <= 1 - probability:
+                return k
+        k += 1
+
+
+def peak_load(secrets, duration_hours, rotation_seconds, astra_requests):
+    """Returns the average and peak concurrency and Astra request rate of a window of secrets rotations
+
+    Rotations start at random times of the window, so the peak concurrency is the largest number of rotations
+    starting within rotation_seconds of each other, and the peak Astra rate the largest number of requests
+    within a second, assuming the requests of a rotation are spread over it. The peaks are the quantiles only
+    exceeded with probability peakExceedProbability over the window (see scan_quantile), which is well above
+    the averages for small limits.
+    """
+    window = duration_hours * 3600
+    return {
+        'averageConcurrency': secrets * rotation_seconds / window,
+        'peakConcurrency': scan_quantile(secrets, window, min(rotation_seconds, window), 1 - peakExceedProbability),
+        'averageAstraRate': secrets * astra_requests / window,
+        'peakAstraRate': scan_quantile(secrets * astra_requests, window, 1, 1 - peakExceedProbability),
+    }
+
+
+def slot_capacity(duration_hours, max_concurrency, astra_rate, rotation_seconds, astra_requests):
+    """Returns the number of secrets a rotation window can hold with its peak load (see peak_load) under the limits
+
+    Args:
+        duration_hours (int): The length of the rotation window, in hours
+        max_concurrency (int): The maximum number of rotations running at once, or None for no limit
+        astra_rate (float): The maximum number of Astra requests per second, or None for no limit
+        rotation_seconds (float): The duration of one rotation, all four steps included
+        astra_requests (float): The number of Astra requests made by one rotation
+    """
+    if not max_concurrency and not astra_rate:
+        return None
+
+    def fits(secrets):
+        load = peak_load(secrets, duration_hours, rotation_seconds, astra_requests)
+        return (not max_concurrency or load['peakConcurrency'] <= max_concurrency) and \
+            (not astra_rate or load['peakAstraRate'] <= astra_rate)
+
+    # The peaks grow with the number of secrets, and the averages bound the capacity from above
+    window = duration_hours * 3600
+    low, high = 0, int(min(max_concurrency * window / rotation_seconds if max_concurrency else math.inf,
+                           astra_rate * window / astra_requests if astra_rate else math.inf)) + 1
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def _hash(name):
+    return int.from_bytes(hashlib.sha256(name.encode("utf-8")).digest()[:8], "big")
+
+
+def plan_schedules(names, interval_days=14, duration_hours=2, max_concurrency=None, astra_rate=None,
+                   rotation_seconds=10, astra_requests=4):
+    """Assigns every secret to a slot of the interval, deterministically and under the limits
+
+    Args:
+        names (list): The names of the secrets
+        interval_days, duration_hours: See schedule_slots
+        max_concurrency, astra_rate, rotation_seconds, astra_requests: See slot_capacity
+
+    Returns:
+        a tuple of a dictionary of the RotationRules of each secret name, and a dictionary with the number of
+        slots, their capacity, the largest number of secrets in a slot, the average and peak concurrency and
+        Astra request rate of that slot (see peak_load), and the longest number of days between two rotations
+        of a secret
+
+    Raises:
+        ValueError: If the secrets do not fit in the interval under the limits
+    """
+    slots = schedule_slots(interval_days, duration_hours)
+    capacity = slot_capacity(duration_hours, max_concurrency, astra_rate, rotation_seconds, astra_requests)
+    names = sorted(set(names), key=lambda name: (_hash(name), name))
+    if capacity is not None and len(names) > capacity * len(slots):
+        raise ValueError(f"{len(names)} secrets do not fit in {len(slots)} rotation windows of {capacity} "
+                         f"secrets, use a longer interval or raise the limits")
+    counts = [0] * len(slots)
+    placed = {}
+    for attempt in range(placementRounds if capacity is not None else 1):
+        # Secrets are in hash order, so the lowest hashes win the room of a slot
+        for name in names:
+            if name in placed:
+                continue
+            slot = (_hash(name) if attempt == 0 else _hash(f"{name}#{attempt}")) % len(slots)
+            if capacity is None or counts[slot] < capacity:
+                counts[slot] += 1
+                placed[name] = slot
+    # The few secrets whose slots were all full take the first slots with room
+    for name in names:
+        if name not in placed:
+            slot = next(slot for slot, count in enumerate(counts) if count < capacity)
+            counts[slot] += 1
+            placed[name] = slot
+    rules = {name: {'ScheduleExpression': slots[slot], 'Duration': f"{duration_hours}h"}
+             for name, slot in placed.items()}
+    largest = max(counts)
+    load = peak_load(largest, duration_hours, rotation_seconds, astra_requests)
+    stats = {
+        'slots': len(slots),
+        'capacity': capacity,
+        'largestSlot': largest,
+        'averageConcurrency': round(load['averageConcurrency'], 3),
+        'peakConcurrency': load['peakConcurrency'],
+        'averageAstraRate': round(load['averageAstraRate'], 3),
+        'peakAstraRate': load['peakAstraRate'],
+        'longestGapDays': longest_gap(interval_days),
+    }
+    return rules, stats
+
+
+def list_fleet(service_client, lambda_arn, prefix=None, enable=False, max_results=10000):
+    """Returns the secrets rotated by lambda_arn as ListSecrets entries, and with enable the Astra secrets
+    without rotation, which are only those whose value parses with parse_secret_dict (so not root secrets)"""
+    filters = [{'Key': 'name', 'Values': [prefix]}] if prefix else None
+    fleet = []
+    candidates = []
+    for entry in SecretsManagerSecret(service_client).list(max_results, filters):
+        if entry.get('RotationEnabled'):
+            if entry.get('RotationLambdaARN') == lambda_arn:
+                fleet.append(entry)
+        elif enable:
+            candidates.append(entry)
+    if candidates:
+        values, errors = SecretsManagerSecret(service_client).get_values(
+            [entry['ARN'] for entry in candidates], parse=lambda_function.parse_secret_dict)
+        for entry in candidates:
+            if entry['ARN'] in values:
+                fleet.append(entry)
+            else:
+                logger.info("Not enabling rotation of %s, which is not an Astra secret: %s", entry['Name'],
+                            errors.get(entry['ARN']))
+    return fleet
+
+
+def diff_schedules(fleet, rules):
+    """Returns the (entry, RotationRules) pairs of the secrets whose schedule differs from the plan"""
+    changes = []
+    for entry in fleet:
+        wanted = rules[entry['Name']]
+        current = entry.get('RotationRules') or {}
+        if not entry.get('RotationEnabled') or any(current.get(key) != value for key, value in wanted.items()):
+            changes.append((entry, wanted))
+    return changes
+
+
+def apply_schedules(service_client, lambda_arn, changes, rate=5, max_workers=4, on_result=None):
+    """Updates the rotation schedule of the secrets, without rotating them
+
+    Args:
+        service_client (client): The secrets manager service client
+        lambda_arn (string): The ARN of the rotation function
+        changes (list): The (ListSecrets entry, RotationRules) pairs to apply
+        rate (float): The maximum number of RotateSecret calls per second, or None for no limit
+        max_workers (int): The number of RotateSecret calls made at the same time
+        on_result (callable): Optional function called with every result as soon as it is available
+
+    Returns:
+        the list of results
+    """
+    limiter = RateLimiter(rate)
+
+    def update(entry, wanted):
+        result = {'secret': entry['Name'], 'from': entry.get('RotationRules') if entry.get('RotationEnabled')
+                  else None, 'to': wanted}
+        try:
+            limiter.acquire()
+            service_client.rotate_secret(SecretId=entry['ARN'], RotationLambdaARN=lambda_arn,
+                                         RotationRules=wanted, RotateImmediately=False)
+            result['status'] = 'updated'
+        except Exception as e:
+            logger.exception("Couldn't update the rotation schedule of %s", entry['Name'])
+            result.update(status='failed', error=str(e))
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda change: update(*change), changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Spread the rotation schedules of Astra secrets")
+    parser.add_argument('--lambda-arn', required=True, help='ARN of the rotation function')
+    parser.add_argument('--prefix', help='only schedule the secrets whose name starts with this prefix')
+    parser.add_argument('--interval', type=int, default=14, help='number of days between rotations of a secret')
+    parser.add_argument('--duration', type=int, default=2, help='length of the rotation windows, in hours')
+    parser.add_argument('--max-concurrency', type=int, help='maximum number of rotations running at once')
+    parser.add_argument('--astra-rate', type=float, help='maximum number of Astra requests per second')
+    parser.add_argument('--rotation-seconds', type=float, default=10, help='duration of one rotation')
+    parser.add_argument('--astra-requests', type=float, default=4, help='number of Astra requests of one rotation')
+    parser.add_argument('--enable', action='store_true', help='also schedule secrets without rotation')
+    parser.add_argument('--apply', action='store_true', help='update the secrets, instead of printing the changes')
+    parser.add_argument('--rate', type=float, default=5, help='maximum number of RotateSecret calls per second')
+    args = parser.parse_args(argv)
+
+    service_client = lambda_function.get_service_client()
+    started = time.monotonic()
+    fleet = list_fleet(service_client, args.lambda_arn, args.prefix, args.enable)
+    try:
+        rules, stats = plan_schedules([entry['Name'] for entry in fleet], args.interval, args.duration,
+                                      args.max_concurrency, args.astra_rate, args.rotation_seconds,
+                                      args.astra_requests)
+    except ValueError as e:
+        parser.error(str(e))
+    if stats['longestGapDays'] > args.interval:
+        logger.warning("With cron schedules, some secrets go up to %d days between rotations instead of %d",
+                       stats['longestGapDays'], args.interval)
+    changes = diff_schedules(fleet, rules)
+
+    def on_result(result):
+        print(json.dumps(result), flush=True)
+
+    if args.apply:
+        results = apply_schedules(service_client, args.lambda_arn, changes, args.rate, on_result=on_result)
+    else:
+        results = []
+        for entry, wanted in changes:
+            on_result({'secret': entry['Name'], 'from': entry.get('RotationRules') if entry.get('RotationEnabled')
+                       else None, 'to': wanted, 'status': 'planned'})
+    summary = dict(stats, secrets=len(fleet), changes=len(changes),
+                   failed=sum(1 for result in results if result['status'] == 'failed'),
+                   seconds=round(time.monotonic() - started, 3))
+    print(json.dumps({'summary': summary}), flush=True)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
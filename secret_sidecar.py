@@ -0,0 +1,282 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Purpose
+
+A local daemon which serves Astra secrets to the processes of a host over a Unix domain socket.
+
+Cron jobs, CLIs and services which only need the credentials of an Astra secret can ask the sidecar for them
+instead of importing boto3 and calling Secrets Manager themselves. The sidecar validates every secret with the
+same rules as get_secret_dict, keeps the secrets in memory, and refreshes all of them every interval seconds with
+batched GetSecretValue calls (SecretsManagerSecret.get_values). Secrets requested at the same time, by one or many
+clients, are fetched in one batch.
+
+The protocol is one compact JSON object per line, in both directions. Every request names a list of secrets and
+every response has the same shape:
+
+    {"get": ["/astra/prod/app1"]}       answer from memory, fetching the secrets not loaded yet
+    {"refresh": ["/astra/prod/app1"]}   fetch the secrets again first, e.g. after Astra answered 401
+    {"watch": ["/astra/prod/app1"]}     answer like get, then keep the connection open and send the secret
+                                        again every time it changes, e.g. after a rotation
+
+    {"secrets": {"/astra/prod/app1": {"astraKey": "...", ...}}, "errors": {}}
+
+The socket file is only accessible to the user running the sidecar.
+
+Example:
+
+    with SidecarClient('/run/astra-secrets.sock') as sidecar:
+        astra_key = sidecar.get_secret('/astra/prod/app1')['astraKey']
+"""
+# Syntax:
+# python secret_sidecar.py serve --socket <PATH> [--interval SECONDS] [<SECRET ID>...]
+# python secret_sidecar.py get --socket <PATH> <SECRET ID>...
+
+# Example
+# python secret_sidecar.py serve --socket /run/astra-secrets.sock /astra/prod/app1
+# python secret_sidecar.py get --socket /run/astra-secrets.sock /astra/prod/app1
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+
+import lambda_function
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(message):
+    return json.dumps(message, separators=(',', ':')).encode("utf-8") + b"\n"
+
+
+class SecretSidecar:
+    """Serves Astra secrets from memory over a Unix domain socket
+
+    Args:
+        path: The path of the Unix domain socket.
+        secret_ids: The names or ARNs of secrets to load at start, other secrets are loaded on first request.
+        interval: The number of seconds between refreshes of every loaded secret.
+        service_client: Optional Secrets Manager client, by default the client of lambda_function.py.
+        max_workers: The number of Secrets Manager requests made at the same time by a batch.
+    """
+
+    def __init__(self, path, secret_ids=(), interval=60, service_client=None, max_workers=4):
+        self.path = path
+        self.interval = interval
+        self.service_client = service_client
+        self.max_workers = max_workers
+        self.batches = 0
+        self._secrets = {}
+        self._errors = {}
+        self._watchers = {}
+        self._queued = set(secret_ids)
+        self._next_batch = None
+        self._server = None
+
+    def _get_values(self, secret_ids):
+        # Imported here so that clients of this module do not import boto3
+        from secretsmanager_lib import SecretsManagerSecret
+        if self.service_client is None:
+            self.service_client = lambda_function.get_service_client()
+        return SecretsManagerSecret(self.service_client).get_values(
+            sorted(secret_ids), parse=lambda_function.parse_secret_dict, max_workers=self.max_workers)
+
+    def _fetch(self, secret_ids):
+        """Fetches the secrets in the next batch, which also holds the secrets requested until it starts"""
+        loop = asyncio.get_running_loop()
+        self._queued |= set(secret_ids)
+        if self._next_batch is None:
+            self._next_batch = loop.create_future()
+            loop.call_soon(lambda: asyncio.ensure_future(self._run_batch()))
+        return asyncio.shield(self._next_batch)
+
+    async def _run_batch(self):
+        future, secret_ids = self._next_batch, self._queued
+        self._next_batch, self._queued = None, set()
+        self.batches += 1
+        try:
+            values, errors = await asyncio.get_running_loop().run_in_executor(None, self._get_values, secret_ids)
+        except Exception as e:
+            logger.exception("Couldn't fetch %d secrets.", len(secret_ids))
+            values, errors = {}, {secret_id: str(e) for secret_id in secret_ids}
+        for secret_id, secret_dict in values.items():
+            self._errors.pop(secret_id, None)
+            if self._secrets.get(secret_id) != secret_dict:
+                self._secrets[secret_id] = secret_dict
+                self._push(secret_id)
+        for secret_id, error in errors.items():
+            # Keep serving the last value of a secret which was loaded before
+            if secret_id not in self._secrets:
+                self._errors[secret_id] = error
+            logger.error("Couldn't fetch secret %s: %s", secret_id, error)
+        future.set_result(None)
+
+    def _push(self, secret_id):
+        for writer in list(self._watchers.get(secret_id, ())):
+            if writer.is_closing():
+                self._watchers[secret_id].discard(writer)
+                continue
+            writer.write(_encode({'secrets': {secret_id: self._secrets[secret_id]}, 'errors': {}}))
+
+    def _answer(self, secret_ids):
+        return {'secrets': {secret_id: self._secrets[secret_id] for secret_id in secret_ids
+                            if secret_id in self._secrets},
+                'errors': {secret_id: self._errors.get(secret_id, "Not loaded") for secret_id in secret_ids
+                           if secret_id not in self._secrets}}
+
+    async def _handle(self, reader, writer):
+        watching = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    (operation, secret_ids), = request.items()
+                    if operation not in ('get', 'refresh', 'watch'):
+                        raise ValueError(f"Unknown request {operation}")
+                    if not isinstance(secret_ids, list) or not all(isinstance(i, str) for i in secret_ids):
+                        raise ValueError("Secrets must be a list of names or ARNs")
+                except (ValueError, AttributeError) as e:
+                    writer.write(_encode({'secrets': {}, 'errors': {'request': f"Invalid request: {e}"}}))
+                    continue
+                if operation == 'refresh':
+                    await self._fetch(secret_ids)
+                else:
+                    missing = [secret_id for secret_id in secret_ids if secret_id not in self._secrets]
+                    if missing:
+                        await self._fetch(missing)
+                writer.write(_encode(self._answer(secret_ids)))
+                if operation == 'watch':
+                    for secret_id in secret_ids:
+                        self._watchers.setdefault(secret_id, set()).add(writer)
+                        watching.append(secret_id)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for secret_id in watching:
+                self._watchers.get(secret_id, set()).discard(writer)
+            writer.close()
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            # Secrets which failed to load are fetched again on their next request instead
+            if self._secrets:
+                await self._fetch(self._secrets)
+
+    async def serve(self):
+        """Listens on the socket and refreshes the secrets until cancelled"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        old_umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle, self.path)
+        finally:
+            os.umask(old_umask)
+        logger.info("Serving Astra secrets on %s.", self.path)
+        if self._queued:
+            await self._fetch(())
+        refresher = asyncio.ensure_future(self._refresh_loop())
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            refresher.cancel()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class SidecarClient:
+    """Blocking client of the sidecar, which only needs the standard library
+
+    Args:
+        path: The path of the Unix domain socket of the sidecar.
+        timeout: The number of seconds to wait for an answer.
+    """
+
+    def __init__(self, path, timeout=10):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(path)
+        self._file = self._socket.makefile("rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def request(self, operation, secret_ids):
+        """Sends a get, refresh or watch request and returns the response dictionary"""
+        self._socket.sendall(_encode({operation: list(secret_ids)}))
+        return self._read()
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("The sidecar closed the connection")
+        return json.loads(line)
+
+    def get_secret(self, secret_id, refresh=False):
+        """Returns the secret dictionary of a secret
+
+        Raises:
+            KeyError: If the sidecar could not load the secret
+        """
+        response = self.request('refresh' if refresh else 'get', [secret_id])
+        if secret_id not in response['secrets']:
+            raise KeyError(f"Secret {secret_id} is not available: {response['errors'].get(secret_id)}")
+        return response['secrets'][secret_id]
+
+    def watch(self, secret_ids):
+        """Yields a (secret ID, secret dictionary) tuple for the current value of each secret, then again
+        every time one of them changes. The connection is dedicated to the watch from then on."""
+        response = self.request('watch', secret_ids)
+        while True:
+            for secret_id, error in response['errors'].items():
+                logger.error("Secret %s is not available: %s", secret_id, error)
+            yield from response['secrets'].items()
+            self._socket.settimeout(None)
+            response = self._read()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve Astra secrets over a Unix domain socket")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='run the sidecar')
+    serve_parser.add_argument('--interval', type=float, default=60, help='number of seconds between refreshes')
+    get_parser = subparsers.add_parser('get', help='print secrets served by a running sidecar')
+    for subparser in (serve_parser, get_parser):
+        subparser.add_argument('--socket', required=True, help='path of the Unix domain socket')
+    serve_parser.add_argument('secret_ids', nargs='*', help='names or ARNs of secrets to load at start')
+    get_parser.add_argument('secret_ids', nargs='+', help='names or ARNs of the secrets to print')
+    args = parser.parse_args(argv)
+
+    if args.command == 'get':
+        with SidecarClient(args.socket) as sidecar:
+            response = sidecar.request('get', args.secret_ids)
+        print(json.dumps(response, indent=4))
+        return 1 if response['errors'] else 0
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(SecretSidecar(args.socket, args.secret_ids, args.interval).serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
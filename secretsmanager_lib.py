@@ -17,11 +17,15 @@ import json
 import logging
 from pprint import pprint
 import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of secrets a single BatchGetSecretValue call can return
+BATCH_GET_SIZE = 20
+
 
 # snippet-start:[python.example_code.secrets-manager.SecretsManagerSecret]
 class SecretsManagerSecret:
@@ -115,6 +119,98 @@ class SecretsManagerSecret:
             return response
 # snippet-end:[python.example_code.secrets-manager.GetSecretValue]
 
+    def get_values(self, secret_ids=None, filters=None, stage=None, parse=None, max_workers=4):
+        """
+        Gets the values of many secrets. Secrets are fetched with BatchGetSecretValue
+        in chunks of BATCH_GET_SIZE, with the chunks fetched in parallel. When the
+        client does not support BatchGetSecretValue (botocore before 1.33), or a stage
+        other than AWSCURRENT is requested, each secret is fetched with
+        GetSecretValue instead, also in parallel. With filters, the names of the
+        selected secrets are listed with ListSecrets first, then fetched the same way.
+
+        A secret which can't be fetched or parsed does not fail the whole batch, it
+        is reported in the returned errors instead.
+
+        :param secret_ids: The names or ARNs of the secrets to get.
+        :param filters: ListSecrets filters which select the secrets to get instead of
+                        secret_ids, such as [{'Key': 'name', 'Values': ['/astra/']}].
+        :param stage: The stage of the secrets to retrieve. If this is None, the
+                      current stage is retrieved.
+        :param parse: Optional function applied to the `SecretString` of each secret,
+                      such as lambda_function.parse_secret_dict to parse and validate
+                      Astra secrets with the same rules as get_secret_dict.
+        :param max_workers: The number of requests made at the same time.
+        :return: A tuple of two dictionaries keyed by the requested secret ID (or by
+                 name when filters are used): the values, which are the parsed
+                 `SecretString` when parse is given and the full secret value
+                 otherwise, and the errors, with the error message of each secret
+                 which failed.
+        """
+        if (secret_ids is None) == (filters is None):
+            raise ValueError("Exactly one of secret_ids and filters is required")
+
+        values = {}
+        errors = {}
+
+        def collect(secret_id, secret):
+            if parse is None:
+                values[secret_id] = secret
+                return
+            try:
+                values[secret_id] = parse(secret['SecretString'])
+            except (KeyError, ValueError, TypeError) as e:
+                errors[secret_id] = f"{type(e).__name__}: {e}"
+
+        batch = hasattr(self.secretsmanager_client, 'batch_get_secret_value') and stage in (None, 'AWSCURRENT')
+        if filters is not None:
+            # Filtered BatchGetSecretValue pages can only be read one after the other, and a page which
+            # fails loses all of its secrets, so the names are listed and fetched in parallel chunks instead
+            secret_ids = [secret['Name'] for secret in self.list(None, filters)]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if batch:
+                chunks = [secret_ids[i:i + BATCH_GET_SIZE] for i in range(0, len(secret_ids), BATCH_GET_SIZE)]
+                for results in executor.map(self._batch_get_chunk, chunks):
+                    for secret_id, secret, error in results:
+                        if error is None:
+                            collect(secret_id, secret)
+                        else:
+                            errors[secret_id] = error
+            else:
+                def get_one(secret_id):
+                    kwargs = {'SecretId': secret_id}
+                    if stage is not None:
+                        kwargs['VersionStage'] = stage
+                    try:
+                        return secret_id, self.secretsmanager_client.get_secret_value(**kwargs), None
+                    except (BotoCoreError, ClientError) as e:
+                        return secret_id, None, str(e)
+
+                for secret_id, secret, error in executor.map(get_one, secret_ids):
+                    if error is None:
+                        collect(secret_id, secret)
+                    else:
+                        errors[secret_id] = error
+
+        logger.info("Got values for %s secrets, %s failed.", len(values), len(errors))
+        return values, errors
+
+    def _batch_get_chunk(self, secret_ids):
+        """Gets up to BATCH_GET_SIZE secrets, keyed by the requested IDs."""
+        try:
+            response = self.secretsmanager_client.batch_get_secret_value(SecretIdList=secret_ids)
+        except (BotoCoreError, ClientError) as e:
+            logger.exception("Couldn't get values for a batch of %s secrets.", len(secret_ids))
+            return [(secret_id, None, str(e)) for secret_id in secret_ids]
+        requested = set(secret_ids)
+        results = []
+        for secret in response.get('SecretValues', []):
+            secret_id = secret['ARN'] if secret['ARN'] in requested else secret['Name']
+            results.append((secret_id, secret, None))
+        for error in response.get('Errors', []):
+            results.append((error['SecretId'], None, f"{error.get('ErrorCode')}: {error.get('Message')}"))
+        return results
+
 # snippet-start:[python.example_code.secrets-manager.GetRandomPassword]
     def get_random_password(self, pw_length):
         """
@@ -218,17 +314,21 @@ class SecretsManagerSecret:
 # snippet-end:[python.example_code.secrets-manager.DeleteSecret]
 
 # snippet-start:[python.example_code.secrets-manager.ListSecrets]
-    def list(self, max_results):
+    def list(self, max_results, filters=None):
         """
         Lists secrets for the current account.
 
         :param max_results: The maximum number of results to return.
+        :param filters: Optional list of ListSecrets filters, such as
+                        [{'Key': 'name', 'Values': ['/astra/']}].
         :return: Yields secrets one at a time.
         """
         try:
+            kwargs = {'PaginationConfig': {'MaxItems': max_results}}
+            if filters is not None:
+                kwargs['Filters'] = filters
             paginator = self.secretsmanager_client.get_paginator('list_secrets')
-            for page in paginator.paginate(
-                    PaginationConfig={'MaxItems': max_results}):
+            for page in paginator.paginate(**kwargs):
                 for secret in page['SecretList']:
                     yield secret
         except ClientError:
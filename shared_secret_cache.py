@@ -0,0 +1,299 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Purpose
+
+A secret cache shared by the processes of a host, such as the workers of a gunicorn or uwsgi server.
+
+The secrets are kept in a memory-mapped file (preferably on a tmpfs such as /dev/shm), one fixed-size slot per
+secret. A single process of the host, the refresher, fetches the secrets with batched GetSecretValue calls and
+writes them to their slots; every other process only reads them, without any network call. Secrets Manager
+traffic then scales with the number of hosts instead of the number of processes.
+
+Every process can call start(): the processes compete for an exclusive lock on <path>.lock, and the one holding
+it refreshes the secrets. When it exits the lock is released and another process takes over at its next check.
+The refresher can also be run as a process of its own with this script.
+
+Reads are lock-free. Each slot starts with a sequence number, which the refresher makes odd before it writes the
+slot and even again afterwards (a seqlock). A reader copies the slot and checks that the sequence number was the
+same even number before and after the copy, and retries otherwise, until the timeout of get(). A slot left odd by
+a refresher killed in the middle of a write is cleared by the next refresher. The last value decoded from each slot is kept
+with its sequence number, so that reading an unchanged secret only costs the read of its sequence number.
+
+Example (in a gunicorn post_fork hook, or at import time in each worker):
+
+    cache = SharedSecretCache('/dev/shm/astra-secrets', ['/astra/prod/app1'])
+    cache.start()
+    ...
+    headers = {'Authorization': f"Bearer {cache.get('/astra/prod/app1')['astraKey']}"}
+"""
+# Syntax:
+# python shared_secret_cache.py --path <FILE> [--interval SECONDS] <SECRET ID>...
+
+# Example
+# python shared_secret_cache.py --path /dev/shm/astra-secrets /astra/prod/app1 /astra/prod/app2
+
+import argparse
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import lambda_function
+from secretsmanager_lib import SecretsManagerSecret
+
+logger = logging.getLogger(__name__)
+
+# Magic number and layout version at the start of the file
+cacheMagic = b"ASTRASC1"
+
+# File header: magic number, number of slots, slot size
+cacheHeader = struct.Struct("<8sII")
+
+# Slot header: sequence number, payload length
+slotHeader = struct.Struct("<QI")
+
+
+class SharedSecretCache:
+    """Astra secrets shared between the processes of a host through a memory-mapped file
+
+    Args:
+        path: The path of the cache file, created when it does not exist.
+        secret_ids: The names or ARNs of the secrets the refresher keeps in the cache.
+        slots: The number of secrets the file can hold.
+        slot_size: The size of each slot, in bytes, which bounds the size of a secret.
+        interval: The number of seconds between refreshes, and between attempts to become the refresher.
+        service_client: Optional Secrets Manager client of the refresher. By default the client of
+                        lambda_function.py is created, and only in the process which becomes the refresher.
+    """
+
+    def __init__(self, path, secret_ids=(), slots=64, slot_size=4096, interval=60, service_client=None):
+        self.path = path
+        self.secret_ids = list(secret_ids)
+        self.interval = interval
+        self.service_client = service_client
+        self.refresher = False
+        self._slot_of = {}
+        self._decoded = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock_fd = None
+        self._mmap, self.slots, self.slot_size = self._open(path, slots, slot_size)
+
+    @staticmethod
+    def _open(path, slots, slot_size):
+        """Maps the cache file, creating it under an exclusive lock when needed"""
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < cacheHeader.size:
+                    os.ftruncate(fd, cacheHeader.size + slots * slot_size)
+                    os.pwrite(fd, cacheHeader.pack(cacheMagic, slots, slot_size), 0)
+                magic, slots, slot_size = cacheHeader.unpack(os.pread(fd, cacheHeader.size, 0))
+                if magic != cacheMagic:
+                    raise ValueError(f"{path} is not an Astra secret cache file")
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            return mmap.mmap(fd, cacheHeader.size + slots * slot_size), slots, slot_size
+        finally:
+            os.close(fd)
+
+    def _offset(self, slot):
+        return cacheHeader.size + slot * self.slot_size
+
+    def _read_slot(self, slot, deadline=None):
+        """Returns the sequence number and payload of a slot, retrying while the refresher writes it
+
+        Raises:
+            TimeoutError: If the slot is still being written at deadline (a time.monotonic() value), e.g.
+                because the refresher was killed in the middle of a write
+        """
+        offset = self._offset(slot)
+        while True:
+            seq, length = slotHeader.unpack_from(self._mmap, offset)
+            if seq & 1:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError(f"Slot {slot} of the shared cache {self.path} is still being written")
+                time.sleep(0)
+                continue
+            cached = self._decoded.get(slot)
+            if cached is not None and cached[0] == seq:
+                return cached
+            start = offset + slotHeader.size
+            payload = self._mmap[start:start + min(length, self.slot_size - slotHeader.size)]
+            if slotHeader.unpack_from(self._mmap, offset)[0] != seq:
+                continue
+            entry = (seq, json.loads(payload) if length else None)
+            self._decoded[slot] = entry
+            return entry
+
+    def _scan(self):
+        """Finds the slot of every secret in the file, skipping the slots being written"""
+        slot_of = {}
+        for slot in range(self.slots):
+            try:
+                seq, entry = self._read_slot(slot, deadline=0)
+            except TimeoutError:
+                continue
+            if entry is not None:
+                slot_of[entry['id']] = slot
+        self._slot_of = slot_of
+
+    def get(self, secret_id, timeout=10):
+        """Returns the cached secret dictionary of a secret, without any network call
+
+        Args:
+            secret_id: The name or ARN of the secret, as given to the refresher.
+            timeout: The number of seconds to wait for the refresher to write the secret the first time.
+
+        Raises:
+            KeyError: If the secret is not in the cache after timeout seconds
+        """
+        return dict(self._entry(secret_id, timeout)['secret'])
+
+    def updated(self, secret_id, timeout=0):
+        """Returns the time the refresher last wrote a secret, as a timestamp
+
+        Raises:
+            KeyError: If the secret is not in the cache after timeout seconds
+        """
+        return self._entry(secret_id, timeout)['updated']
+
+    def _entry(self, secret_id, timeout):
+        """Returns the entry of a secret, looking for its slot again when the slot was reused for another one"""
+        deadline = time.monotonic() + timeout
+        while True:
+            slot = self._slot_of.get(secret_id)
+            if slot is not None:
+                try:
+                    seq, entry = self._read_slot(slot, deadline)
+                except TimeoutError:
+                    raise KeyError(f"Secret {secret_id} is not readable in the shared cache {self.path}")
+                if entry is not None and entry['id'] == secret_id:
+                    return entry
+            self._scan()
+            if secret_id in self._slot_of and self._slot_of[secret_id] != slot:
+                continue
+            if time.monotonic() >= deadline:
+                raise KeyError(f"Secret {secret_id} is not in the shared cache {self.path}")
+            time.sleep(0.05)
+
+    def _write_slot(self, slot, payload):
+        offset = self._offset(slot)
+        # Round up to an even number first: a refresher killed in the middle of a write leaves it odd
+        seq = (slotHeader.unpack_from(self._mmap, offset)[0] + 1) & ~1
+        # An odd sequence number tells readers that the slot is being written
+        slotHeader.pack_into(self._mmap, offset, seq + 1, 0)
+        start = offset + slotHeader.size
+        self._mmap[start:start + len(payload)] = payload
+        slotHeader.pack_into(self._mmap, offset, seq + 1, len(payload))
+        slotHeader.pack_into(self._mmap, offset, seq + 2, len(payload))
+
+    def refresh(self):
+        """Fetches every secret and writes the ones which changed, in the refresher process only
+
+        Returns:
+            the errors of the secrets which could not be fetched, keyed by secret ID
+        """
+        if self.service_client is None:
+            self.service_client = lambda_function.get_service_client()
+        # Only the refresher writes, so a slot left odd was cut short by a refresher which died: clear it
+        for slot in range(self.slots):
+            if slotHeader.unpack_from(self._mmap, self._offset(slot))[0] & 1:
+                logger.warning("Clearing slot %d of the shared cache %s, left half written.", slot, self.path)
+                self._write_slot(slot, b"")
+        self._scan()
+        values, errors = SecretsManagerSecret(self.service_client).get_values(
+            self.secret_ids, parse=lambda_function.parse_secret_dict)
+        free = [slot for slot in range(self.slots) if slot not in self._slot_of.values()]
+        for secret_id, secret_dict in values.items():
+            slot = self._slot_of.get(secret_id)
+            if slot is not None and self._read_slot(slot)[1]['secret'] == secret_dict:
+                continue
+            if slot is None:
+                if not free:
+                    errors[secret_id] = f"No free slot in the shared cache {self.path}"
+                    continue
+                slot = self._slot_of[secret_id] = free.pop(0)
+            payload = json.dumps({'id': secret_id, 'updated': time.time(), 'secret': secret_dict},
+                                 separators=(',', ':')).encode("utf-8")
+            if len(payload) > self.slot_size - slotHeader.size:
+                errors[secret_id] = f"Secret is larger than the slots of the shared cache {self.path}"
+                continue
+            self._write_slot(slot, payload)
+            logger.info("Updated secret %s in the shared cache.", secret_id)
+        for secret_id, error in errors.items():
+            logger.error("Couldn't refresh secret %s in the shared cache: %s", secret_id, error)
+        return errors
+
+    def _try_become_refresher(self):
+        if self._lock_fd is None:
+            self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        logger.info("Process %d is now the refresher of the shared cache %s.", os.getpid(), self.path)
+        self.refresher = True
+        return True
+
+    def _run(self):
+        delay = 0
+        while not self._stopped.wait(delay):
+            delay = self.interval
+            if not self.refresher and not self._try_become_refresher():
+                continue
+            try:
+                self.refresh()
+            except Exception:
+                # Readers keep the last values written, try again at the next refresh
+                logger.exception("Couldn't refresh the shared cache %s.", self.path)
+
+    def start(self):
+        """Starts a background thread which refreshes the cache whenever this process holds the refresher lock"""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="shared-secret-cache", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops refreshing, and releases the refresher lock for another process to take over"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+            self.refresher = False
+
+    def close(self):
+        self.stop()
+        self._mmap.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Refresh a shared-memory cache of Astra secrets")
+    parser.add_argument('--path', required=True, help='the cache file, preferably on a tmpfs such as /dev/shm')
+    parser.add_argument('--interval', type=float, default=60, help='number of seconds between refreshes')
+    parser.add_argument('--slots', type=int, default=64, help='number of secrets the cache file can hold')
+    parser.add_argument('secret_ids', nargs='+', help='names or ARNs of the secrets to cache')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    cache = SharedSecretCache(args.path, args.secret_ids, slots=args.slots, interval=args.interval)
+    cache.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Tests of the streaming JSON parser, the Astra connection pool and the retry policy of lambda_function.py.
+
+The pool tests run against a local HTTPS server with a self-signed certificate made with the openssl command
+line tool, and are skipped when it is not installed.
+"""
+
+import email.utils
+import http.client
+import http.server
+import io
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import threading
+import time
+
+import pytest
+
+import lambda_function
+from lambda_function import AstraConnectionError, AstraConnectionPool, JSONStreamParser, RetryBudget, retry_delay
+
+DOCUMENT = {
+    "other": {"nested": [1, 2.5e-3, None, True], "text": "a \"quoted\" \\ value"},
+    "clients": [
+        {"clientId": "0d1e2f", "roles": ["read-write-user"], "name": "café 東京 \U0001f511"},
+        {"clientId": "3a4b5c", "roles": [], "escaped": "\\u00e9 é \\n"},
+        [],
+        {},
+        "",
+        -12345.678e9,
+    ],
+    "after": [{"clients": ["not", "these"]}],
+}
+
+
+class OneChunkAtATime(io.RawIOBase):
+    """Binary stream which never returns more than size bytes, whatever is asked"""
+
+    def __init__(self, content, size):
+        self.content = content
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        size = self.size if size is None or size < 0 else min(size, self.size)
+        chunk = self.content[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5, 7, 13, 64, 4096])
+def test_parser_splits_anywhere(chunk_size):
+    content = json.dumps(DOCUMENT, ensure_ascii=False, indent=1).encode("utf-8")
+    parser = JSONStreamParser(OneChunkAtATime(content, chunk_size), chunk_size)
+    assert list(parser.items("clients")) == DOCUMENT["clients"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 4096])
+def test_parser_splits_multibyte_characters(chunk_size):
+    # Every boundary of a 1 byte chunk falls inside a 2, 3 or 4 byte UTF-8 sequence at some point
+    clients = [{"clientId": "é東\U0001f511" * 5}]
+    content = json.dumps({"clients": clients}, ensure_ascii=False).encode("utf-8")
+    assert list(JSONStreamParser(io.BytesIO(content), chunk_size).items("clients")) == clients
+
+
+def test_parser_empty_array():
+    assert list(JSONStreamParser(io.BytesIO(b' { "clients" : [ ] } '), 1).items("clients")) == []
+
+
+def test_parser_missing_key():
+    with pytest.raises(KeyError):
+        list(JSONStreamParser(io.BytesIO(b'{"other": []}'), 2).items("clients"))
+
+
+@pytest.mark.parametrize("content", [b'{"clients": [1, 2}', b'{"clients": [1]} x', b'{"clients": [1,'])
+def test_parser_invalid_document(content):
+    with pytest.raises(ValueError):
+        list(JSONStreamParser(io.BytesIO(content), 3).items("clients"))
+
+
+def test_retry_after_seconds():
+    assert retry_delay("GET", 1, 503, [("Retry-After", "2")]) >= 2
+
+
+def test_retry_after_date():
+    date = email.utils.formatdate(time.time() + 10, usegmt=True)
+    assert 8 <= retry_delay("GET", 1, 429, [("retry-after", date)]) <= 10
+
+
+def test_retry_after_too_long():
+    assert retry_delay("GET", 1, 503, [("Retry-After", str(lambda_function.astraAPIretryAfterMax + 1))]) is None
+
+
+def test_retry_after_invalid():
+    assert 0 <= retry_delay("GET", 1, 503, [("Retry-After", "soon")]) <= lambda_function.astraAPIbackoffBase
+
+
+def test_retry_backoff_is_capped():
+    for attempt in range(1, 20):
+        assert 0 <= retry_delay("DELETE", attempt, 500, []) <= lambda_function.astraAPIbackoffMax
+
+
+def test_retry_post():
+    # A POST may have created a token unless it was rejected with 429 or never sent
+    assert retry_delay("POST", 1, 500, []) is None
+    assert retry_delay("POST", 1, None, [], ConnectionResetError()) is None
+    assert retry_delay("POST", 1, 429, []) is not None
+    assert retry_delay("POST", 1, None, [], AstraConnectionError("refused")) is not None
+
+
+def test_retry_statuses():
+    assert retry_delay("GET", 1, None, [], ConnectionResetError()) is not None
+    assert retry_delay("GET", 1, 401, []) is None
+    assert retry_delay("GET", 1, 404, []) is None
+
+
+def test_retry_budget_exhaustion():
+    budget = RetryBudget(ratio=0.5, minimum=2)
+    assert budget.withdraw() and budget.withdraw()
+    assert not budget.withdraw()
+    assert budget.exhausted == 1
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    assert budget.retries == 3
+
+
+def test_retry_budget_cap():
+    budget = RetryBudget(ratio=0.1, minimum=1)
+    for _ in range(1000):
+        budget.deposit()
+    assert budget.balance == pytest.approx(budget.cap)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with self.server.lock:
+            self.server.requests.append(self.command)
+        body = json.dumps({"method": self.command}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Closes the connection without a Connection: close header, as a server dropping an idle socket would
+        self.close_connection = self.server.close_after_response
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    if shutil.which("openssl") is None:
+        pytest.skip("the openssl command line tool is not installed")
+    directory = tmp_path_factory.mktemp("certificate")
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj",
+                    "/CN=localhost", "-addext", "subjectAltName=DNS:localhost", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+@pytest.fixture
+def server(certificate):
+    httpd = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.close_after_response = False
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*certificate)
+    httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def pool(server, certificate):
+    pool = AstraConnectionPool(f"localhost:{server.server_address[1]}",
+                               ssl_context=ssl.create_default_context(cafile=certificate[0]))
+    yield pool
+    pool.close()
+
+
+def test_pool_reuses_connections(pool, server):
+    for _ in range(3):
+        status, reason, headers, content = pool.request("GET", "/v2/currentOrg")
+        assert status == 200
+    assert pool.stats() == {'hits': 2, 'misses': 1, 'reconnects': 0, 'idle': 1}
+
+
+def test_pool_drops_sockets_closed_by_the_server(pool, server):
+    server.close_after_response = True
+    assert pool.request("GET", "/v2/currentOrg")[0] == 200
+    deadline = time.monotonic() + 5
+    while pool._idle and not AstraConnectionPool._at_eof(pool._idle[-1]) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # The closed idle socket is not reused, so even a POST goes to a new connection, once
+    assert json.loads(pool.request("POST", "/v2/clientIdSecrets", "{}")[3]) == {"method": "POST"}
+    assert pool.stats()['hits'] == 0 and pool.stats()['reconnects'] == 0
+    assert server.requests == ["GET", "POST"]
+
+
+def fail_first_response(monkeypatch, error):
+    getresponse = http.client.HTTPConnection.getresponse
+    failures = [error]
+
+    def fail_once(self):
+        response = getresponse(self)
+        if failures:
+            # The server processed the request, but the response was lost with the connection
+            response.read()
+            raise failures.pop()
+        return response
+
+    monkeypatch.setattr(http.client.HTTPConnection, "getresponse", fail_once)
+
+
+@pytest.mark.parametrize("error", [http.client.RemoteDisconnected("closed"), ssl.SSLEOFError(8, "EOF"),
+                                   ssl.SSLZeroReturnError(6, "closed")])
+def test_pool_reconnects_stale_idempotent_requests(pool, server, monkeypatch, error):
+    assert pool.request("GET", "/v2/currentOrg")[0] == 200
+    monkeypatch.setattr(AstraConnectionPool, "_at_eof", staticmethod(lambda conn: False))
+    fail_first_response(monkeypatch, error)
+    assert pool.request("GET", "/v2/currentOrg")[0] == 200
+    assert pool.stats()['reconnects'] == 1
+    assert server.requests == ["GET", "GET", "GET"]
+
+
+def test_pool_does_not_replay_post(pool, server, monkeypatch):
+    assert pool.request("GET", "/v2/currentOrg")[0] == 200
+    monkeypatch.setattr(AstraConnectionPool, "_at_eof", staticmethod(lambda conn: False))
+    fail_first_response(monkeypatch, http.client.RemoteDisconnected("closed"))
+    with pytest.raises(http.client.RemoteDisconnected):
+        pool.request("POST", "/v2/clientIdSecrets", "{}")
+    assert pool.stats()['reconnects'] == 0
+    assert server.requests == ["GET", "POST"]
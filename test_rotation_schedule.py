@@ -0,0 +1,87 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Tests of the capacity and placement of the rotation planner of rotation_schedule.py.
+"""
+
+import bisect
+import collections
+import random
+
+import pytest
+
+from rotation_schedule import peak_load, plan_schedules, scan_quantile, slot_capacity
+
+NAMES = [f"/astra/prod/app{i}" for i in range(600)]
+
+
+@pytest.mark.parametrize("max_concurrency", [1, 3, 10, 50])
+def test_capacity_is_below_the_average_bound(max_concurrency):
+    capacity = slot_capacity(2, max_concurrency, None, 10, 4)
+    assert 0 < capacity < max_concurrency * 7200 / 10
+    assert peak_load(capacity, 2, 10, 4)['peakConcurrency'] <= max_concurrency
+    assert peak_load(capacity + 1, 2, 10, 4)['peakConcurrency'] > max_concurrency
+
+
+def test_capacity_grows_with_the_limits():
+    capacities = [slot_capacity(2, limit, None, 10, 4) for limit in (2, 4, 8, 16)]
+    assert capacities == sorted(capacities)
+    assert slot_capacity(4, 4, None, 10, 4) > slot_capacity(2, 4, None, 10, 4)
+    assert slot_capacity(2, None, None, 10, 4) is None
+
+
+def test_capacity_takes_the_tightest_limit():
+    by_concurrency = slot_capacity(2, 10, None, 10, 4)
+    by_rate = slot_capacity(2, None, 2, 10, 4)
+    assert slot_capacity(2, 10, 2, 10, 4) == min(by_concurrency, by_rate)
+
+
+def test_peak_concurrency_is_rarely_exceeded():
+    # Rotations start at random times of the window: the planned peak holds in about 99% of the windows
+    random.seed(7)
+    window, rotation, limit = 7200, 10, 3
+    secrets = slot_capacity(2, limit, None, rotation, 4)
+    exceeded = 0
+    for _ in range(500):
+        starts = sorted(random.uniform(0, window) for _ in range(secrets))
+        peak = max(bisect.bisect_left(starts, start + rotation) - i for i, start in enumerate(starts))
+        exceeded += peak > limit
+    assert exceeded <= 20
+
+
+def test_scan_quantile_edge_cases():
+    assert scan_quantile(0, 7200, 10, 0.99) == 0
+    assert scan_quantile(1, 7200, 10, 0.99) == 1
+    assert scan_quantile(100, 7200, 10, 0.999) >= scan_quantile(100, 7200, 10, 0.9)
+
+
+def test_plan_is_under_capacity():
+    rules, stats = plan_schedules(NAMES, interval_days=7, duration_hours=2, max_concurrency=3)
+    assert set(rules) == set(NAMES)
+    counts = collections.Counter(rule['ScheduleExpression'] for rule in rules.values())
+    assert max(counts.values()) == stats['largestSlot'] <= stats['capacity']
+    assert stats['peakConcurrency'] <= 3
+    assert all(rule['Duration'] == "2h" for rule in rules.values())
+
+
+def test_plan_is_deterministic():
+    shuffled = list(NAMES)
+    random.Random(3).shuffle(shuffled)
+    assert plan_schedules(NAMES, 14, 2, 3)[0] == plan_schedules(shuffled + NAMES[:10], 14, 2, 3)[0]
+
+
+@pytest.mark.parametrize("count", [100, 780])
+def test_new_secret_moves_few_others(count):
+    # 780 secrets nearly fill the 12 windows of a day of 71 secrets each, so some slots are full
+    names = NAMES[:count] if count <= len(NAMES) else NAMES + [f"/astra/dev/app{i}" for i in range(count - 600)]
+    before, _ = plan_schedules(names, 1, 2, 3)
+    after, _ = plan_schedules(names + ["/astra/prod/new"], 1, 2, 3)
+    moved = [name for name in names if before[name] != after[name]]
+    assert len(moved) <= 1
+
+
+def test_plan_too_large():
+    capacity = slot_capacity(2, 1, None, 10, 4)
+    with pytest.raises(ValueError):
+        plan_schedules([f"s{i}" for i in range(capacity * 12 + 1)], 1, 2, 1)
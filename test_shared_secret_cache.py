@@ -0,0 +1,109 @@
+# Copyright 2023 Datastax. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Tests of the sequence-locked slots of shared_secret_cache.py, written directly with _write_slot as the refresher
+would, without any Secrets Manager call.
+"""
+
+import json
+import threading
+import time
+
+import pytest
+
+from shared_secret_cache import SharedSecretCache, slotHeader
+
+
+def payload(secret_id, value):
+    return json.dumps({'id': secret_id, 'updated': time.time(), 'secret': {'astraKey': value}}).encode("utf-8")
+
+
+@pytest.fixture
+def caches(tmp_path):
+    path = str(tmp_path / "secrets.cache")
+    writer = SharedSecretCache(path, slots=4, slot_size=512)
+    reader = SharedSecretCache(path)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+def leave_half_written(cache, slot):
+    # A refresher killed in the middle of _write_slot leaves an odd sequence number
+    offset = cache._offset(slot)
+    seq, length = slotHeader.unpack_from(cache._mmap, offset)
+    slotHeader.pack_into(cache._mmap, offset, seq + 1, length)
+
+
+def test_read_written_secret(caches):
+    writer, reader = caches
+    writer._write_slot(0, payload("a", "one"))
+    assert reader.get("a", timeout=0) == {'astraKey': "one"}
+    assert reader.updated("a") <= time.time()
+
+
+def test_odd_sequence_times_out(caches):
+    writer, reader = caches
+    writer._write_slot(0, payload("a", "one"))
+    reader.get("a", timeout=0)
+    leave_half_written(writer, 0)
+    with pytest.raises(TimeoutError):
+        reader._read_slot(0, deadline=time.monotonic() + 0.1)
+    started = time.monotonic()
+    with pytest.raises(KeyError):
+        reader.get("a", timeout=0.2)
+    with pytest.raises(KeyError):
+        reader.updated("a", timeout=0.2)
+    assert time.monotonic() - started < 2
+
+
+def test_half_written_slot_is_skipped_by_scan(caches):
+    writer, reader = caches
+    writer._write_slot(0, payload("a", "one"))
+    writer._write_slot(1, payload("b", "two"))
+    leave_half_written(writer, 0)
+    reader._scan()
+    assert reader._slot_of == {"b": 1}
+
+
+def test_reused_slot(caches):
+    writer, reader = caches
+    writer._write_slot(0, payload("a", "one"))
+    assert reader.updated("a") is not None
+    # The slot of a is given to b, and a moves to another slot
+    writer._write_slot(0, payload("b", "two"))
+    writer._write_slot(2, payload("a", "three"))
+    assert reader.get("a", timeout=0) == {'astraKey': "three"}
+    writer._write_slot(2, b"")
+    with pytest.raises(KeyError):
+        reader.updated("a")
+
+
+def test_no_torn_reads(caches):
+    writer, reader = caches
+    # Values of different lengths, so that a torn read would mix the bytes of two of them
+    values = ["x" * length for length in (10, 200, 50, 400)]
+    writer._write_slot(0, payload("a", values[0]))
+    stopped = threading.Event()
+
+    def write():
+        i = 0
+        while not stopped.is_set():
+            i += 1
+            writer._write_slot(0, payload("a", values[i % len(values)]))
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        seen = set()
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline:
+            seq, entry = reader._read_slot(0, deadline=time.monotonic() + 5)
+            assert seq % 2 == 0
+            assert entry['secret']['astraKey'] in values
+            seen.add(entry['secret']['astraKey'])
+    finally:
+        stopped.set()
+        thread.join()
+    assert len(seen) > 1